@@ -0,0 +1,71 @@
+"""Measure fuzzy path completion on a large synthetic tree.
+
+The index is built from generated paths, so no files are written. Each query
+is timed as a keystroke sequence, the way the REPL asks for completions.
+
+Usage: python benchmarks/bench_completer.py [--paths 100000] [--repeat 5]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import eng  # noqa: E402
+
+QUERIES = ['eng.py', 'srcutil', 'pkg12/mod', 'p/c/f9999', 'sub3/99', 'file_99999.py', 'readme', 'test_http', 'zzz']
+WORDS = ['core', 'utils', 'http', 'client', 'server', 'models', 'views', 'tests', 'api', 'config', 'parser', 'cache']
+
+
+def synthetic_paths(count, seed=0):
+    """Files spread over a few thousand folders, roughly like a large monorepo."""
+    rng = random.Random(seed)
+    folders = [
+        f"src/pkg{package}/{word}{variant}" + (f"/sub{sub}" if sub else "")
+        for package in range(30) for word in WORDS for variant in range(3) for sub in range(5)
+    ]
+    paths = ['eng.py', 'engc.py', 'README.md']
+    for i in range(count - len(paths)):
+        word = rng.choice(WORDS)
+        name = rng.choice([f"file_{i}.py", f"test_{word}_{i}.py", f"{word}_{i}.js"])
+        paths.append(f"{rng.choice(folders)}/{name}")
+    for path in list(paths):
+        directory = os.path.dirname(path)
+        while directory:
+            paths.append(directory + '/')
+            directory = os.path.dirname(directory)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the fuzzy path completer")
+    parser.add_argument("--paths", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    paths = synthetic_paths(args.paths)
+    start = time.perf_counter()
+    index = eng.index_paths(paths)
+    print(f"index build  {time.perf_counter() - start:8.3f}s  ({len(index['lines'])} paths)")
+
+    print(f"{'query':<20} {'last (ms)':>10} {'worst key (ms)':>15} {'results':>8}")
+    worst = []
+    for query in QUERIES:
+        keystrokes = []
+        for end in range(1, len(query) + 1):
+            samples = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                results = eng.fuzzy_find_paths(query[:end], index=index)
+                samples.append(time.perf_counter() - start)
+            keystrokes.append(min(samples) * 1000)
+        worst.append(max(keystrokes))
+        print(f"{query:<20} {keystrokes[-1]:>10.2f} {max(keystrokes):>15.2f} {len(results):>8}")
+    print(f"median worst keystroke {statistics.median(worst):.2f}ms, max {max(worst):.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Compare a cold eng.py run with commands sent to a warm daemon.
+
+A mock server stands in for the API. The cold path runs one chat task with
+`eng.py --batch`; the warm path sends the same task to `eng.py --daemon`
+through engc.py, in process, so interpreter startup is not counted.
+
+Usage: python benchmarks/bench_daemon.py [--repeat 10]
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+
+import engc  # noqa: E402
+from mock_server import MockConfig, start_server  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark daemon dispatch against cold starts")
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    server, base_url = start_server(MockConfig())
+    home = tempfile.mkdtemp(prefix="stima-daemon-")
+    env = dict(os.environ, HOME=home)
+    options = ['--base-url', base_url, '--api-key', 'mock-key', '--no-cache', '--no-telemetry']
+    socket_path = os.path.join(home, 'daemon.sock')
+    task = {'command': 'Explain the retry layer', 'cwd': home}
+    try:
+        tasks_path = os.path.join(home, 'tasks.jsonl')
+        with open(tasks_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(task) + "\n")
+        cold = []
+        for _ in range(max(1, args.repeat // 3)):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, os.path.join(ROOT, 'eng.py'), '--batch', tasks_path] + options,
+                           env=env, cwd=home, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            cold.append(time.perf_counter() - start)
+
+        daemon = subprocess.Popen([sys.executable, os.path.join(ROOT, 'eng.py'), '--daemon', '--socket', socket_path] + options,
+                                  env=env, cwd=home, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            deadline = time.monotonic() + 30
+            while not os.path.exists(socket_path) and time.monotonic() < deadline:
+                time.sleep(0.05)
+            pings, warm = [], []
+            devnull = open(os.devnull, 'w')
+            stdout, stderr = sys.stdout, sys.stderr
+            sys.stdout = sys.stderr = devnull
+            try:
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    engc.send_task({'command': '/ping'}, socket_path, [], autostart=False)
+                    pings.append(time.perf_counter() - start)
+                    start = time.perf_counter()
+                    engc.send_task(task, socket_path, [], autostart=False)
+                    warm.append(time.perf_counter() - start)
+                engc.send_task({'command': '/shutdown'}, socket_path, [], autostart=False)
+            finally:
+                sys.stdout, sys.stderr = stdout, stderr
+                devnull.close()
+            daemon.wait(timeout=10)
+        finally:
+            if daemon.poll() is None:
+                daemon.kill()
+    finally:
+        server.shutdown()
+        shutil.rmtree(home, ignore_errors=True)
+
+    print(f"{'path':<22} {'median (ms)':>12} {'min (ms)':>10}")
+    for label, values in (("cold eng.py --batch", cold), ("daemon ping", pings), ("daemon chat", warm)):
+        print(f"{label:<22} {statistics.median(values) * 1000:>12.1f} {min(values) * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
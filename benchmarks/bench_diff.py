@@ -0,0 +1,116 @@
+"""Compare display_diff with the previous unified_diff/table implementation.
+
+Files of 10k to 100k lines are diffed when identical, with scattered edits
+and with a block moved to the end. Rendering goes to a string so terminal
+speed does not count.
+
+Usage: python benchmarks/bench_diff.py [--lines 10000 50000 100000] [--repeat 3]
+"""
+import argparse
+import contextlib
+import difflib
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import eng  # noqa: E402
+from rich.console import Console  # noqa: E402
+from rich.table import Table  # noqa: E402
+
+
+def legacy_display_diff(old_content, new_content, file_path):
+    diff = list(difflib.unified_diff(
+        old_content.splitlines(keepends=True),
+        new_content.splitlines(keepends=True),
+        fromfile=f"a/{file_path}",
+        tofile=f"b/{file_path}",
+        lineterm='',
+        n=5
+    ))
+    if not diff:
+        print(f"在 {file_path} 中未檢測到更改")
+        return
+    console = Console()
+    table = Table(title=f"Diff for {file_path}")
+    table.add_column("Status", style="bold")
+    table.add_column("Line")
+    table.add_column("Content")
+    line_number = 1
+    for line in diff:
+        status = line[0]
+        content = line[2:].rstrip()
+        if status == ' ':
+            continue
+        elif status == '-':
+            table.add_row("Removed", str(line_number), content, style="red")
+        elif status == '+':
+            table.add_row("Added", str(line_number), content, style="green")
+        line_number += 1
+    console.print(table)
+
+
+def make_file(lines, seed=0):
+    rnd = random.Random(seed)
+    body = []
+    for i in range(lines):
+        if i % 10 == 0:
+            body.append(f"def function_{i}(value):")
+        elif i % 10 == 9:
+            body.append("")  # Repeated lines give difflib and patience something to disagree on
+        else:
+            body.append(f"    value = value * {rnd.randint(1, 99)} + {i}")
+    return body
+
+
+def variants(lines):
+    original = make_file(lines)
+    edited = list(original)
+    rnd = random.Random(1)
+    for index in rnd.sample(range(lines), lines // 100):
+        edited[index] = edited[index] + "  # changed"
+    block = lines // 10
+    moved = original[block:] + original[:block]
+    text = "\n".join(original) + "\n"
+    return {
+        'identical': (text, "\n".join(original) + "\n"),
+        'edits_1pct': (text, "\n".join(edited) + "\n"),
+        'moved_block': (text, "\n".join(moved) + "\n"),
+    }
+
+
+def timed(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark display_diff on large files")
+    parser.add_argument("--lines", type=int, nargs='*', default=[10000, 50000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip-legacy", action="store_true", help="only time the current implementation")
+    args = parser.parse_args()
+
+    eng.BATCH_MODE = True  # Render the first page only, never prompt
+    print(f"{'lines':>7} {'case':<12} {'legacy (s)':>11} {'current (s)':>12} {'speedup':>8}")
+    for lines in args.lines:
+        for case, (old_content, new_content) in variants(lines).items():
+            current = timed(lambda: eng.display_diff(old_content, new_content, "module.py"), args.repeat)
+            if args.skip_legacy:
+                print(f"{lines:>7} {case:<12} {'-':>11} {current:>12.4f} {'-':>8}")
+                continue
+            legacy = timed(lambda: legacy_display_diff(old_content, new_content, "module.py"), args.repeat)
+            print(f"{lines:>7} {case:<12} {legacy:>11.4f} {current:>12.4f} {legacy / current:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
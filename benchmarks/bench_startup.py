@@ -0,0 +1,125 @@
+"""Measure how long eng.py takes to import and to reach argument parsing.
+
+`python -X importtime -c "import eng"` is run in fresh interpreters. The
+cumulative import time of eng and of its slowest direct imports is reported,
+along with the wall time of `eng.py --help`. The check fails when a heavy
+module is imported at load time, when the import exceeds the budget, or with
+--check when a measurement is slower than its saved baseline.
+
+Usage:
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --save-baseline
+    python benchmarks/bench_startup.py --check --threshold 1.25 --budget-ms 100
+"""
+import argparse
+import json
+import os
+import py_compile
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ENG_DIR = os.path.join(HERE, '..')
+BASELINE_PATH = os.path.join(HERE, 'baselines.json')
+# Modules that must only be imported on first use
+HEAVY_MODULES = ('openai', 'httpx', 'httpcore', 'rich', 'prompt_toolkit', 'tiktoken', 'difflib', 'email.utils', 'asyncio')
+
+
+def import_profile():
+    """Return ({module: cumulative seconds} for the direct imports of eng, eng's own cumulative seconds)."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import eng'],
+        cwd=ENG_DIR, capture_output=True, text=True, check=True,
+    )
+    children = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not cumulative.strip().isdigit():
+            continue  # Header line
+        # A module is printed after its imports, indented two spaces per level
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        seconds = int(cumulative) / 1e6
+        if depth == 0:
+            if name.strip() == 'eng':
+                return children, seconds
+            children = {}
+        elif depth == 1:
+            children[name.strip()] = seconds
+    raise RuntimeError("eng was not imported")
+
+
+def loaded_heavy_modules():
+    code = f"import sys, eng; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, '-c', code], cwd=ENG_DIR, capture_output=True, text=True, check=True)
+    return [name for name in result.stdout.strip().split(',') if name]
+
+
+def help_wall():
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(ENG_DIR, 'eng.py'), '--help'], capture_output=True, check=True)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark eng.py startup")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=8, help="slowest imports to list")
+    parser.add_argument("--budget-ms", type=float, default=100.0, help="fail when importing eng takes longer")
+    parser.add_argument("--save-baseline", action="store_true", help=f"store the results in {BASELINE_PATH}")
+    parser.add_argument("--check", action="store_true", help="fail when startup is slower than its baseline")
+    parser.add_argument("--threshold", type=float, default=1.25, help="allowed slowdown ratio for --check")
+    args = parser.parse_args()
+
+    # Time the import from cached bytecode, as after the first run, even when PYTHONDONTWRITEBYTECODE is set
+    py_compile.compile(os.path.join(ENG_DIR, 'eng.py'), doraise=True)
+    profiles = [import_profile() for _ in range(args.repeat)]
+    import_time = min(total for _, total in profiles)
+    modules = {name: min(profile.get(name, 0.0) for profile, _ in profiles) for name in profiles[0][0]}
+    help_time = min(help_wall() for _ in range(args.repeat))
+    results = {'startup/import_eng': {'wall': import_time}, 'startup/help': {'wall': help_time}}
+
+    print(f"import eng          {import_time * 1000:8.1f}ms")
+    print(f"eng.py --help       {help_time * 1000:8.1f}ms  (includes interpreter start)")
+    print("slowest imports:")
+    for name, seconds in sorted(modules.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"  {name:<30} {seconds * 1000:8.1f}ms")
+
+    failed = []
+    heavy = loaded_heavy_modules()
+    if heavy:
+        print(f"imported at load time: {', '.join(heavy)} (REGRESSION)")
+        failed.append('heavy imports')
+    if import_time * 1000 > args.budget_ms:
+        print(f"import eng exceeds the {args.budget_ms:.0f}ms budget (REGRESSION)")
+        failed.append('budget')
+
+    baselines = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH, 'r', encoding='utf-8') as f:
+            baselines = json.load(f)
+    if args.check:
+        for key, result in results.items():
+            baseline = baselines.get(key)
+            if not baseline:
+                print(f"{key}: no baseline (FAILED, save one with --save-baseline)")
+                failed.append(key)
+                continue
+            ratio = result['wall'] / baseline['wall'] if baseline['wall'] else 1.0
+            status = "REGRESSION" if ratio > args.threshold else "ok"
+            print(f"{key}: {ratio:.2f}x baseline ({status})")
+            if ratio > args.threshold:
+                failed.append(key)
+    if args.save_baseline:
+        baselines.update(results)
+        with open(BASELINE_PATH, 'w', encoding='utf-8') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f"Baselines saved to {BASELINE_PATH}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Compare the shared repository walker with the previous per-file path.
+
+The previous path visited every file and re-read .gitignore for each one.
+Its fnmatch check missed directory patterns such as `out/` and negations,
+so here it decides with the walker's rules instead. That way both sides
+return the same files and only the cost of the walk is compared. The
+script fails if the file sets differ.
+
+Usage: python benchmarks/bench_walker.py [--files 50000] [--repeat 3]
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import eng  # noqa: E402
+from synthetic_repo import make_tree  # noqa: E402
+
+
+def legacy_is_binary_file(file_path):
+    try:
+        with open(file_path, 'rb') as file:
+            chunk = file.read(1024)
+            if b'\0' in chunk:
+                return True
+            text_characters = bytearray({7, 8, 9, 10, 12, 13, 27} | set(range(0x20, 0x100)))
+            non_text = chunk.translate(None, text_characters)
+            if len(non_text) / len(chunk) > 0.30:
+                return True
+    except Exception:
+        return True
+    return False
+
+
+def legacy_is_gitignored(file_path, patterns):
+    """The walker's ignore decision for one file, checking the file and each of its directories."""
+    rules = [rule for rule in map(eng.compile_gitignore_pattern, patterns) if rule]
+    stack = [(os.path.abspath('.'), rules)]
+    abs_path = os.path.abspath(file_path)
+    directory = os.path.dirname(abs_path)
+    while directory.startswith(stack[0][0] + os.sep):
+        if eng.is_gitignored(directory, True, stack):
+            return True
+        directory = os.path.dirname(directory)
+    return eng.is_gitignored(abs_path, False, stack)
+
+
+def legacy_add_file_to_context(file_path, added_files):
+    gitignore_patterns = []
+    if os.path.exists('.gitignore'):
+        gitignore_patterns = eng.load_gitignore_patterns('.')
+    if os.path.isfile(file_path):
+        if eng.is_excluded_path(file_path):
+            return
+        if gitignore_patterns and legacy_is_gitignored(file_path, gitignore_patterns):
+            return
+        if legacy_is_binary_file(file_path):
+            return
+        with open(file_path, 'r', encoding='utf-8', errors='ignore') as file:
+            added_files[file_path] = file.read()
+
+
+def legacy_add_paths(paths, added_files):
+    for path in paths:
+        for root, dirs, files_in_dir in os.walk(path):
+            dirs[:] = [d for d in dirs if d not in {'__pycache__', '.git', 'node_modules'}]  # The rest are checked per file
+            for file in files_in_dir:
+                legacy_add_file_to_context(os.path.join(root, file), added_files)
+
+
+def timed(label, func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{label:<10} {best:8.3f}s  ({len(result)} files)")
+    return best, set(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the repository walker")
+    parser.add_argument("--files", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="stima-walker-")
+    cwd = os.getcwd()
+    try:
+        make_tree(root, args.files)
+        os.chdir(root)
+
+        def legacy():
+            added_files = {}
+            legacy_add_paths(['.'], added_files)
+            return added_files
+
+        def walker():
+            added_files = {}
+            eng.add_paths_to_context(['.'], added_files)
+            return added_files
+
+        legacy_time, legacy_files = timed("legacy", legacy, args.repeat)
+        walker_time, walker_files = timed("walker", walker, args.repeat)
+        print(f"speedup    {legacy_time / walker_time:8.2f}x")
+        if legacy_files != walker_files:
+            print(f"file sets differ: {len(legacy_files - walker_files)} only in legacy, "
+                  f"{len(walker_files - legacy_files)} only in walker")
+            sys.exit(1)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Check that the prompt prefix stays byte-identical across chat turns.
+
+Three chat turns are sent to the local mock server with the same added
+files, once without and once with --prompt-cache. The system message and
+the file block (the file context and its acknowledgement) of every request
+must serialize to the same bytes as in the first turn, otherwise provider
+prompt caching cannot reuse them. Both modes must also carry the same text.
+
+Usage: python benchmarks/check_prompt_prefix.py
+Exits with status 1 when a prefix differs.
+"""
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, HERE)
+
+import eng  # noqa: E402
+from mock_server import MockConfig, start_server  # noqa: E402
+
+TURNS = ["Explain the retry layer", "Which function builds the messages?", "Summarise what we discussed"]
+FILES = {
+    'retry.py': "def retry(func, attempts=3):\n    for _ in range(attempts):\n        try:\n            return func()\n        except OSError:\n            pass\n",
+    'messages.py': "def build(system, files):\n    return [system, files]\n",
+}
+
+
+def prefix_of(messages):
+    """The system message and the file block, serialized as they go on the wire."""
+    prefix = [message for message in messages[:3] if message['role'] == 'system']
+    prefix += messages[len(prefix):len(prefix) + 2]
+    return json.dumps(prefix, ensure_ascii=False, sort_keys=True)
+
+
+def text_of(messages):
+    return [content if isinstance(content, str) else "".join(part['text'] for part in content)
+            for content in (message['content'] for message in messages)]
+
+
+def run_turns(server, prompt_cache):
+    eng.PROMPT_CACHE = prompt_cache
+    eng.reset_session()
+    added_files = dict(FILES)
+    start = len(server.config.requests)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for turn in TURNS:
+            eng.run_chat(turn, added_files)
+    return [body['messages'] for body in server.config.requests[start:]]
+
+
+def main():
+    server, base_url = start_server(MockConfig())
+    workdir = tempfile.mkdtemp(prefix="stima-prefix-")
+    cwd = os.getcwd()
+    eng.client = eng.create_client("mock-key", base_url=base_url)
+    eng.MODEL = "mock-model"
+    eng.CACHE_ENABLED = False
+    eng.STREAM = False
+    eng.AUTO_CONTEXT_K = 0
+    eng.configure_telemetry(None, None)
+    failures = []
+    try:
+        os.chdir(workdir)
+        for file_path, content in FILES.items():
+            with open(file_path, 'w', encoding='utf-8') as f:
+                f.write(content)
+        runs = {mode: run_turns(server, mode) for mode in (False, True)}
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+        server.shutdown()
+
+    for mode, requests in runs.items():
+        label = "--prompt-cache" if mode else "default"
+        if len(requests) != len(TURNS):
+            failures.append(f"{label}: expected {len(TURNS)} requests, got {len(requests)}")
+            continue
+        first = prefix_of(requests[0])
+        for turn, messages in enumerate(requests[1:], start=2):
+            if prefix_of(messages) != first:
+                failures.append(f"{label}: the prefix of turn {turn} differs from turn 1")
+        if len(requests[-1]) != len(requests[0]) + 2 * (len(TURNS) - 1):
+            failures.append(f"{label}: earlier turns were not sent as history")
+        print(f"{label:16} {len(requests)} turns, prefix {len(first.encode('utf-8'))} bytes")
+    if all(len(requests) == len(TURNS) for requests in runs.values()):
+        for turn, (plain, cached) in enumerate(zip(runs[False], runs[True]), start=1):
+            if text_of(plain) != text_of(cached):
+                failures.append(f"turn {turn}: the message text differs with --prompt-cache")
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    if failures:
+        sys.exit(1)
+    print("OK: the system and file-block messages are byte-identical across turns")
+
+
+if __name__ == '__main__':
+    main()
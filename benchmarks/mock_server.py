@@ -0,0 +1,198 @@
+"""A local stand-in for an OpenAI-compatible /v1/chat/completions endpoint.
+
+Answers are derived from the system prompt so /edit, /create, /review and
+/planning flows all receive well-formed responses. Latency, streaming speed
+and injected faults are configurable, which makes the server useful both for
+benchmarks and for exercising the retry layer.
+
+Usage: python benchmarks/mock_server.py --port 8000 --latency 0.2 --fail-rate 0.1
+Then:  python eng.py --base-url http://127.0.0.1:8000/v1
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockConfig:
+    def __init__(self, latency=0.0, ttft=0.0, chunk_delay=0.0, chunk_size=16, fail_rate=0.0, retry_after=1, seed=None,
+                 model_delays=None, failing_models=(), stall_first=0, stall=0.0):
+        self.latency = latency  # Seconds before a non-streaming answer
+        self.ttft = ttft  # Seconds before the first streamed chunk
+        self.chunk_delay = chunk_delay  # Seconds between streamed chunks
+        self.chunk_size = chunk_size  # Characters per streamed chunk
+        self.fail_rate = fail_rate  # Share of requests answered with 429 or 503
+        self.retry_after = retry_after
+        self.model_delays = dict(model_delays or {})  # Model -> extra seconds before answering
+        self.failing_models = set(failing_models)  # Models that always answer 503
+        self.stall_first = stall_first  # The first requests wait stall seconds longer, e.g. to trigger hedging
+        self.stall = stall
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.statuses = []  # Status code of every answer sent
+
+    def should_fail(self):
+        with self.lock:
+            return self.fail_rate and self.random.random() < self.fail_rate
+
+
+def _text(content):
+    if isinstance(content, list):
+        return "".join(part.get('text', '') for part in content)
+    return content or ""
+
+
+def answer_for(messages):
+    """Pick a response in the format the calling command expects."""
+    system = _text(messages[0]['content']) if messages and messages[0]['role'] == 'system' else ""
+    request = _text(messages[-1]['content']) if messages else ""
+    if 'return the edits directly' in system:
+        context = _text(messages[1]['content']) if len(messages) > 2 else ""
+        blocks = []
+        for path in re.findall(r'^- (.+)$', request, re.MULTILINE):
+            match = re.search(r'^File: ' + re.escape(path) + r'\nContent:\n(.*?)\n', context, re.MULTILINE)
+            if match:
+                line = match.group(1)
+                blocks.append(f"File: {path}\n<<<<<<< SEARCH\n{line}\n=======\n{line}  # edited\n>>>>>>> REPLACE\n")
+        return "\n".join(blocks)
+    if 'SEARCH/REPLACE' in system:
+        match = re.search(r'Content:\n(.*?)\n', request)
+        line = match.group(1) if match else ""
+        return f"<<<<<<< SEARCH\n{line}\n=======\n{line}  # edited\n>>>>>>> REPLACE\n"
+    if 'Rewrite an entire file' in system:
+        match = re.search(r'Content:\n(.*)\n\nEdit Instructions:', request, re.DOTALL)
+        return (match.group(1) if match else "") + "\n# edited\n"
+    if 'reviews are stored per file' in system:
+        files = re.findall(r'^- (.+)$', request, re.MULTILINE)
+        return "\n\n".join(f"## File: {path}\n\n- Finding: looks fine." for path in files)
+    if 'provide edit instructions' in system:
+        files = re.findall(r'^- (.+)$', request, re.MULTILINE)
+        return "\n".join(f"File: {path}\nInstructions:\n1. Add a trailing comment.\n" for path in files)
+    if 'create files and folders' in system:
+        return "```\n### FOLDER: mock_app\n```\n\n```python\n### FILE: mock_app/main.py\nprint('hello')\n```\n"
+    return "# Mock answer\n\n" + "\n".join(f"- Finding {i}: looks fine." for i in range(20))
+
+
+def make_handler(config):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, status, payload, headers=None):
+            data = json.dumps(payload).encode('utf-8')
+            with config.lock:
+                config.statuses.append(status)
+            try:
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True  # The client aborted the request
+
+        def do_POST(self):
+            if not self.path.endswith('/chat/completions'):
+                self._send_json(404, {'error': {'message': 'not found'}})
+                return
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            with config.lock:
+                config.requests.append(body)
+                stalled = len(config.requests) <= config.stall_first
+            if stalled:
+                time.sleep(config.stall)
+            if body.get('model') in config.failing_models:
+                self._send_json(503, {'error': {'message': 'model unavailable'}})
+                return
+            time.sleep(config.model_delays.get(body.get('model'), 0.0))
+            if config.should_fail():
+                if config.random.random() < 0.5:
+                    self._send_json(429, {'error': {'message': 'rate limited'}}, {'Retry-After': str(config.retry_after)})
+                else:
+                    self._send_json(503, {'error': {'message': 'unavailable'}})
+                return
+
+            text = answer_for(body.get('messages', []))
+            usage = {'prompt_tokens': len(json.dumps(body)) // 4, 'completion_tokens': len(text) // 4}
+            usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+            if body.get('stream'):
+                self._stream(body, text, usage)
+                return
+            time.sleep(config.latency)
+            self._send_json(200, {
+                'id': 'mock', 'object': 'chat.completion', 'created': int(time.time()), 'model': body.get('model'),
+                'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': text}}],
+                'usage': usage,
+            })
+
+        def _stream(self, body, text, usage):
+            with config.lock:
+                config.statuses.append(200)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            time.sleep(config.ttft)
+
+            def event(payload):
+                self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode('utf-8'))
+                self.wfile.flush()
+
+            base = {'id': 'mock', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': body.get('model')}
+            for i in range(0, len(text), config.chunk_size):
+                event(dict(base, choices=[{'index': 0, 'delta': {'content': text[i:i + config.chunk_size]}, 'finish_reason': None}]))
+                if config.chunk_delay:
+                    time.sleep(config.chunk_delay)
+            if (body.get('stream_options') or {}).get('include_usage'):
+                event(dict(base, choices=[], usage=usage))
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+            self.close_connection = True
+
+    return Handler
+
+
+def start_server(config=None, host='127.0.0.1', port=0):
+    """Start the server in a background thread and return (server, base_url)."""
+    config = config or MockConfig()
+    server = ThreadingHTTPServer((host, port), make_handler(config))
+    server.daemon_threads = True
+    server.config = config
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_port}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible chat completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--ttft", type=float, default=0.0)
+    parser.add_argument("--chunk-delay", type=float, default=0.0)
+    parser.add_argument("--chunk-size", type=int, default=16)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=1)
+    parser.add_argument("--model-delay", action="append", default=[], metavar="MODEL=SECONDS", help="extra latency for one model")
+    parser.add_argument("--failing-model", action="append", default=[], metavar="MODEL", help="model that always answers 503")
+    args = parser.parse_args()
+    delays = {model: float(seconds) for model, _, seconds in (spec.partition('=') for spec in args.model_delay)}
+    config = MockConfig(args.latency, args.ttft, args.chunk_delay, args.chunk_size, args.fail_rate, args.retry_after,
+                        model_delays=delays, failing_models=args.failing_model)
+    server, base_url = start_server(config, args.host, args.port)
+    print(f"Mock server listening on {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+"""Measure the local overhead eng.py adds around the model.
+
+Every scenario runs against a synthetic repository and, where a model is
+involved, against the local mock server, so the numbers only reflect local
+work. Wall time, CPU time and peak traced memory are reported per scenario.
+
+Usage:
+    python benchmarks/run_benchmarks.py --size medium
+    python benchmarks/run_benchmarks.py --size medium --save-baseline
+    python benchmarks/run_benchmarks.py --size medium --check --threshold 1.25
+"""
+import argparse
+import contextlib
+import gc
+import io
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, HERE)
+
+import eng  # noqa: E402
+import synthetic_repo  # noqa: E402
+from mock_server import MockConfig, start_server  # noqa: E402
+
+BASELINE_PATH = os.path.join(HERE, 'baselines.json')
+SCENARIOS = {}
+
+
+def scenario(func):
+    """Register a scenario. It receives the environment and returns the callable to measure."""
+    SCENARIOS[func.__name__] = func
+    return func
+
+
+@scenario
+def context_assembly(env):
+    added_files = dict(list(env['files'].items())[:env['scale'] * 20])
+    history = [f"question {i} " * 50 if i % 2 == 0 else f"answer {i} " * 200 for i in range(20)]
+
+    def run():
+        eng._token_counts.clear()
+        files, kept_history, _ = eng.build_context("Refactor the helpers", added_files, history, fixed_text=eng.PLANNING_PROMPT)
+        eng.build_messages("Refactor the helpers", system_prompt=eng.PLANNING_PROMPT, files=files, history=kept_history)
+    return run
+
+
+@scenario
+def walker(env):
+    def run():
+        eng.add_paths_to_context(['.'], {})
+    return run
+
+
+@scenario
+def parse_edit_instructions(env):
+    response = synthetic_repo.edit_instructions_response(list(env['files'])[:env['scale'] * 100])
+
+    def run():
+        eng.parse_edit_instructions(response)
+    return run
+
+
+@scenario
+def creation_parsing(env):
+    response = synthetic_repo.creation_response(env['scale'] * 20)
+    target = os.path.join(env['root'], 'creation')
+
+    def run():
+        os.makedirs(target, exist_ok=True)
+        cwd = os.getcwd()
+        os.chdir(target)
+        try:
+            eng.apply_creation_steps(response, {})
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(target, ignore_errors=True)
+    return run
+
+
+@scenario
+def creation_stream_parser(env):
+    response = synthetic_repo.creation_response(env['scale'] * 20)
+    chunks = [response[i:i + 16] for i in range(0, len(response), 16)]  # Roughly token-sized deltas
+
+    def run():
+        parser = eng.CreationStreamParser()
+        for chunk in chunks:
+            parser.feed(chunk)
+        parser.close()
+    return run
+
+
+@scenario
+def display_diff(env):
+    old_content = "".join(synthetic_repo.python_module(0, functions=env['scale'] * 100))
+    new_content = synthetic_repo.modified_copy(old_content)
+
+    def run():
+        eng.display_diff(old_content, new_content, "module.py")
+    return run
+
+
+@scenario
+def review_changed(env):
+    """Repeat /review --changed after two files changed; the rest come from the review store."""
+    eng.REVIEW_STORE_PATH = os.path.join(env['root'], 'review_store.sqlite3')
+    eng._review_store_connection = None
+    paths = [path for path in env['files'] if path.endswith('.py')][:env['scale'] * 50]
+    with contextlib.redirect_stdout(io.StringIO()):
+        eng.run_review(paths, changed_only=True)  # Fill the store
+    runs = iter(range(1, sys.maxsize))
+
+    def run():
+        number = next(runs)
+        for path in paths[:2]:
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write(f"# change {number}\n")
+        eng.run_review(paths, changed_only=True)
+    return run
+
+
+@contextlib.contextmanager
+def patched(**settings):
+    """Set eng globals for one run and restore them afterwards."""
+    saved = {name: getattr(eng, name) for name in settings}
+    for name, value in settings.items():
+        setattr(eng, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(eng, name, value)
+
+
+@scenario
+def retry_path(env):
+    """Calls against a server failing 30% of requests with 429 (Retry-After) or 503, through the token bucket."""
+    config = MockConfig(fail_rate=0.3, retry_after=0.02, seed=7)
+    server, base_url = start_server(config)
+    client = eng.create_client("mock-key", base_url=base_url)
+    messages = [{"role": "user", "content": "Explain the retry layer"}]
+    calls = 20
+
+    def run():
+        start = len(config.statuses)
+        started = time.perf_counter()
+        with patched(client=client, MAX_RETRIES=10, RETRY_BASE_DELAY=0.01, HEDGE_AFTER=None):
+            eng.rate_limiter.configure(6000)  # 100 requests per second, so the bucket is exercised
+            logging.disable(logging.WARNING)  # One warning per retry
+            try:
+                results = [eng.call_api(model="mock-model", messages=messages, max_tokens=100) for _ in range(calls)]
+            finally:
+                logging.disable(logging.NOTSET)
+                eng.rate_limiter.configure(eng.RATE_LIMIT_RPM)
+        elapsed = time.perf_counter() - started
+        statuses = config.statuses[start:]
+        assert all(response.choices[0].message.content for response, _ in results), "a call returned no answer"
+        assert statuses.count(200) == calls, f"{statuses.count(200)} answers for {calls} calls"
+        assert sum(retries for _, retries in results) == len(statuses) - calls, "retries do not match the failed requests"
+        assert 429 in statuses and 503 in statuses, "the server injected no failures"
+        assert elapsed >= config.retry_after * statuses.count(429), "Retry-After was not honoured"
+    return run
+
+
+@scenario
+def hedged_call(env):
+    """A stalled request is hedged after 50 ms; the stalled one is aborted and not retried."""
+    stall = 2.0
+    config = MockConfig(stall=stall)
+    server, base_url = start_server(config)
+    client = eng.create_client("mock-key", base_url=base_url)
+    messages = [{"role": "user", "content": "Explain the retry layer"}]
+
+    def run():
+        config.stall_first = len(config.requests) + 1  # Stall the next request only
+        start = len(config.requests)
+        started = time.perf_counter()
+        with patched(client=client, HEDGE_AFTER=0.05):
+            response, _ = eng.call_api(model="mock-model", messages=messages, max_tokens=100)
+        elapsed = time.perf_counter() - started
+        time.sleep(0.1)  # A retried loser would show up as a third request
+        assert response.choices[0].message.content, "the hedged call returned no answer"
+        assert elapsed < stall / 2, f"the hedged call took {elapsed:.2f}s"
+        assert len(config.requests) - start == 2, f"{len(config.requests) - start} requests sent, expected 2"
+    return run
+
+
+def edit_roundtrip_with(mode):
+    def setup(env):
+        paths = [path for path in env['files'] if path.endswith('.py')][:env['scale'] * 2]
+
+        def run():
+            eng.EDIT_MODE = mode
+            added_files = {}
+            eng.add_paths_to_context(paths, added_files)
+            eng.run_edit("Add a trailing comment to every file", added_files)
+        return run
+    return setup
+
+
+SCENARIOS['edit_roundtrip'] = edit_roundtrip_with('two-pass')
+SCENARIOS['edit_pipelined'] = edit_roundtrip_with('pipelined')
+SCENARIOS['edit_single_pass'] = edit_roundtrip_with('single')
+
+
+def measure(run, repeat):
+    with contextlib.redirect_stdout(io.StringIO()):
+        run()  # Warm up first-use work (lazy imports, clients, caches) so it is not timed
+    walls, cpus = [], []
+    for _ in range(repeat):
+        gc.collect()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            run()
+        walls.append(time.perf_counter() - wall_start)
+        cpus.append(time.process_time() - cpu_start)
+    # Memory is traced in a separate pass so tracing does not inflate the timings
+    gc.collect()
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'wall': min(walls), 'cpu': min(cpus), 'peak_kb': peak / 1024}
+
+
+def load_baselines():
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark local overhead of eng.py")
+    parser.add_argument("--size", choices=sorted(synthetic_repo.SIZES), default='small')
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", nargs='*', choices=sorted(SCENARIOS), help="run only these scenarios")
+    parser.add_argument("--latency", type=float, default=0.0, help="mock server latency per request in seconds")
+    parser.add_argument("--save-baseline", action="store_true", help=f"store the results in {BASELINE_PATH}")
+    parser.add_argument("--check", action="store_true", help="fail when a scenario is slower than its baseline")
+    parser.add_argument("--threshold", type=float, default=1.25, help="allowed slowdown ratio for --check")
+    parser.add_argument("--min-delta", type=float, default=0.005, help="slowdowns below this many seconds are noise for --check")
+    args = parser.parse_args()
+
+    server, base_url = start_server(MockConfig(latency=args.latency))
+    eng.client = eng.create_client("mock-key", base_url=base_url)
+    eng.MODEL = "mock-model"
+    eng.CACHE_ENABLED = False
+    eng.STREAM = False
+    eng.BATCH_MODE = True
+    eng.AUTO_APPROVE = True
+
+    root = tempfile.mkdtemp(prefix="stima-bench-")
+    cwd = os.getcwd()
+    results = {}
+    try:
+        synthetic_repo.make_tree(root, synthetic_repo.SIZES[args.size])
+        os.chdir(root)
+        files = {}
+        with contextlib.redirect_stdout(io.StringIO()):
+            eng.add_paths_to_context(['.'], files)
+        env = {'root': root, 'files': files, 'scale': max(1, synthetic_repo.SIZES[args.size] // 200)}
+
+        print(f"{'scenario':<26} {'wall (s)':>10} {'cpu (s)':>10} {'peak (KB)':>12}")
+        for name in args.only or SCENARIOS:
+            result = measure(SCENARIOS[name](env), args.repeat)
+            results[f"{args.size}/{name}"] = result
+            print(f"{name:<26} {result['wall']:>10.4f} {result['cpu']:>10.4f} {result['peak_kb']:>12.1f}")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root, ignore_errors=True)
+        server.shutdown()
+
+    baselines = load_baselines()
+    failed = []
+    if args.check:
+        for key, result in results.items():
+            baseline = baselines.get(key)
+            if not baseline:
+                print(f"{key}: no baseline (FAILED, save one with --save-baseline)")
+                failed.append(key)
+                continue
+            ratio = result['wall'] / baseline['wall'] if baseline['wall'] else 1.0
+            regressed = ratio > args.threshold and result['wall'] - baseline['wall'] > args.min_delta
+            print(f"{key}: {ratio:.2f}x baseline ({'REGRESSION' if regressed else 'ok'})")
+            if regressed:
+                failed.append(key)
+    if args.save_baseline:
+        baselines.update(results)
+        with open(BASELINE_PATH, 'w', encoding='utf-8') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f"Baselines saved to {BASELINE_PATH}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Generate synthetic repositories for the benchmarks."""
+import os
+import random
+
+SIZES = {
+    'small': 200,
+    'medium': 2000,
+    'large': 20000,
+}
+
+
+def python_module(index, functions=10):
+    lines = [f'"""Synthetic module {index}."""', "import os", ""]
+    for i in range(functions):
+        lines += [
+            f"def function_{index}_{i}(value):",
+            f'    """Return value scaled by {i}."""',
+            f"    total = value * {i}",
+            "    for step in range(3):",
+            "        total += step",
+            "    return total",
+            "",
+        ]
+    return "\n".join(lines) + "\n"
+
+
+def make_tree(root, file_count, seed=0):
+    """Create a repository with nested packages, gitignored output, logs and binaries."""
+    rng = random.Random(seed)
+    with open(os.path.join(root, '.gitignore'), 'w') as f:
+        f.write("*.log\nout/\n!important.log\n")
+    per_dir = 50
+    for i in range(file_count):
+        package = os.path.join(root, 'src', f'pkg{i // (per_dir * 20)}', f'mod{(i // per_dir) % 20}')
+        os.makedirs(package, exist_ok=True)
+        if i % 100 == 0:
+            with open(os.path.join(package, f'blob{i}.bin'), 'wb') as f:
+                f.write(bytes(rng.getrandbits(8) for _ in range(2048)))
+        elif i % 25 == 0:
+            with open(os.path.join(package, f'run{i}.log'), 'w') as f:
+                f.write("log line\n" * 20)
+        else:
+            with open(os.path.join(package, f'file{i}.py'), 'w') as f:
+                f.write(python_module(i))
+    for i in range(file_count // 10):
+        out = os.path.join(root, 'out', f'chunk{i // 100}')
+        os.makedirs(out, exist_ok=True)
+        with open(os.path.join(out, f'gen{i}.js'), 'w') as f:
+            f.write("console.log('generated');\n" * 10)
+
+
+def edit_instructions_response(file_paths, steps=5):
+    """Build an EDIT_INSTRUCTION_PROMPT style response for the given files."""
+    parts = []
+    for file_path in file_paths:
+        parts.append(f"File: {file_path}")
+        parts.append("Instructions:")
+        parts.extend(f"{i}. Rename function_{i} and update every caller accordingly." for i in range(1, steps + 1))
+        parts.append("")
+    return "\n".join(parts)
+
+
+def creation_response(file_count, lines_per_file=40):
+    """Build a CREATE_SYSTEM_PROMPT style response with folders and files."""
+    blocks = ["```\n### FOLDER: generated\n```"]
+    for i in range(file_count):
+        body = "\n".join(f"print('line {j} of file {i}')" for j in range(lines_per_file))
+        blocks.append(f"```python\n### FILE: generated/pkg{i % 10}/module{i}.py\n{body}\n```")
+    return "\n\n".join(blocks)
+
+
+def modified_copy(content, every=50):
+    """Change every n-th line so diffs have scattered hunks."""
+    lines = content.splitlines(keepends=True)
+    for i in range(0, len(lines), every):
+        lines[i] = lines[i].rstrip("\n") + "  # changed\n"
+    return "".join(lines)
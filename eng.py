@@ -1,19 +1,31 @@
 import os
-import fnmatch
+import sys
 import logging
 import time
-from openai import OpenAI
+import random
 from termcolor import colored
-from prompt_toolkit import prompt
-from prompt_toolkit.styles import Style
-from prompt_toolkit.completion import WordCompleter
-from rich import print as rprint
-from rich.markdown import Markdown
-from rich.console import Console
-from rich.table import Table
-import difflib
 import re
+import shutil
+import tempfile
 import argparse
+import bisect
+import hashlib
+import heapq
+import json
+import math
+import sqlite3
+import struct
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from functools import lru_cache, wraps
+from itertools import compress, islice
+from contextlib import contextmanager, nullcontext
+
+# openai, httpx, rich, prompt_toolkit, tiktoken and the rarely used standard
+# modules are imported where they are first needed, so `--help`, the banner and
+# commands that never call the model or draw a table start quickly.
+# benchmarks/bench_startup.py tracks the import time.
 
 CREATE_SYSTEM_PROMPT = """You are an advanced Software engineer designed to create files and folders based on user instructions. Your primary objective is to generate the content of the files to be created as code blocks. Each code block should specify whether it's a file or folder, along with its path.
 
@@ -87,6 +99,39 @@ Format your review as follows:
 Your review should be detailed but concise, focusing on the most important aspects of the code."""
 
 
+REVIEW_MERGE_PROMPT = """You are an expert code reviewer. You are given reviews of separate batches of files from one codebase. Merge them into a single code review.
+
+Format the merged review as follows:
+1. Start with a brief overview of all files
+2. For each file, provide:
+   - A summary of the file's purpose
+   - Key findings (both positive and negative)
+   - Specific recommendations
+3. End with any overall suggestions for the codebase, including patterns that recur across batches
+
+Keep every file-level finding, remove duplicates, and keep the review concise."""
+
+
+FILE_REVIEW_PROMPT = """You are an expert code reviewer. Your task is to review each of the provided code files on its own. For each file, consider:
+
+1. Code Quality: Assess readability, maintainability, and adherence to best practices
+2. Potential Issues: Identify bugs, security vulnerabilities, or performance concerns
+3. Suggestions: Provide specific recommendations for improvements
+
+Start the review of every file with a line of the form:
+
+## File: [file_path]
+
+and follow it with:
+- A summary of the file's purpose
+- Key findings (both positive and negative)
+- Specific recommendations
+
+Review every listed file and write its path exactly as given. Do not add an overview or overall suggestions: the reviews are stored per file and combined later.
+
+Your review should be detailed but concise, focusing on the most important aspects of the code."""
+
+
 EDIT_INSTRUCTION_PROMPT = """You are an advanced Software engineer designed to analyze files and provide edit instructions based on user requests. Your task is to:
 
 1. Understand the User Request: Carefully interpret what the user wants to achieve with the modification.
@@ -133,51 +178,435 @@ NEVER ADD ANY CODE BLOCK MARKER AT THE BEGINNING OF THE FILE OR AT THE END OF TH
 """
 
 
+APPLY_DIFF_EDITS_PROMPT = """
+Apply edit instructions provided by another AI to a file by returning SEARCH/REPLACE blocks instead of rewriting the whole file.
+
+# Format
+
+<<<<<<< SEARCH
+[exact lines copied from the original file]
+=======
+[lines that replace them]
+>>>>>>> REPLACE
+
+# Rules
+
+1. The SEARCH section must copy the existing lines exactly, including indentation and comments.
+2. Include just enough surrounding lines for the SEARCH section to match a single place in the file.
+3. Keep blocks small and list them in the order they appear in the file. Use several blocks for several changes.
+4. To delete code, leave the REPLACE section empty. To insert code, put the neighbouring line in SEARCH and repeat it in REPLACE together with the new lines.
+5. Do not include any explanations, additional text, or code block markers (such as ```python or ```). Only output the blocks.
+
+"""
+
+
+SESSION_SUMMARY_PROMPT = """Summarize the earlier part of a conversation between a user and a software engineering assistant. Keep the user's goals and requirements, decisions that were made, file names, relevant code details and open questions, so the conversation can continue from the summary alone. Be concise."""
+
+SESSION_SUMMARY_ACK = "Understood. I will continue from this summary."
+
+SINGLE_PASS_EDIT_PROMPT = """You are an advanced Software engineer. Apply the user's request to the provided files and return the edits directly as SEARCH/REPLACE blocks, grouped by file.
+
+# Format
+
+File: path/to/file
+<<<<<<< SEARCH
+[exact lines copied from the original file]
+=======
+[lines that replace them]
+>>>>>>> REPLACE
+
+# Rules
+
+1. Start every file with a "File: " line naming its path exactly as given, followed by all blocks for that file.
+2. The SEARCH section must copy the existing lines exactly, including indentation and comments.
+3. Include just enough surrounding lines for the SEARCH section to match a single place in the file.
+4. Keep blocks small and list them in the order they appear in the file. Use several blocks for several changes.
+5. To delete code, leave the REPLACE section empty. To insert code, put the neighbouring line in SEARCH and repeat it in REPLACE together with the new lines.
+6. Only include files that need changes. Do not include any explanations, additional text, or code block markers (such as ```python or ```).
+"""
+
 PLANNING_PROMPT = """You are an AI planning assistant. Your task is to create a detailed plan based on the user's request. Consider all aspects of the task, break it down into steps, and provide a comprehensive strategy for accomplishment. Your plan should be clear, actionable, and thorough."""
 
 
 last_ai_response = None
-conversation_history = []
+last_response_timing = None
+last_usage = None
+STREAM = True
+PROMPT_STYLE = {'prompt': 'cyan'}  # prompt_toolkit style rules, turned into a Style by ask()
+AUTO_APPROVE = False  # Answer "yes" to every confirmation
+BATCH_MODE = False  # Non-interactive: no history, no prompts, no live rendering
+PROMPT_CACHE = False  # Add cache_control breakpoints on the stable prefix
+FILE_CONTEXT_ACK = "I have read the added files and will use them as context."
+OUTLINE_MARKER = "[outline: bodies elided]"
+OUTLINE_NOTE = (f"Files whose content starts with {OUTLINE_MARKER} only show imports, signatures and docstrings. "
+                "If you need the full source of a function or class from one of them, reply only with lines of the form "
+                "EXPAND: <path>::<name> (for example EXPAND: app/models.py::User.save) and the source will be sent to you.")
+OUTLINE_EXPAND_ROUNDS = 2  # Follow-up calls answering EXPAND requests per chat message
+OUTLINE_MAX_ASSIGN_LINES = 3  # Longer module and class level assignments keep only their target
+EXPAND_REQUEST = re.compile(r'^\W*EXPAND:\s*(.+?)::([\w.$]+)\W*$', re.MULTILINE)
+OUTLINE_IMPORT = re.compile(r'^\s*(?:import|from|using|use|require|include|#include|package|extern crate)\b|^\s*(?:const|let|var)\s+\w+\s*=\s*require\(')
+OUTLINE_DEFINITION = re.compile(
+    r'^\s*(?:(?:export|default|public|private|protected|internal|static|abstract|final|async|pub(?:\([^)]*\))?|unsafe|extern|inline|virtual|override|open|sealed|data)\s+)*'
+    r'(?:class|interface|struct|enum|trait|impl|union|object|module|namespace|protocol|extension|type|fn|func|fun|function|def|sub)\b'
+    r'|^\s*(?:export\s+)?(?:const|let|var)\s+\w+\s*=\s*(?:async\s+)?(?:function\b|\([^)]*\)\s*=>|\w+\s*=>)'
+)
+# C-like functions and methods: a signature with parameters that opens a block
+OUTLINE_BLOCK_DEFINITION = re.compile(r'^\s*+(?!(?:if|for|while|switch|catch|else|do|try|return|with)\b)[\w<>\[\]*&:,. ]+\([^;]*\)[^;]*\{\s*$')
+MAX_WORKERS = 4
+EDIT_FORMAT = 'diff'
+EDIT_MODE = 'two-pass'  # two-pass, pipelined, single or auto
+SINGLE_PASS_MAX_TOKENS = 8000  # auto uses single-pass up to this many file tokens
+MAX_OUTPUT_TOKENS = 60000
+CONTEXT_BUDGET = None  # Input token budget, defaults to the model's context window minus MAX_OUTPUT_TOKENS
+REVIEW_BATCH_TOKENS = 60000  # File tokens per /review batch
+DIFF_CONTEXT_LINES = 3  # Unchanged lines shown around each change
+DIFF_MAX_ROWS = 200  # Diff rows rendered per page
+DIFF_QUADRATIC_LIMIT = 4000000  # Largest len(a) * len(b) handed to difflib when patience finds no anchors
 
-def is_binary_file(file_path):
-    """Check if a file is binary by reading a small portion of it."""
+# Context window sizes by model name prefix, longest prefix wins
+MODEL_CONTEXT_WINDOWS = {
+    'claude': 200000,
+    'gpt-4o': 128000,
+    'gpt-4-turbo': 128000,
+    'gpt-4': 8192,
+    'gpt-3.5-turbo': 16385,
+    'o1': 128000,
+    'gemini': 1000000,
+}
+DEFAULT_CONTEXT_WINDOW = 128000
+
+# Model routing: each call type is sent to the models of its tier, in order, falling back down the list
+MODEL_TIERS = {}  # Tier name -> [model, fallback, ...]; unrouted call types use [MODEL]
+MODEL_ROUTES = {}  # Call type -> tier name
+ROUTE_TYPES = ('instructions', 'rewrite', 'review', 'plan', 'create', 'chat')
+ROUTE_ALIASES = {'single_pass': 'rewrite', 'review_merge': 'review', 'summary': 'chat'}  # Follow these routes unless routed themselves
+ROUTE_TIMEOUT = None  # Seconds before a model that has a fallback is given up on as too slow
+ROUTE_COOLDOWN = 60.0  # Seconds a model that failed or was too slow is tried after the others
+ROUTE_RACE = False  # Send calls that are not streamed to the first two models of their tier at once
+# List prices in USD per million input and output tokens, matched by the longest model name prefix
+MODEL_PRICES = {
+    'claude-3-5-sonnet': (3.0, 15.0),
+    'claude-3-5-haiku': (0.8, 4.0),
+    'claude-3-opus': (15.0, 75.0),
+    'claude-3-sonnet': (3.0, 15.0),
+    'claude-3-haiku': (0.25, 1.25),
+    'gpt-4o-mini': (0.15, 0.6),
+    'gpt-4o': (2.5, 10.0),
+    'gpt-4-turbo': (10.0, 30.0),
+    'gpt-3.5-turbo': (0.5, 1.5),
+    'o1-mini': (3.0, 12.0),
+    'o1': (15.0, 60.0),
+    'gemini-1.5-flash': (0.075, 0.3),
+    'gemini-1.5-pro': (1.25, 5.0),
+}
+
+# API client settings
+API_BASE_URL = "https://api.stima.tech/v1"
+REQUEST_TIMEOUT = 600.0  # Seconds per attempt
+MAX_RETRIES = 5
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+RATE_LIMIT_RPM = None  # Requests per minute shared by all calls, None for no limit
+HEDGE_AFTER = None  # Seconds before a duplicate request is sent for non-streaming calls
+
+# Local state such as the response cache lives here
+STATE_DIR = os.path.join(os.path.expanduser('~'), '.stima_engineer')
+CACHE_ENABLED = False  # Replay identical requests from the local response cache (--cache)
+CACHE_PATH = os.path.join(STATE_DIR, 'response_cache.sqlite3')
+CACHE_TTL = 7 * 24 * 3600  # Seconds before a cached response expires
+CACHE_MAX_BYTES = 200 * 1024 * 1024
+TELEMETRY_PATH = os.path.join(STATE_DIR, 'telemetry.jsonl')
+PROMETHEUS_TEXTFILE = None
+PROMETHEUS_INTERVAL = 1.0  # Seconds between rewrites of the Prometheus textfile; commands flush it when they end
+DAEMON_SOCKET = os.path.join(STATE_DIR, 'daemon.sock')
+SESSION_DIR = os.path.join(STATE_DIR, 'sessions')
+SNAPSHOT_DIR = os.path.join(STATE_DIR, 'snapshots')  # File contents stored once by digest
+SESSION_NAME = None  # Persist the conversation under this name
+SESSION_MAX_TURNS = 10  # Compact the history beyond this many exchanges
+SESSION_MAX_TOKENS = 30000  # ... or beyond this many history tokens
+SESSION_KEEP_TURNS = 4  # Most recent exchanges kept verbatim by compaction
+PATH_INDEX_REFRESH = 30.0  # Seconds before the completion index is rebuilt in the background
+PATH_MATCH_CANDIDATES = 200  # Matches collected before ranking completions
+PATH_SEARCH_BUDGET = 0.008  # Seconds spent collecting fuzzy matches per completion
+PATH_SEARCH_CHUNK = 4096  # Index lines searched between budget checks
+PATH_COMMANDS = {'/add', '/edit', '/review'}
+WATCH_FILES = True  # Keep added files in sync with the disk in the interactive session
+DELTA_MAX_RATIO = 0.5  # A changed file is sent in full once its diff exceeds this share of its tokens
+RETRIEVAL_INDEX_PATH = os.path.join(STATE_DIR, 'retrieval_index.sqlite3')
+REVIEW_STORE_PATH = os.path.join(STATE_DIR, 'review_store.sqlite3')  # Per-file reviews for /review --changed
+RETRIEVAL_MAX_FILE_BYTES = 1024 * 1024  # Larger files are listed but not indexed
+AUTO_CONTEXT_K = 0  # Relevant files added to each chat and /edit request, 0 to disable
+BM25_K1 = 1.2
+BM25_B = 0.75
+SYMBOL_BOOST = 2.0  # Extra weight when a query term names a definition in the file
+PATH_BOOST = 1.5  # Extra weight when a query term appears in the file path
+
+# Per-call telemetry: kept in memory for /stats and appended to a rotating JSONL file
+telemetry_records = []
+_telemetry_lock = threading.Lock()
+telemetry_logger = logging.getLogger('stima.telemetry')
+telemetry_logger.propagate = False
+_prometheus_lock = threading.Lock()
+_prometheus_pending = False  # Records arrived since the textfile was last written
+_prometheus_written = 0.0
+
+def configure_telemetry(path=None, prometheus_textfile=None):
+    """Send telemetry records to a rotating JSONL file and optionally a Prometheus textfile."""
+    global PROMETHEUS_TEXTFILE
+    if prometheus_textfile and not PROMETHEUS_TEXTFILE:
+        import atexit
+        atexit.register(flush_prometheus_textfile)
+    PROMETHEUS_TEXTFILE = prometheus_textfile
+    for handler in list(telemetry_logger.handlers):
+        telemetry_logger.removeHandler(handler)
+        handler.close()
+    if path:
+        from logging.handlers import RotatingFileHandler
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        handler = RotatingFileHandler(path, maxBytes=5 * 1024 * 1024, backupCount=3, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        telemetry_logger.addHandler(handler)
+        telemetry_logger.setLevel(logging.INFO)
+
+def record_telemetry(record):
+    global _prometheus_pending
+    record.setdefault('timestamp', time.time())
+    with _telemetry_lock:
+        telemetry_records.append(record)
+    if telemetry_logger.handlers:
+        telemetry_logger.info(json.dumps(record, ensure_ascii=False))
+    if PROMETHEUS_TEXTFILE:
+        _prometheus_pending = True
+        flush_prometheus_textfile(throttle=True)
+
+def flush_prometheus_textfile(throttle=False):
+    """Rewrite the Prometheus textfile if records arrived since the last write.
+
+    With throttle, it is rewritten at most once every PROMETHEUS_INTERVAL
+    seconds, since each rewrite summarises every record of the session.
+    """
+    global _prometheus_pending, _prometheus_written
+    if not PROMETHEUS_TEXTFILE:
+        return
+    with _prometheus_lock:
+        if not _prometheus_pending or throttle and time.monotonic() - _prometheus_written < PROMETHEUS_INTERVAL:
+            return
+        _prometheus_pending = False
+        _prometheus_written = time.monotonic()
+        try:
+            write_prometheus_textfile(PROMETHEUS_TEXTFILE)
+        except OSError as e:
+            logging.warning(f"無法寫入 Prometheus 指標檔案: {e}")
+
+def model_cost(model, prompt_tokens, completion_tokens):
+    """Estimated cost in USD at MODEL_PRICES list prices, or None for a model without a price."""
+    matches = [prefix for prefix in MODEL_PRICES if model.lower().startswith(prefix)]
+    if not matches:
+        return None
+    input_price, output_price = MODEL_PRICES[max(matches, key=len)]
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1e6
+
+def record_model_call(call_type, model, usage, ttft, latency, retries, cached=False, error=None, tier=None, fallback=False, discarded=False):
+    """Record one model call. fallback marks an answer from a later model of the tier, discarded a raced answer that lost."""
+    usage = usage or {}
+    prompt_tokens, completion_tokens = usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0)
+    record_telemetry({
+        'type': 'model_call',
+        'call_type': call_type,
+        'model': model,
+        'tier': tier or 'default',
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'cached_tokens': usage.get('cached_tokens', 0),
+        'cost': model_cost(model, prompt_tokens, completion_tokens) if not cached else 0.0,
+        'ttft': ttft,
+        'latency': latency,
+        'retries': retries,
+        'cached': cached,
+        'error': error,
+        'fallback': fallback,
+        'discarded': discarded,
+    })
+
+@contextmanager
+def phase_timer(phase):
+    """Time a local phase such as the file walk, the context build or the diff render."""
+    start_time = time.perf_counter()
     try:
-        with open(file_path, 'rb') as file:
-            chunk = file.read(1024)  # Read the first 1024 bytes
-            if b'\0' in chunk:
-                return True  # File is binary if it contains null bytes
-            # Use a heuristic to detect binary content
-            text_characters = bytearray({7,8,9,10,12,13,27} | set(range(0x20, 0x100)))
-            non_text = chunk.translate(None, text_characters)
-            if len(non_text) / len(chunk) > 0.30:
-                return True  # Consider binary if more than 30% non-text characters
-    except Exception as e:
-        logging.error(f"錯誤讀取檔案 {file_path}: {e}")
-        return True  # Assume binary if an error occurs
-    return False  # File is likely text
+        yield
+    finally:
+        record_telemetry({'type': 'phase', 'phase': phase, 'duration': time.perf_counter() - start_time})
 
+def timed_phase(phase):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase_timer(phase):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
 
-# Load .gitignore patterns if in a git repository
-def load_gitignore_patterns(directory):
-    gitignore_path = os.path.join(directory, '.gitignore')
-    patterns = []
-    if os.path.exists(gitignore_path):
-        with open(gitignore_path, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if line and not line.startswith('#'):
-                    patterns.append(line)
-    return patterns
+def percentile(values, q):
+    """Nearest-rank percentile of values for q between 0 and 100."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
 
-def should_ignore(file_path, patterns):
-    for pattern in patterns:
-        if fnmatch.fnmatch(file_path, pattern):
-            return True
-    return False
+def summarize_telemetry(records=None):
+    """Group model calls by call type and phases by name."""
+    with _telemetry_lock:
+        records = list(records if records is not None else telemetry_records)
+    calls, phases = {}, {}
+    for record in records:
+        if record['type'] == 'model_call':
+            group = calls.setdefault(record['call_type'], {
+                'model': record['model'], 'calls': 0, 'errors': 0, 'retries': 0, 'cache_hits': 0,
+                'latency': [], 'ttft': [], 'prompt_tokens': 0, 'completion_tokens': 0, 'cached_tokens': 0,
+            })
+            group['calls'] += 1
+            group['errors'] += 1 if record['error'] else 0
+            group['retries'] += record['retries']
+            group['cache_hits'] += 1 if record['cached'] else 0
+            if not record.get('discarded'):  # Raced answers that lost only add to the tokens
+                group['latency'].append(record['latency'])
+                if record['ttft'] is not None:
+                    group['ttft'].append(record['ttft'])
+            for name in ('prompt_tokens', 'completion_tokens', 'cached_tokens'):
+                group[name] += record[name]
+        elif record['type'] == 'phase':
+            phases.setdefault(record['phase'], []).append(record['duration'])
+    return calls, phases
 
-def add_file_to_context(file_path, added_files, action='to the chat context'):
-    """Add a file to the given dictionary, applying exclusion rules."""
-    excluded_dirs = {
+def summarize_tiers(records=None):
+    """Group model calls by routing tier, with the models that answered and the estimated cost."""
+    with _telemetry_lock:
+        records = list(records if records is not None else telemetry_records)
+    tiers = {}
+    for record in records:
+        if record['type'] != 'model_call':
+            continue
+        group = tiers.setdefault(record.get('tier') or 'default', {
+            'models': {}, 'calls': 0, 'errors': 0, 'fallbacks': 0, 'discarded': 0, 'latency': [], 'ttft': [],
+            'prompt_tokens': 0, 'completion_tokens': 0, 'cost': 0.0, 'unpriced': 0,
+        })
+        group['calls'] += 1
+        group['errors'] += 1 if record['error'] else 0
+        group['fallbacks'] += 1 if record.get('fallback') else 0
+        group['discarded'] += 1 if record.get('discarded') else 0
+        if not record['error'] and not record.get('discarded'):
+            group['models'][record['model']] = group['models'].get(record['model'], 0) + 1
+            group['latency'].append(record['latency'])
+            if record['ttft'] is not None:
+                group['ttft'].append(record['ttft'])
+        group['prompt_tokens'] += record['prompt_tokens']
+        group['completion_tokens'] += record['completion_tokens']
+        if record.get('cost') is None:
+            group['unpriced'] += 1 if record['prompt_tokens'] or record['completion_tokens'] else 0
+        else:
+            group['cost'] += record['cost']
+    return tiers
+
+def write_prometheus_textfile(path):
+    """Write the session metrics in the Prometheus textfile collector format."""
+    calls, phases = summarize_telemetry()
+    lines = [
+        "# HELP stima_model_calls_total Model calls by command type.",
+        "# TYPE stima_model_calls_total counter",
+    ]
+    for call_type, group in sorted(calls.items()):
+        lines.append(f'stima_model_calls_total{{call_type="{call_type}",model="{group["model"]}"}} {group["calls"]}')
+    lines += ["# HELP stima_model_errors_total Failed model calls by command type.", "# TYPE stima_model_errors_total counter"]
+    for call_type, group in sorted(calls.items()):
+        lines.append(f'stima_model_errors_total{{call_type="{call_type}"}} {group["errors"]}')
+    lines += ["# HELP stima_model_retries_total Retried API requests by command type.", "# TYPE stima_model_retries_total counter"]
+    for call_type, group in sorted(calls.items()):
+        lines.append(f'stima_model_retries_total{{call_type="{call_type}"}} {group["retries"]}')
+    lines += ["# HELP stima_model_tokens_total Tokens by command type and kind.", "# TYPE stima_model_tokens_total counter"]
+    for call_type, group in sorted(calls.items()):
+        for kind in ('prompt', 'completion', 'cached'):
+            lines.append(f'stima_model_tokens_total{{call_type="{call_type}",kind="{kind}"}} {group[kind + "_tokens"]}')
+    lines += ["# HELP stima_model_latency_seconds Model call latency.", "# TYPE stima_model_latency_seconds summary"]
+    for call_type, group in sorted(calls.items()):
+        for q in (0.5, 0.95):
+            value = percentile(group["latency"], q * 100)
+            if value is not None:  # None when every call of the type was a discarded race answer
+                lines.append(f'stima_model_latency_seconds{{call_type="{call_type}",quantile="{q}"}} {value:.6f}')
+        lines.append(f'stima_model_latency_seconds_sum{{call_type="{call_type}"}} {sum(group["latency"]):.6f}')
+        lines.append(f'stima_model_latency_seconds_count{{call_type="{call_type}"}} {len(group["latency"])}')
+    lines += ["# HELP stima_model_cost_usd_total Estimated model cost by routing tier.", "# TYPE stima_model_cost_usd_total counter"]
+    for tier, group in sorted(summarize_tiers().items()):
+        lines.append(f'stima_model_cost_usd_total{{tier="{tier}"}} {group["cost"]:.6f}')
+    lines += ["# HELP stima_phase_seconds Duration of local phases.", "# TYPE stima_phase_seconds summary"]
+    for phase, durations in sorted(phases.items()):
+        for q in (0.5, 0.95):
+            value = percentile(durations, q * 100)
+            if value is not None:
+                lines.append(f'stima_phase_seconds{{phase="{phase}",quantile="{q}"}} {value:.6f}')
+        lines.append(f'stima_phase_seconds_sum{{phase="{phase}"}} {sum(durations):.6f}')
+        lines.append(f'stima_phase_seconds_count{{phase="{phase}"}} {len(durations)}')
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(temp_path, path)
+
+def display_stats():
+    """Show p50/p95 latency and token totals of this session."""
+    calls, phases = summarize_telemetry()
+    if not calls and not phases:
+        print(colored("本次會話尚無統計資料。", "yellow"))
+        return
+
+    def seconds(value):
+        return f"{value:.2f}s" if value is not None else "-"
+
+    def milliseconds(value):
+        return f"{value * 1000:.1f}ms" if value is not None else "-"
+
+    from rich.console import Console
+    from rich.table import Table
+    console = Console()
+    table = Table(title="Model calls")
+    for column in ("Type", "Calls", "Errors", "Retries", "p50", "p95", "TTFT p50", "Prompt", "Cached", "Completion"):
+        table.add_column(column, justify="left" if column == "Type" else "right")
+    totals = {'prompt_tokens': 0, 'completion_tokens': 0, 'cached_tokens': 0}
+    for call_type, group in sorted(calls.items()):
+        table.add_row(
+            call_type, str(group['calls']), str(group['errors']), str(group['retries']),
+            seconds(percentile(group['latency'], 50)), seconds(percentile(group['latency'], 95)),
+            seconds(percentile(group['ttft'], 50)),
+            str(group['prompt_tokens']), str(group['cached_tokens']), str(group['completion_tokens'])
+        )
+        for name in totals:
+            totals[name] += group[name]
+    table.add_row("Total", str(sum(group['calls'] for group in calls.values())), "", "", "", "", "",
+                  str(totals['prompt_tokens']), str(totals['cached_tokens']), str(totals['completion_tokens']), style="bold")
+    console.print(table)
+
+    table = Table(title="Model tiers")
+    for column in ("Tier", "Models", "Calls", "Errors", "Fallbacks", "Discarded", "p50", "p95", "TTFT p50", "Cost"):
+        table.add_column(column, justify="left" if column in ("Tier", "Models") else "right")
+    for tier, group in sorted(summarize_tiers().items()):
+        models = ", ".join(f"{model} ×{count}" for model, count in sorted(group['models'].items(), key=lambda item: -item[1]))
+        cost = f"${group['cost']:.4f}" + ("+" if group['unpriced'] else "") if group['cost'] or not group['unpriced'] else "-"
+        table.add_row(
+            tier, models or "-", str(group['calls']), str(group['errors']), str(group['fallbacks']), str(group['discarded']),
+            seconds(percentile(group['latency'], 50)), seconds(percentile(group['latency'], 95)),
+            seconds(percentile(group['ttft'], 50)), cost
+        )
+    console.print(table)
+
+    if phases:
+        table = Table(title="Local phases")
+        for column in ("Phase", "Count", "p50", "p95", "Total"):
+            table.add_column(column, justify="left" if column == "Phase" else "right")
+        for phase, durations in sorted(phases.items()):
+            table.add_row(phase, str(len(durations)), milliseconds(percentile(durations, 50)), milliseconds(percentile(durations, 95)), milliseconds(sum(durations)))
+        console.print(table)
+
+EXCLUDED_DIRS = {
     '__pycache__',
     '.git',
     'node_modules',
@@ -198,493 +627,3872 @@ def add_file_to_context(file_path, added_files, action='to the chat context'):
     'private',
     'cache',
     'addons'
-    }
-    # Removed reliance on 'excluded_extensions' and 'supported_extensions'
-
-    # Load .gitignore patterns if in a git repository
-    gitignore_patterns = []
-    if os.path.exists('.gitignore'):
-        gitignore_patterns = load_gitignore_patterns('.')
-
-    if os.path.isfile(file_path):
-        # Exclude based on directory
-        if any(ex_dir in file_path for ex_dir in excluded_dirs):
-            print(f"跳過排除的目錄檔案: {file_path}", "yellow")
-            logging.info(f"跳過排除的目錄檔案: {file_path}")
-            return
-        # Exclude based on gitignore patterns
-        if gitignore_patterns and should_ignore(file_path, gitignore_patterns):
-            print(f"跳過匹配 .gitignore 模式的檔案: {file_path}", "yellow")
-            logging.info(f"跳過匹配 .gitignore 模式的檔案: {file_path}")
-            return
-        if is_binary_file(file_path):
-            print(f"跳過二進制檔案: {file_path}", "yellow")
-            logging.info(f"跳過二進制檔案: {file_path}")
-            return
-        try:
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as file:
-                content = file.read()
-                added_files[file_path] = content
-                print(colored(f"Added {file_path} {action}.", "green"))
-                print(colored(f"添加 {file_path} {action}.", "green"))
-                logging.info(f"添加 {file_path} {action}.")
-        except Exception as e:
-            print(colored(f"讀取檔案 {file_path} 時發生錯誤: {e}", "red"))
-            logging.error(f"讀取檔案 {file_path} 時發生錯誤: {e}")
-    else:
-        print(colored(f"Error: {file_path} 不是一個檔案.", "red"))
-        logging.error(f"{file_path} 不是一個檔案.")
+}
 
+# Bytes that are expected in text files, built once for is_binary_chunk
+TEXT_CHARACTERS = bytes(bytearray({7, 8, 9, 10, 12, 13, 27} | set(range(0x20, 0x100))))
 
+def is_binary_chunk(chunk):
+    """Check if the first bytes of a file look like binary content."""
+    if not chunk:
+        return False
+    if b'\0' in chunk:
+        return True  # File is binary if it contains null bytes
+    # Use a heuristic to detect binary content
+    non_text = chunk.translate(None, TEXT_CHARACTERS)
+    return len(non_text) / len(chunk) > 0.30  # Consider binary if more than 30% non-text characters
 
-def apply_modifications(new_content, file_path):
+def is_binary_file(file_path):
+    """Check if a file is binary by reading a small portion of it."""
     try:
-        with open(file_path, 'r') as file:
-            old_content = file.read()
+        with open(file_path, 'rb') as file:
+            return is_binary_chunk(file.read(1024))  # Read the first 1024 bytes
+    except Exception as e:
+        logging.error(f"錯誤讀取檔案 {file_path}: {e}")
+        return True  # Assume binary if an error occurs
 
-        if old_content.strip() == new_content.strip():
-            print(colored(f"在 {file_path} 中未檢測到更改", "red"))
-            return True
 
-        display_diff(old_content, new_content, file_path)
+# Load .gitignore patterns if in a git repository
+def load_gitignore_patterns(directory):
+    gitignore_path = os.path.join(directory, '.gitignore')
+    patterns = []
+    if os.path.exists(gitignore_path):
+        with open(gitignore_path, 'r', encoding='utf-8', errors='ignore') as f:
+            for line in f:
+                line = line.rstrip('\n').rstrip()
+                if line and not line.startswith('#'):
+                    patterns.append(line)
+    return patterns
 
-        confirm = prompt(f"Apply these changes to {file_path}? (yes/no): ", style=Style.from_dict({'prompt': 'orange'})).strip().lower()
-        if confirm == 'yes':
-            with open(file_path, 'w') as file:
-                file.write(new_content)
-            print(colored(f"已成功將更改應用於 {file_path}.", "green"))
-            logging.info(f"已成功將更改應用於 {file_path}.")
-            return True
+def _translate_gitignore_glob(pattern):
+    """Translate a gitignore glob into a regular expression."""
+    i, n = 0, len(pattern)
+    regex = []
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern[i:i + 2] == '**':
+                i += 2
+                if i < n and pattern[i] == '/':
+                    regex.append('(?:.*/)?')  # '**/' matches zero or more directories
+                    i += 1
+                else:
+                    regex.append('.*')
+                continue
+            regex.append('[^/]*')
+        elif c == '?':
+            regex.append('[^/]')
+        elif c == '[':
+            j = i + 1
+            if j < n and pattern[j] in '!^':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            j = pattern.find(']', j)
+            if j < 0:
+                regex.append(re.escape(c))
+            else:
+                body = pattern[i + 1:j].replace('\\', '\\\\')
+                if body[:1] in ('!', '^'):
+                    body = '^' + body[1:]
+                regex.append(f'[{body}]')
+                i = j
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            regex.append(re.escape(pattern[i]))
         else:
-            print(colored(f"未將更改應用於 {file_path}.", "red"))
-            logging.info(f"用戶選擇不將更改應用於 {file_path}.")
-            return False
+            regex.append(re.escape(c))
+        i += 1
+    return ''.join(regex)
 
-    except Exception as e:
-        print(colored(f"在應用更改到 {file_path} 時發生錯誤: {e}", "red"))
-        logging.error(f"在應用更改到 {file_path} 時發生錯誤: {e}")
-        return False
+def compile_gitignore_pattern(pattern):
+    """Compile one gitignore line into (regex, negate, dir_only, anchored)."""
+    negate = pattern.startswith('!')
+    if negate:
+        pattern = pattern[1:]
+    elif pattern.startswith('\\!') or pattern.startswith('\\#'):
+        pattern = pattern[1:]
+    dir_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    if not pattern:
+        return None
+    # A slash anywhere but at the end anchors the pattern to the .gitignore directory
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+    regex = re.compile(_translate_gitignore_glob(pattern) + r'\Z', re.DOTALL)
+    return regex, negate, dir_only, anchored
 
-def display_diff(old_content, new_content, file_path):
-    diff = list(difflib.unified_diff(
-old_content.splitlines(keepends=True),
-new_content.splitlines(keepends=True),
-fromfile=f"a/{file_path}",
-tofile=f"b/{file_path}",
-lineterm='',
-n=5
-))
-    if not diff:
-        print(f"在 {file_path} 中未檢測到更改")
-        return
-    console = Console()
-    table = Table(title=f"Diff for {file_path}")
-    table.add_column("Status", style="bold")
-    table.add_column("Line")
-    table.add_column("Content")
-    line_number = 1
-    for line in diff:
-        status = line[0]
-        content = line[2:].rstrip()
-        if status == ' ':
-            continue  # Skip unchanged lines
-        elif status == '-':
-            table.add_row("Removed", str(line_number), content, style="red")
-        elif status == '+':
-            table.add_row("Added", str(line_number), content, style="green")
-        line_number += 1
-    console.print(table)
+@lru_cache(maxsize=None)
+def _compile_gitignore_file(directory, mtime):
+    rules = []
+    for pattern in load_gitignore_patterns(directory):
+        rule = compile_gitignore_pattern(pattern)
+        if rule:
+            rules.append(rule)
+    return tuple(rules)
 
-def apply_creation_steps(creation_response, added_files, retry_count=0):
-    max_retries = 3
+def gitignore_rules(directory):
+    """Return the compiled rules of directory/.gitignore, cached until the file changes."""
     try:
-        code_blocks = re.findall(r'```(?:\w+)?\s*([\s\S]*?)```', creation_response)
-        if not code_blocks:
-            raise ValueError("在 AI 回應中未找到程式碼區塊。")
+        mtime = os.stat(os.path.join(directory, '.gitignore')).st_mtime_ns
+    except OSError:
+        return ()
+    return _compile_gitignore_file(directory, mtime)
 
-        print("成功提取程式碼區塊:")
-        logging.info("成功從創建回應中提取程式碼區塊。")
+def gitignore_rule_stack(directory):
+    """Collect (base_dir, rules) for the working directory and every directory down to directory.
 
-        for code in code_blocks:
-            # Extract file/folder information from the special comment line
-            info_match = re.match(r'### (FILE|FOLDER): (.+)', code.strip())
-            
-            if info_match:
-                item_type, path = info_match.groups()
-                
-                if item_type == 'FOLDER':
-                    # Create the folder
-                    os.makedirs(path, exist_ok=True)
-                    print(colored(f"創建資料夾: {path}", "green"))
-                    logging.info(f"創建資料夾: {path}")
-                elif item_type == 'FILE':
-                    # Extract file content (everything after the special comment line)
-                    file_content = re.sub(r'### FILE: .+\n', '', code, count=1).strip()
-
-                    # Create directories if necessary
-                    directory = os.path.dirname(path)
-                    if directory and not os.path.exists(directory):
-                        os.makedirs(directory, exist_ok=True)
-                        print(colored(f"創建資料夾: {directory}", "green"))
-                        logging.info(f"創建資料夾: {directory}")
-
-                    # Write content to the file
-                    with open(path, 'w', encoding='utf-8') as f:
-                        f.write(file_content)
-                    print(colored(f"創建檔案: {path}", "green"))
-                    logging.info(f"創建檔案: {path}")
-            else:
-                print(colored("錯誤: 無法從程式碼區塊中確定檔案或資料夾資訊。", "red"))
-                logging.error("無法從程式碼區塊中確定檔案或資料夾資訊。")
+    Outside the working directory only the directory's own .gitignore
+    applies, since the project's rules cannot match paths outside it.
+    """
+    cwd = os.path.abspath('.')
+    directory = os.path.abspath(directory)
+    bases = [directory]
+    if directory.startswith(cwd + os.sep):
+        while directory != cwd:
+            directory = os.path.dirname(directory)
+            bases.append(directory)
+    stack = []
+    for base in reversed(bases):
+        rules = gitignore_rules(base)
+        if rules:
+            stack.append((base, rules))
+    return stack
+
+def is_gitignored(abs_path, is_dir, rule_stack):
+    """Apply gitignore rules in order; the last matching rule decides."""
+    ignored = False
+    name = os.path.basename(abs_path)
+    for base, rules in rule_stack:
+        if not abs_path.startswith(base.rstrip(os.sep) + os.sep):
+            continue
+        relative = abs_path[len(base.rstrip(os.sep)) + 1:]
+        if os.sep != '/':
+            relative = relative.replace(os.sep, '/')
+        for regex, negate, dir_only, anchored in rules:
+            if dir_only and not is_dir:
                 continue
+            if regex.match(relative if anchored else name):
+                ignored = not negate
+    return ignored
 
-        return True
+def is_ignored_file(file_path):
+    """Whether the walker would skip file_path: it or a directory between it and the working directory is gitignored."""
+    abs_path = os.path.abspath(file_path)
+    cwd = os.path.abspath('.')
+    directories = []
+    directory = os.path.dirname(abs_path)
+    while directory.startswith(cwd + os.sep):
+        directories.append(directory)
+        directory = os.path.dirname(directory)
+    for directory in reversed(directories):
+        if is_gitignored(directory, True, gitignore_rule_stack(os.path.dirname(directory))):
+            return True
+    return is_gitignored(abs_path, False, gitignore_rule_stack(os.path.dirname(abs_path)))
 
-    except ValueError as e:
-        if retry_count < max_retries:
-            print(colored(f"錯誤: {str(e)} 重試... (嘗試 {retry_count + 1})", "red"))
-            logging.warning(f"創建解析失敗: {str(e)}. 重試... (嘗試 {retry_count + 1})")
-            error_message = f"{str(e)} 請再次提供使用指定格式的創建指令。"
-            time.sleep(2 ** retry_count)  # Exponential backoff
-            new_response = chat_with_ai(error_message, is_edit_request=False, added_files=added_files)
-            if new_response:
-                return apply_creation_steps(new_response, added_files, retry_count + 1)
-            else:
-                return False
-        else:
-            print(colored(f"創建回應失敗: {str(e)}", "red"))
-            logging.error(f"創建回應失敗: {str(e)}")
-            print("創建回應失敗:")
-            print(creation_response)
-            return False
-    except Exception as e:
-        print(colored(f"創建回應失敗: {e}", "red"))
-        logging.error(f"創建回應失敗: {e}")
-        return False
+def is_excluded_path(file_path):
+    """Check whether any directory of file_path is one of EXCLUDED_DIRS."""
+    parts = os.path.normpath(file_path).split(os.sep)
+    return any(part in EXCLUDED_DIRS for part in parts[:-1])
 
+def walk_files(path):
+    """Yield the files under path, pruning excluded and gitignored directories.
 
+    Uses os.scandir and compiles every .gitignore (including nested ones) only
+    once per walk.
+    """
+    pending = [(path, os.path.abspath(path), gitignore_rule_stack(path))]
+    while pending:
+        directory, abs_directory, rule_stack = pending.pop()
+        try:
+            with os.scandir(directory) as entries:
+                entries = sorted(entries, key=lambda entry: entry.name)
+        except OSError as e:
+            logging.error(f"無法讀取目錄 {directory}: {e}")
+            continue
+        if directory != path and any(entry.name == '.gitignore' for entry in entries):
+            rules = gitignore_rules(abs_directory)
+            if rules:
+                rule_stack = rule_stack + [(abs_directory, rules)]
+        subdirs = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+            if is_dir and entry.name in EXCLUDED_DIRS:
+                continue
+            abs_path = os.path.join(abs_directory, entry.name)
+            if rule_stack and is_gitignored(abs_path, is_dir, rule_stack):
+                continue
+            if is_dir:
+                subdirs.append((entry.path, abs_path, rule_stack))
+            elif entry.is_file():
+                yield entry.path
+        pending.extend(reversed(subdirs))
 
-def parse_edit_instructions(response):
-    instructions = {}
-    current_file = None
-    current_instructions = []
+def read_text_file(file_path):
+    """Read a file as text, returning None for binary or unreadable files."""
+    try:
+        with open(file_path, 'rb') as file:
+            chunk = file.read(1024)
+            if is_binary_chunk(chunk):
+                return None
+            data = chunk + file.read()
+    except Exception as e:
+        logging.error(f"讀取檔案 {file_path} 時發生錯誤: {e}")
+        return None
+    content = data.decode('utf-8', errors='ignore')
+    return content.replace('\r\n', '\n').replace('\r', '\n')
 
-    for line in response.split('\n'):
-        if line.startswith("File: "):
-            if current_file:
-                instructions[current_file] = "\n".join(current_instructions)
-            current_file = line[6:].strip()
-            current_instructions = []
-        elif line.strip() and current_file:
-            current_instructions.append(line.strip())
+_path_index_lock = threading.Lock()
+_path_index = None  # Built in the background by refresh_path_index
+_path_index_building = False
+BIT_SELECTOR = bytes.maketrans(b'01', b'\x00\x01')
+COUNT_FLAGS = {k: bytes(ord('1') if value >= k else ord('0') for value in range(256)) for k in (1, 2, 3)}
 
-    if current_file:
-        instructions[current_file] = "\n".join(current_instructions)
+def index_paths(paths):
+    """Build the completion index for a list of relative paths.
 
-    return instructions
+    Lines are searched as one newline-joined string. For every character
+    there are bitsets of the lines containing it at least once, twice and
+    three times, so a query only scans the lines that can possibly match.
+    """
+    lines = sorted(set(paths))
+    lowered = [line.lower() for line in lines]
+    bits = {}
+    for char in set("".join(lowered)) - {'\n'}:
+        counts = bytes(min(line.count(char), 3) for line in lowered)
+        for k in (1, 2, 3):
+            flags = counts.translate(COUNT_FLAGS[k])
+            if b'1' not in flags:
+                break
+            bits[(char, k)] = int(flags[::-1], 2)
+    return {
+        'lines': lines,
+        'lowered': lowered,
+        'original': dict(zip(lowered, lines)),
+        'blob': "\n".join(lowered) + "\n",
+        'bits': bits,
+        'built_at': time.monotonic(),
+    }
 
-def apply_edit_instructions(edit_instructions, original_files):
-    modified_files = {}
-    for file_path, content in original_files.items():
-        if file_path in edit_instructions:
-            instructions = edit_instructions[file_path]
-            prompt = f"{APPLY_EDITS_PROMPT}\n\nOriginal File: {file_path}\nContent:\n{content}\n\nEdit Instructions:\n{instructions}\n\nUpdated File Content:"
-            response = chat_with_ai(prompt, is_edit_request=True)
-            if response:
-                modified_files[file_path] = response.strip()
-        else:
-            modified_files[file_path] = content  # No changes for this file
-    return modified_files
+def build_path_index(root='.', previous=None):
+    """Index every file and folder under root that the walker does not skip.
 
-def chat_with_ai(user_message, is_edit_request=False, retry_count=0, added_files=None):
-    global last_ai_response, conversation_history, MODEL
-    try:
-        # Include added file contents and conversation history in the user message
-        if added_files:
-            file_context = "Added files:\n"
-            for file_path, content in added_files.items():
-                file_context += f"File: {file_path}\nContent:\n{content}\n\n"
-            user_message = f"{file_context}\n{user_message}"
-
-        # Include conversation history
-        if not is_edit_request:
-            history = "\n".join([f"User: {msg}" if i % 2 == 0 else f"AI: {msg}" for i, msg in enumerate(conversation_history)])
-            if history:
-                user_message = f"{history}\nUser: {user_message}"
-
-        # Prepare the message content based on the request type
-        if is_edit_request:
-            prompt = EDIT_INSTRUCTION_PROMPT if retry_count == 0 else APPLY_EDITS_PROMPT
-            message_content = f"{prompt}\n\nUser request: {user_message}"
-        else:
-            message_content = user_message
+    The previous index is kept when the set of paths has not changed.
+    """
+    paths = set()
+    for file_path in walk_files(root):
+        path = os.path.normpath(os.path.relpath(file_path, root)).replace(os.sep, '/')
+        paths.add(path)
+        directory = os.path.dirname(path)
+        while directory and directory + '/' not in paths:
+            paths.add(directory + '/')
+            directory = os.path.dirname(directory)
+    if previous and previous['lines'] == sorted(paths):
+        return dict(previous, built_at=time.monotonic())
+    return index_paths(paths)
 
-        messages = [
-            {"role": "user", "content": message_content}
-        ]
-        
-        if is_edit_request and retry_count == 0:
-            print(colored("分析文件並生成修改...", "magenta"))
-            logging.info("分析文件並生成修改...")
-        elif not is_edit_request:
-            print(colored("軟體工程師正在思考...", "magenta"))
-            logging.info("發送一般查詢到 AI.")
+def refresh_path_index(root='.', wait=False):
+    """Rebuild the path index in the background once it is older than PATH_INDEX_REFRESH seconds."""
+    global _path_index_building
 
-        response = client.chat.completions.create(
-            model=MODEL,  # 在這裡使用 MODEL 變量
-            messages=messages,
-            max_tokens=60000  # 注意：這裡使用 max_tokens 而不是 max_completion_tokens
-        )
-        logging.info("Received response from AI.")
-        last_ai_response = response.choices[0].message.content
+    def build():
+        global _path_index, _path_index_building
+        try:
+            index = build_path_index(root, _path_index)
+            with _path_index_lock:
+                changed = index['bits'] is not (_path_index or {}).get('bits')
+                _path_index = index
+            if changed:
+                logging.info(f"路徑索引已更新: {len(index['lines'])} 個路徑")
+        except Exception as e:
+            logging.error(f"建立路徑索引時發生錯誤: {e}")
+        finally:
+            _path_index_building = False
 
-        if not is_edit_request:
-            # Update conversation history
-            conversation_history.append(user_message)
-            conversation_history.append(last_ai_response)
-            if len(conversation_history) > 20:  # 10 interactions (user + AI each)
-                conversation_history = conversation_history[-20:]
+    with _path_index_lock:
+        if _path_index_building or (_path_index and time.monotonic() - _path_index['built_at'] < PATH_INDEX_REFRESH):
+            return
+        _path_index_building = True
+    if wait:
+        build()
+    else:
+        threading.Thread(target=build, daemon=True).start()
 
-        return last_ai_response
-    except Exception as e:
-        print(colored(f"與 Stima API 通訊時發生錯誤: {e}", "red"))
-        logging.error(f"與 Stima API 通訊時發生錯誤: {e}")
-        return None
-    
+def fuzzy_find_paths(query, limit=20, index=None):
+    """Return up to limit indexed paths containing the characters of query in order.
 
+    Each query character is matched with [^c\\n]*c, so a "/" in the query
+    moves on to a later path segment. Paths containing more of the query
+    segments verbatim come first, then those whose name holds the last
+    segment, then shorter paths.
+    """
+    index = index or _path_index
+    query = query.lower()
+    if not index or not query or '\n' in query:
+        return []
+    candidates = -1
+    for char in set(query):
+        key = (char, min(query.count(char), 3))
+        if key not in index['bits']:
+            return []
+        candidates &= index['bits'][key]
+    pattern = re.compile(re.escape(query[0]) + "".join(f"[^{re.escape(char)}\\n]*{re.escape(char)}" for char in query[1:]))
+    segments = [segment for segment in query.split('/') if segment] or [query]
+    deadline = time.perf_counter() + PATH_SEARCH_BUDGET
+    matches = set()
 
-def main():
-    global last_ai_response, conversation_history, client, MODEL
+    def collect(blob, search, limit):
+        position = 0
+        while len(matches) < limit and time.perf_counter() < deadline:
+            match = search(blob, position)
+            if not match:
+                return
+            start = blob.rfind('\n', 0, match.start()) + 1
+            position = blob.find('\n', match.end()) + 1
+            line = blob[start:position - 1]
+            if search is pattern.search or pattern.search(line):
+                matches.add(line)
 
-    parser = argparse.ArgumentParser(description="Stima 助理工程師 CLI")
-    parser.add_argument("--api-key", help="請輸入您的 Stima API Key")
-    parser.add_argument("--model", help="請輸入模型名稱, 預設使用 Anthropic Claude 3.5 Sonnet", default="claude-3-5-sonnet-20240620")
-    args = parser.parse_args()
-    
-    # 定義全局 MODEL 變量
-    MODEL = args.model
+    # Paths containing query segments verbatim rank first and a literal search is cheap,
+    # so matches holding the longest segment are collected from the whole index first
+    collect(index['blob'], re.compile(re.escape(max(segments, key=len))).search, PATH_MATCH_CANDIDATES // 2)
+    # The fuzzy pass only looks at lines holding every query character, a chunk at a time,
+    # until enough matches are found or the time budget runs out
+    selector = bin(candidates)[:1:-1].encode().translate(BIT_SELECTOR)
+    for start in range(0, len(selector), PATH_SEARCH_CHUNK):
+        if len(matches) >= PATH_MATCH_CANDIDATES or time.perf_counter() >= deadline:
+            break
+        lines = list(compress(index['lowered'][start:start + PATH_SEARCH_CHUNK], selector[start:start + PATH_SEARCH_CHUNK]))
+        if lines:
+            collect("\n".join(lines) + "\n", pattern.search, PATH_MATCH_CANDIDATES)
 
-    # 初始化 OpenAI 客戶端
-    client = OpenAI(
-        base_url="https://api.stima.tech/v1",  
-        api_key=args.api_key if args.api_key else "YOUR KEY"
-    )
+    def rank(line):
+        name = line.rstrip('/').rsplit('/', 1)[-1]
+        missing = sum(segment not in line for segment in segments)
+        return (missing, segments[-1] not in name, not name.startswith(segments[-1][0]), len(line), line)
 
-    print(colored(f"Stima engineer is ready to help you. Using model: {MODEL}", "cyan"))
-    print("\nAvailable commands:")
-    print(f"{colored('/edit', 'magenta'):<10} {colored('編輯文件或目錄 (跟隨路徑)', 'dark_grey')}")
-    print(f"{colored('/create', 'magenta'):<10} {colored('創建文件或文件夾 (跟隨指令)', 'dark_grey')}")
-    print(f"{colored('/add', 'magenta'):<10} {colored('添加文件或文件夾到上下文', 'dark_grey')}")
-    print(f"{colored('/debug', 'magenta'):<10} {colored('印出最後的 AI 回應', 'dark_grey')}")
-    print(f"{colored('/reset', 'magenta'):<10} {colored('重置聊天上下文並清除添加的文件', 'dark_grey')}")
-    print(f"{colored('/review', 'magenta'):<10} {colored('審查代碼文件 (跟隨文件路徑)', 'dark_grey')}")
-    print(f"{colored('/planning', 'magenta'):<10} {colored('生成基於您請求的詳細計劃', 'dark_grey')}")
-    print(f"{colored('/quit', 'magenta'):<10} {colored('退出腳本', 'dark_grey')}")
-    style = Style.from_dict({
-        'prompt': 'cyan',
-    })
+    return [index['original'][line] for line in sorted(matches, key=rank)[:limit]]
 
-    # Get the list of files in the current directory
-    files = [f for f in os.listdir('.') if os.path.isfile(f)]
+def make_path_completer(commands):
+    """Return a threaded prompt_toolkit completer for commands and indexed paths."""
+    from prompt_toolkit.completion import Completer, Completion, ThreadedCompleter
 
-    # Create a WordCompleter with available commands and files
-    completer = WordCompleter(
-        ['/edit', '/create', '/add', '/quit', '/debug', '/reset', '/review', '/planning'] + files,
-        ignore_case=True
-    )
+    class FuzzyPathCompleter(Completer):
+        """Complete commands, and paths from the background index with fuzzy matching."""
 
-    added_files = {}
-    file_contents = {}
+        def __init__(self, commands):
+            self.commands = commands
 
-    while True:
-        print()  # Add a newline before the prompt
-        user_input = prompt("You: ", style=style, completer=completer).strip()
+        def get_completions(self, document, complete_event):
+            text = document.text_before_cursor
+            word = document.get_word_before_cursor(WORD=True)
+            if ' ' not in text:
+                for command in self.commands:
+                    if text.startswith('/') and command.startswith(text.lower()):
+                        yield Completion(command, start_position=-len(text))
+                if text.startswith('/'):
+                    return
+            if not word or not (text.split(' ', 1)[0] in PATH_COMMANDS or '/' in word or '.' in word):
+                return
+            refresh_path_index()
+            for path in fuzzy_find_paths(word):
+                yield Completion(path, start_position=-len(word))
 
-        if user_input.lower() == '/quit':
-            print("Goodbye!")
-            logging.info("User exited the program.")
-            break
+    return ThreadedCompleter(FuzzyPathCompleter(commands))
 
-        elif user_input.lower() == '/debug':
-            if last_ai_response:
-                print(colored("Last AI Response:", "blue"))
-                print(last_ai_response)
-            else:
-                print(colored("No AI response available yet.", "red"))
-
-        elif user_input.lower() == '/reset':
-            conversation_history = []
-            added_files.clear()
-            last_ai_response = None
-            print(colored("聊天上下文和添加的文件已重置。", "green"))
-            logging.info("聊天上下文和添加的文件已重置。")
-
-        elif user_input.startswith('/add'):
-            paths = user_input.split()[1:]
-            if not paths:
-                print(colored("請提供至少一個文件或文件夾路徑。", "red"))
-                logging.warning("用戶發送 /add 而沒有文件或文件夾路徑。")
-                continue
+@timed_phase('walk')
+def add_paths_to_context(paths, added_files, action='to the chat context', max_workers=None):
+    """Add files and folders to added_files using one shared walk and parallel reads."""
+    file_paths = []
+    for path in paths:
+        if os.path.isfile(path):
+            file_paths.append(path)
+        elif os.path.isdir(path):
+            file_paths.extend(walk_files(path))
+        else:
+            print(colored(f"錯誤: {path} 既不是文件也不是目錄。", "red"))
+            logging.error(f"{path} 既不是文件也不是目錄。")
 
-            for path in paths:
-                if os.path.isfile(path):
-                    add_file_to_context(path, added_files)
-                elif os.path.isdir(path):
-                    for root, dirs, files_in_dir in os.walk(path):
-                        # Skip excluded directories
-                        dirs[:] = [d for d in dirs if d not in {'__pycache__', '.git', 'node_modules'}]
-                        for file in files_in_dir:
-                            file_path = os.path.join(root, file)
-                            add_file_to_context(file_path, added_files)
-                else:
-                    print(colored(f"錯誤: {path} 既不是文件也不是目錄。", "red"))
-                    logging.error(f"{path} 既不是文件也不是目錄。")
-            total_size = sum(len(content) for content in added_files.values())
-            if total_size > 100000:  # Warning if total content exceeds ~100KB
-                print(colored("警告: 添加的文件總大小可能會影響性能。", "red"))
-                logging.warning("添加的文件總大小超過 100KB。")
-
-        elif user_input.startswith('/edit'):
-            paths = user_input.split()[1:]
-            if not paths:
-                print(colored("請提供至少一個文件或文件夾路徑。", "red"))
-                logging.warning("用戶發送 /edit 而沒有文件或文件夾路徑。")
+    explicit = set(paths)
+    candidates = []
+    for file_path in file_paths:
+        # Files named directly still go through the same exclusion rules as before
+        if file_path in explicit:
+            if is_excluded_path(file_path):
+                print(colored(f"跳過排除的目錄檔案: {file_path}", "yellow"))
+                logging.info(f"跳過排除的目錄檔案: {file_path}")
                 continue
-            for path in paths:
-                if os.path.isfile(path):
-                    add_file_to_context(path, added_files)
-                elif os.path.isdir(path):
-                    for root, dirs, files_in_dir in os.walk(path):
-                        # Skip excluded directories
-                        dirs[:] = [d for d in dirs if d not in {'__pycache__', '.git', 'node_modules'}]
-                        for file in files_in_dir:
-                            file_path = os.path.join(root, file)
-                            add_file_to_context(file_path, added_files)
-                else:
-                    print(colored(f"錯誤: {path} 既不是文件也不是目錄。", "red"))
-                    logging.error(f"{path} 既不是文件也不是目錄。")
-            if not added_files:
-                print(colored("沒有有效的文件可以編輯。", "red"))
+            if is_ignored_file(file_path):
+                print(colored(f"跳過匹配 .gitignore 模式的檔案: {file_path}", "yellow"))
+                logging.info(f"跳過匹配 .gitignore 模式的檔案: {file_path}")
                 continue
-            edit_instruction = prompt(f"Edit Instruction for all files: ", style=style).strip()
+        candidates.append(file_path)
 
-            edit_request = f"""User request: {edit_instruction}
+    added = 0
+    skipped = []
+    with ThreadPoolExecutor(max_workers=max_workers or MAX_WORKERS * 4) as executor:
+        for file_path, content in zip(candidates, executor.map(read_text_file, candidates)):
+            if content is None:
+                skipped.append(file_path)
+                logging.info(f"跳過二進制或無法讀取的檔案: {file_path}")
+                continue
+            added_files[file_path] = content
+            added += 1
+            if added <= 20:
+                print(colored(f"添加 {file_path} {action}.", "green"))
+            logging.info(f"添加 {file_path} {action}.")
+    if added > 20:
+        print(colored(f"... 以及另外 {added - 20} 個文件 {action}.", "green"))
+    if skipped:
+        print(colored(f"跳過 {len(skipped)} 個二進制或無法讀取的檔案。", "yellow"))
+    return added
 
-Files to modify:
-"""
-            for file_path, content in added_files.items():
-                edit_request += f"\nFile: {file_path}\nContent:\n{content}\n\n"
+def add_file_to_context(file_path, added_files, action='to the chat context'):
+    """Add a file to the given dictionary, applying exclusion rules."""
+    if os.path.isfile(file_path):
+        add_paths_to_context([file_path], added_files, action=action)
+    else:
+        print(colored(f"Error: {file_path} 不是一個檔案.", "red"))
+        logging.error(f"{file_path} 不是一個檔案.")
 
-            ai_response = chat_with_ai(edit_request, is_edit_request=True, added_files=added_files)
-            
-            if ai_response:
-                print("軟體工程師: 以下是建議的編輯指令:")
-                rprint(Markdown(ai_response))
-
-                confirm = prompt("你想要應用這些編輯指令嗎? (yes/no): ", style=style).strip().lower()
-                if confirm == 'yes':
-                    edit_instructions = parse_edit_instructions(ai_response)
-                    modified_files = apply_edit_instructions(edit_instructions, added_files)
-                    for file_path, new_content in modified_files.items():
-                        apply_modifications(new_content, file_path)
-                else:
-                    print(colored("編輯指令未應用。", "red"))
-                    logging.info("用戶選擇不應用編輯指令。")
-
-        elif user_input.startswith('/create'):
-            creation_instruction = user_input[7:].strip()  # Remove '/create' and leading/trailing whitespace
-            if not creation_instruction:
-                print(colored("請在 /create 後提供創建指令。", "red"))
-                logging.warning("用戶發送 /create 而沒有指令。")
-                continue
 
-            create_request = f"{CREATE_SYSTEM_PROMPT}\n\nUser request: {creation_instruction}"
-            ai_response = chat_with_ai(create_request, is_edit_request=False, added_files=added_files)
-            
-            if ai_response:
-                while True:
-                    print("軟體工程師: 以下是建議的創建結構:")
-                    rprint(Markdown(ai_response))
-
-                    confirm = prompt("你想要執行這些創建步驟嗎? (yes/no): ", style=style).strip().lower()
-                    if confirm == 'yes':
-                        success = apply_creation_steps(ai_response, added_files)
-                        if success:
-                            break
-                        else:
-                            retry = prompt("創建失敗。你想要 AI 再次嘗試嗎? (yes/no): ", style=style).strip().lower()
-                            if retry != 'yes':
-                                break
-                            ai_response = chat_with_ai("The previous creation attempt failed. Please try again with a different approach.", is_edit_request=False, added_files=added_files)
-                    else:
-                        print(colored("創建步驟未執行。", "red"))
-                        logging.info("用戶選擇不執行創建步驟。")
-                        break
+def is_outline(content):
+    return bool(content) and content.startswith(OUTLINE_MARKER)
 
-        elif user_input.startswith('/review'):
-            paths = user_input.split()[1:]
-            if not paths:
-                print(colored("請提供至少一個文件或文件夾路徑。", "red"))
-                logging.warning("用戶發送 /review 而沒有文件或文件夾路徑。")
-                continue
+def _outline_python(content):
+    """Keep the docstrings, imports, short assignments and signatures of a Python module."""
+    import ast
+    tree = ast.parse(content)
+    lines = content.split('\n')
+    kept = []
 
-            file_contents = {}
+    def segment(node):
+        return lines[node.lineno - 1:node.end_lineno]
+
+    def visit(body, module=False):
+        for position, node in enumerate(body):
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                start = min([decorator.lineno for decorator in node.decorator_list] + [node.lineno])
+                first = node.body[0]
+                if first.lineno == node.lineno:  # def f(): return 1
+                    kept.extend(lines[start - 1:node.lineno - 1])
+                    kept.append(lines[node.lineno - 1][:first.col_offset].rstrip() + " ...")
+                    continue
+                kept.extend(lines[start - 1:first.lineno - 1])
+                has_docstring = ast.get_docstring(node, clean=False) is not None
+                if has_docstring:
+                    kept.extend(segment(first))
+                indent = lines[first.lineno - 1][:first.col_offset]
+                before = len(kept)
+                if isinstance(node, ast.ClassDef):
+                    visit(node.body[1:] if has_docstring else node.body)
+                if len(kept) == before:
+                    kept.append(indent + "...")
+            elif isinstance(node, (ast.Import, ast.ImportFrom)):
+                kept.extend(segment(node))
+            elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+                if node.end_lineno - node.lineno < OUTLINE_MAX_ASSIGN_LINES and len(lines[node.lineno - 1]) <= 160:
+                    kept.extend(segment(node))
+                elif node.value is not None and node.value.lineno == node.lineno:
+                    kept.append(lines[node.lineno - 1][:node.value.col_offset] + "...")  # Long values such as prompts
+            elif module and position == 0 and isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str):
+                kept.extend(segment(node))  # Module docstring
+            elif module and isinstance(node, (ast.If, ast.Try)) and node.end_lineno - node.lineno < 15 \
+                    and any(isinstance(child, (ast.Import, ast.ImportFrom)) for child in ast.walk(node)):
+                kept.extend(segment(node))  # Guarded imports such as try: import x / except ImportError
+
+    visit(tree.body, module=True)
+    return "\n".join(kept)
+
+def _outline_lines(content):
+    """Keep import and definition lines of any language, replacing each elided run with '...'."""
+    kept = []
+    elided = False
+    for line in content.split('\n'):
+        if OUTLINE_IMPORT.match(line) or OUTLINE_DEFINITION.match(line) or OUTLINE_BLOCK_DEFINITION.match(line):
+            kept.append(line.rstrip())
+            elided = False
+        elif line.strip() and not elided:
+            kept.append(line[:len(line) - len(line.lstrip())] + "...")
+            elided = True
+    return "\n".join(kept)
+
+def outline_file(file_path, content):
+    """Return the skeleton of a file, marked with OUTLINE_MARKER so it is never mistaken for the full text."""
+    skeleton = None
+    if file_path.endswith(('.py', '.pyi')):
+        try:
+            skeleton = _outline_python(content)
+        except (SyntaxError, ValueError) as e:
+            logging.info(f"無法解析 {file_path}, 改用通用大綱: {e}")
+    if skeleton is None:
+        skeleton = _outline_lines(content)
+    return f"{OUTLINE_MARKER}\n{skeleton}\n"
+
+def find_symbol_source(file_path, content, name):
+    """Return (source, first line, last line) of a symbol such as Class.method, or None."""
+    lines = content.split('\n')
+    if file_path.endswith(('.py', '.pyi')):
+        import ast
+        try:
+            body = ast.parse(content).body
+        except (SyntaxError, ValueError):
+            body = None
+        if body is not None:
+            node = None
+            for part in name.split('.'):
+                node = next((child for child in body if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)) and child.name == part), None)
+                if node is None:
+                    return None
+                body = node.body
+            start = min([decorator.lineno for decorator in node.decorator_list] + [node.lineno])
+            return "\n".join(lines[start - 1:node.end_lineno]), start, node.end_lineno
+    symbol = re.compile(r'\b' + re.escape(name.split('.')[-1]) + r'\b')
+    for index, line in enumerate(lines):
+        if not symbol.search(line) or not (OUTLINE_DEFINITION.match(line) or OUTLINE_BLOCK_DEFINITION.match(line)):
+            continue
+        end = index
+        if '{' in line:
+            # Brace languages: up to the matching closing brace
+            depth = 0
+            for end in range(index, len(lines)):
+                depth += lines[end].count('{') - lines[end].count('}')
+                if depth <= 0:
+                    break
+        else:
+            # Indentation languages: the following lines that are indented deeper
+            indent = len(line) - len(line.lstrip())
+            for following in range(index + 1, len(lines)):
+                if lines[following].strip() and len(lines[following]) - len(lines[following].lstrip()) <= indent:
+                    break
+                end = following
+        return "\n".join(lines[index:end + 1]).rstrip(), index + 1, end + 1
+    return None
+
+def add_outlines_to_context(paths, added_files):
+    """Add files as outlines and report the tokens saved per file.
+
+    A file whose outline would not be smaller is added in full.
+    """
+    from rich.console import Console
+    from rich.table import Table
+    contents = {}
+    add_paths_to_context(paths, contents, action='as an outline')
+    table = Table(title="Outline token savings")
+    table.add_column("File")
+    table.add_column("Full", justify="right")
+    table.add_column("Outline", justify="right")
+    table.add_column("Saved", justify="right")
+    full_total = outline_total = 0
+    for file_path, content in contents.items():
+        outline = outline_file(file_path, content)
+        full_tokens, outline_tokens = estimate_tokens(content), estimate_tokens(outline)
+        if outline_tokens >= full_tokens:
+            outline, outline_tokens = content, full_tokens
+        added_files[file_path] = outline
+        full_total += full_tokens
+        outline_total += outline_tokens
+        saved = f"{(full_tokens - outline_tokens) / full_tokens:.0%}" if full_tokens else "-"
+        table.add_row(file_path, str(full_tokens), str(outline_tokens), saved)
+    if len(contents) > 1:
+        saved = f"{(full_total - outline_total) / full_total:.0%}" if full_total else "-"
+        table.add_row("Total", str(full_total), str(outline_total), saved, style="bold")
+    if contents:
+        Console().print(table)
+        logging.info(f"以大綱添加 {len(contents)} 個文件: {full_total} -> {outline_total} tokens")
+    return len(contents)
+
+def expand_outline_requests(ai_response, added_files):
+    """Collect the source of every symbol the response asks for with an EXPAND line.
+
+    Only files that are in the context as outlines can be expanded, read
+    fresh from disk. Returns the follow-up message, or None without requests.
+    """
+    sections = []
+    for file_path, name in dict.fromkeys(EXPAND_REQUEST.findall(ai_response or "")):
+        file_path = file_path.strip()
+        if not is_outline(added_files.get(file_path)):
+            sections.append(f"{file_path}::{name}: not an outlined file in the context")
+            continue
+        content = read_text_file(file_path) if os.path.isfile(file_path) else None
+        found = find_symbol_source(file_path, content, name) if content is not None else None
+        if found:
+            source, first, last = found
+            print(colored(f"展開 {file_path}::{name} (第 {first}-{last} 行)", "cyan"))
+            sections.append(f"File: {file_path}, {name} (lines {first}-{last}):\n{source}")
+        else:
+            print(colored(f"找不到 {file_path}::{name}", "yellow"))
+            sections.append(f"{file_path}::{name}: not found")
+    return "Full source of the requested symbols:\n\n" + "\n\n".join(sections) if sections else None
+
+
+# Bookkeeping for the task that is currently running (used by batch mode)
+current_task = contextvars.ContextVar('current_task', default=None)
+_task_lock = threading.Lock()
+
+def record_changed_file(file_path):
+    task = current_task.get()
+    if task is not None:
+        with _task_lock:
+            if file_path not in task['files_changed']:
+                task['files_changed'].append(file_path)
+
+def record_task_usage(usage, retries):
+    task = current_task.get()
+    if task is not None:
+        with _task_lock:
+            task['usage']['calls'] += 1
+            task['usage']['retries'] += retries
+            for name in ('prompt_tokens', 'completion_tokens', 'cached_tokens'):
+                task['usage'][name] += (usage or {}).get(name, 0)
+
+# Set inside a background job of the interactive session (see start_job)
+current_job = contextvars.ContextVar('current_job', default=None)
+
+class JobCancelled(Exception):
+    """Raised in a background job once /cancel has been requested for it."""
+
+def check_cancelled():
+    job = current_job.get()
+    if job is not None and job['cancel'].is_set():
+        raise JobCancelled(f"背景工作 {job['id']} 已取消")
+
+def confirm(question, style=None):
+    """Ask a yes/no question, following the auto-approve policy in batch mode and background jobs."""
+    if AUTO_APPROVE:
+        logging.info(f"自動同意: {question}")
+        return True
+    if BATCH_MODE:
+        logging.info(f"批次模式未啟用 --auto-approve, 自動拒絕: {question}")
+        return False
+    if current_job.get() is not None:
+        print(colored(f"背景工作無法詢問, 已拒絕: {question.strip()} (請在前景重新執行或使用 --auto-approve)", "yellow"))
+        logging.info(f"背景工作未啟用 --auto-approve, 自動拒絕: {question}")
+        return False
+    return ask(question, style=style or {'prompt': 'orange'}).strip().lower() == 'yes'
+
+def ask(message, style=None, **kwargs):
+    """Read a line with prompt_toolkit, styled with a dict of style rules."""
+    from prompt_toolkit import prompt
+    from prompt_toolkit.styles import Style
+    return prompt(message, style=Style.from_dict(style or PROMPT_STYLE), **kwargs)
+
+def show_markdown(text):
+    if not BATCH_MODE:
+        from rich import print as rprint
+        from rich.markdown import Markdown
+        rprint(Markdown(text))
+
+@lru_cache(maxsize=64)  # A pending change is sent again with every request until the file is resent in full
+def unified_diff(old_content, new_content, file_path, context=None):
+    """Format the changes as a unified diff, using the same hunks as display_diff."""
+    old_lines, new_lines = old_content.splitlines(), new_content.splitlines()
+    hunks = group_hunks(diff_opcodes(old_lines, new_lines), context)
+    if not hunks:
+        return ""
+    lines = [f"--- a/{file_path}", f"+++ b/{file_path}"]
+    prefixes = {'': ' ', 'Removed': '-', 'Added': '+'}
+    for status, _, _, text in diff_rows(old_lines, new_lines, hunks):
+        lines.append(f"@@ {text} @@" if status == '@@' else prefixes[status] + text)
+    return "\n".join(lines) + "\n"
+
+class FileWatcher:
+    """Report which watched files changed since the last poll.
+
+    On Linux the parent folders are watched with inotify, read without
+    blocking when polled, so editors that save by renaming are noticed too.
+    Elsewhere, or when inotify is unavailable or its queue overflows, the
+    mtime and size of every watched file are compared instead.
+    """
+    IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+    IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_NONBLOCK, IN_CLOEXEC = 0o4000, 0o2000000
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, use_inotify=True):
+        self.signatures = {}  # Absolute path -> (mtime_ns, size) or None when missing
+        self.polled = set()  # Paths whose folder has no inotify watch
+        self.folders = {}  # Watch descriptor -> folder
+        self.watched_folders = set()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.fd = None
+        if use_inotify and sys.platform.startswith('linux'):
+            try:
+                import ctypes
+                import ctypes.util
+                self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+                self.get_errno = ctypes.get_errno
+                fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+                if fd >= 0:
+                    self.fd = fd
+            except (OSError, AttributeError) as e:
+                logging.info(f"inotify 無法使用, 改用輪詢: {e}")
+
+    @property
+    def method(self):
+        return 'inotify' if self.fd is not None else 'mtime polling'
+
+    @staticmethod
+    def _signature(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def watch(self, paths):
+        """Start watching paths; paths already watched are left alone.
+
+        Newly watched paths are reported by the next poll.
+        """
+        mask = self.IN_MODIFY | self.IN_ATTRIB | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        with self.lock:
             for path in paths:
-                if os.path.isfile(path):
-                    add_file_to_context(path, file_contents, action='to review')
-                elif os.path.isdir(path):
-                    for root, dirs, files_in_dir in os.walk(path):
-                        # Skip excluded directories
-                        dirs[:] = [d for d in dirs if d not in {'__pycache__', '.git', 'node_modules'}]
-                        for file in files_in_dir:
-                            file_path = os.path.join(root, file)
-                            add_file_to_context(file_path, file_contents, action='to review')
-                else:
-                    print(colored(f"錯誤: {path} 既不是文件也不是目錄。", "red"))
-                    logging.error(f"{path} 既不是文件也不是目錄。")
+                path = os.path.abspath(path)
+                if path in self.signatures:
+                    continue
+                self.signatures[path] = self._signature(path)
+                self.pending.add(path)  # It may have changed since it was read, so the first poll checks it
+                folder = os.path.dirname(path)
+                if self.fd is None:
+                    self.polled.add(path)
+                elif folder not in self.watched_folders:
+                    descriptor = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), mask)
+                    if descriptor < 0:
+                        logging.info(f"無法監看 {folder} ({os.strerror(self.get_errno())}), 改用輪詢")
+                        self.polled.add(path)
+                        continue
+                    self.folders[descriptor] = folder
+                    self.watched_folders.add(folder)
+
+    def unwatch_all(self):
+        with self.lock:
+            self.signatures.clear()
+            self.polled.clear()
+            self.pending.clear()
+            # Folder watches stay in place; events for unwatched files are ignored
+
+    def poll(self):
+        """Return the absolute paths of watched files that changed since the last poll."""
+        with self.lock:
+            reported, self.pending = self.pending, set()
+            events = set()
+            overflow = False
+            while self.fd is not None:
+                try:
+                    data = os.read(self.fd, 65536)
+                except BlockingIOError:
+                    break
+                offset = 0
+                while offset < len(data):
+                    descriptor, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+                    name = data[offset + self.EVENT_HEADER.size:offset + self.EVENT_HEADER.size + length].rstrip(b'\0')
+                    offset += self.EVENT_HEADER.size + length
+                    if mask & self.IN_Q_OVERFLOW:
+                        overflow = True
+                    elif descriptor in self.folders and name:
+                        path = os.path.join(self.folders[descriptor], os.fsdecode(name))
+                        if path in self.signatures:
+                            events.add(path)
+            # Events only say that something happened; the stat signature says whether it matters
+            for path in (self.signatures if overflow else self.polled | events):
+                signature = self._signature(path)
+                if signature != self.signatures[path]:
+                    self.signatures[path] = signature
+                    reported.add(path)
+            return reported
+
+file_watcher = None  # FileWatcher for the interactive session, created by main()
+_newer_contents = {}  # Path -> content on disk that differs from the copy in the file block
+_delta_lock = threading.Lock()
+
+def sync_context_files(added_files, rebase=False):
+    """Bring the added files in line with the disk and describe the changes.
 
-            if not file_contents:
-                print(colored("沒有有效的文件可以審查。", "red"))
+    The content in added_files is the version in the file block, so it stays
+    as it is for files whose unified diff against the new content is at most
+    DELTA_MAX_RATIO of the full file's tokens; the diff is returned instead,
+    always against that version, so each request is complete on its own.
+    Larger changes, deletions and outlines replace the file block copy, as
+    does rebase=True. Returns the text to send with the request, or "".
+    """
+    if file_watcher is None or not added_files or current_job.get() is not None:
+        return ""  # A background job works on a copy that was brought up to date when it started
+    notes = []
+    with _delta_lock:
+        file_watcher.watch(added_files)
+        changed = file_watcher.poll()
+        for file_path in list(added_files):
+            if os.path.abspath(file_path) not in changed:
                 continue
+            content = read_text_file(file_path) if os.path.isfile(file_path) else None
+            if content is None:
+                del added_files[file_path]
+                _newer_contents.pop(file_path, None)
+                notes.append(f"{file_path} was deleted and removed from the added files.")
+                print(colored(f"{file_path} 已被刪除, 已從上下文移除", "yellow"))
+                continue
+            if is_outline(added_files[file_path]):
+                added_files[file_path] = outline_file(file_path, content)
+            else:
+                _newer_contents[file_path] = content
+        diffs = []
+        for file_path, content in list(_newer_contents.items()):
+            baseline = added_files.get(file_path)
+            if baseline is None or baseline == content:
+                del _newer_contents[file_path]  # Removed, or added again from disk
+                continue
+            diff = unified_diff(baseline, content, file_path)
+            if rebase or estimate_tokens(diff) > DELTA_MAX_RATIO * estimate_tokens(content):
+                added_files[file_path] = content
+                del _newer_contents[file_path]
+                logging.info(f"{file_path} 變更較大, 重新傳送完整內容")
+            else:
+                diffs.append(diff)
+    if diffs:
+        print(colored(f"已變更的文件以差異傳送: {len(diffs)} 個", "cyan"))
+        notes.append("These added files changed on disk since the version shown in the added files. "
+                      "Their current content is that version with these diffs applied:\n\n" + "\n".join(diffs))
+    return "\n\n".join(notes)
 
-            review_request = f"{CODE_REVIEW_PROMPT}\n\nFiles to review:\n"
-            for file_path, content in file_contents.items():
-                review_request += f"\nFile: {file_path}\nContent:\n{content}\n\n"
+def reset_context_sync():
+    """Forget the watched files and pending changes, for /reset."""
+    with _delta_lock:
+        _newer_contents.clear()
+        if file_watcher is not None:
+            file_watcher.unwatch_all()
 
-            print(colored("分析程式碼並生成審查...", "magenta"))
-            ai_response = chat_with_ai(review_request, is_edit_request=False, added_files=added_files)
-            
-            if ai_response:
-                print()
-                print(colored("程式碼審查:", "blue"))
-                rprint(Markdown(ai_response))
-                logging.info("提供程式碼審查給請求的文件。")
-
-        elif user_input.startswith('/planning'):
-            planning_instruction = user_input[9:].strip()  # Remove '/planning' and leading/trailing whitespace
-            if not planning_instruction:
-                print(colored("請在 /planning 後提供計劃請求。", "red"))
-                logging.warning("用戶發送 /planning 而沒有指令。")
+
+def apply_modifications(new_content, file_path):
+    try:
+        with open(file_path, 'r') as file:
+            old_content = file.read()
+
+        if old_content.strip() == new_content.strip():
+            print(colored(f"在 {file_path} 中未檢測到更改", "red"))
+            return True
+
+        if not BATCH_MODE:
+            display_diff(old_content, new_content, file_path)
+
+        if confirm(f"Apply these changes to {file_path}? (yes/no): "):
+            with open(file_path, 'w') as file:
+                file.write(new_content)
+            record_changed_file(file_path)
+            print(colored(f"已成功將更改應用於 {file_path}.", "green"))
+            logging.info(f"已成功將更改應用於 {file_path}.")
+            return True
+        else:
+            print(colored(f"未將更改應用於 {file_path}.", "red"))
+            logging.info(f"用戶選擇不將更改應用於 {file_path}.")
+            return False
+
+    except Exception as e:
+        print(colored(f"在應用更改到 {file_path} 時發生錯誤: {e}", "red"))
+        logging.error(f"在應用更改到 {file_path} 時發生錯誤: {e}")
+        return False
+
+def content_digest(text):
+    """Return a short digest of text, used to detect unchanged content cheaply."""
+    return hashlib.blake2b(text.encode('utf-8', errors='surrogatepass'), digest_size=16).hexdigest()
+
+def _unique_matches(a, b, alo, ahi, blo, bhi):
+    """Return (i, j) for lines that occur exactly once in a[alo:ahi] and in b[blo:bhi], ordered by i."""
+    counts = {}
+    for i in range(alo, ahi):
+        entry = counts.get(a[i])
+        if entry is None:
+            counts[a[i]] = [1, i, 0, -1]
+        else:
+            entry[0] += 1
+    for j in range(blo, bhi):
+        entry = counts.get(b[j])
+        if entry is not None:
+            entry[2] += 1
+            entry[3] = j
+    return [(i, j) for count_a, i, count_b, j in counts.values() if count_a == 1 and count_b == 1]
+
+def _longest_increasing_matches(pairs):
+    """Patience sorting: the longest run of pairs whose j increases along with i."""
+    tails, tail_index = [], []
+    previous = [None] * len(pairs)
+    for k, (i, j) in enumerate(pairs):
+        pile = bisect.bisect_left(tails, j)
+        if pile:
+            previous[k] = tail_index[pile - 1]
+        if pile == len(tails):
+            tails.append(j)
+            tail_index.append(k)
+        else:
+            tails[pile] = j
+            tail_index[pile] = k
+    result = []
+    k = tail_index[-1] if tail_index else None
+    while k is not None:
+        result.append(pairs[k])
+        k = previous[k]
+    return result[::-1]
+
+def diff_opcodes(a, b):
+    """Patience diff of two lists of lines, returned like SequenceMatcher.get_opcodes().
+
+    Common prefixes and suffixes are trimmed and lines that are unique on both
+    sides are used as anchors. Ranges without anchors fall back to difflib when
+    they are small enough and are reported as one replacement otherwise, so
+    very large inputs never hit the quadratic path.
+    """
+    matches = []
+    pending = [(0, len(a), 0, len(b))]
+    while pending:
+        alo, ahi, blo, bhi = pending.pop()
+        start_a, start_b = alo, blo
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            alo += 1
+            blo += 1
+        if alo > start_a:
+            matches.append((start_a, start_b, alo - start_a))
+        end_a = ahi
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+        if ahi < end_a:
+            matches.append((ahi, bhi, end_a - ahi))
+        if alo == ahi or blo == bhi:
+            continue
+        anchors = _longest_increasing_matches(_unique_matches(a, b, alo, ahi, blo, bhi))
+        if anchors:
+            for i, j in anchors:
+                pending.append((alo, i, blo, j))
+                matches.append((i, j, 1))
+                alo, blo = i + 1, j + 1
+            pending.append((alo, ahi, blo, bhi))
+        elif (ahi - alo) * (bhi - blo) <= DIFF_QUADRATIC_LIMIT:
+            import difflib
+            matcher = difflib.SequenceMatcher(None, a[alo:ahi], b[blo:bhi], autojunk=False)
+            matches.extend((alo + i, blo + j, size) for i, j, size in matcher.get_matching_blocks() if size)
+
+    opcodes = []
+    i = j = 0
+    for match_a, match_b, size in sorted(matches) + [(len(a), len(b), 0)]:
+        if i < match_a and j < match_b:
+            opcodes.append(('replace', i, match_a, j, match_b))
+        elif i < match_a:
+            opcodes.append(('delete', i, match_a, j, match_b))
+        elif j < match_b:
+            opcodes.append(('insert', i, match_a, j, match_b))
+        if size:
+            if opcodes and opcodes[-1][0] == 'equal':
+                tag, i1, i2, j1, j2 = opcodes.pop()
+                opcodes.append((tag, i1, match_a + size, j1, match_b + size))
+            else:
+                opcodes.append(('equal', match_a, match_a + size, match_b, match_b + size))
+        i, j = match_a + size, match_b + size
+    return opcodes
+
+def group_hunks(opcodes, context=None):
+    """Group opcodes into hunks with up to context unchanged lines around each change."""
+    n = DIFF_CONTEXT_LINES if context is None else context
+    codes = list(opcodes)
+    if not codes or (len(codes) == 1 and codes[0][0] == 'equal'):
+        return []
+    if codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+    hunks, group = [], []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal' and i2 - i1 > 2 * n:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            hunks.append(group)
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        hunks.append(group)
+    return hunks
+
+def diff_rows(a, b, hunks):
+    """Yield (status, old line number, new line number, text) rows for the hunks."""
+    for hunk in hunks:
+        i1, j1 = hunk[0][1], hunk[0][3]
+        i2, j2 = hunk[-1][2], hunk[-1][4]
+        yield '@@', '', '', f"-{i1 + 1},{i2 - i1} +{j1 + 1},{j2 - j1}"
+        for tag, i1, i2, j1, j2 in hunk:
+            if tag == 'equal':
+                for offset in range(i2 - i1):
+                    yield '', str(i1 + offset + 1), str(j1 + offset + 1), a[i1 + offset]
                 continue
-            planning_request = f"{PLANNING_PROMPT}\n\nUser request: {planning_instruction}"
-            ai_response = chat_with_ai(planning_request, is_edit_request=False, added_files=added_files)
-            if ai_response:
-                print()
-                print(colored("軟體工程師: 以下是你的詳細計劃:", "blue"))
-                rprint(Markdown(ai_response))
-                logging.info("提供計劃回應給用戶。")
+            for i in range(i1, i2):
+                yield 'Removed', str(i + 1), '', a[i]
+            for j in range(j1, j2):
+                yield 'Added', '', str(j + 1), b[j]
+
+DIFF_ROW_STYLES = {'@@': 'cyan', '': 'dim', 'Removed': 'red', 'Added': 'green'}
+
+@timed_phase('diff_render')
+def display_diff(old_content, new_content, file_path):
+    """Show the changes as hunks with old and new line numbers, DIFF_MAX_ROWS rows per page."""
+    if content_digest(old_content) == content_digest(new_content):
+        print(f"在 {file_path} 中未檢測到更改")
+        return
+    old_lines, new_lines = old_content.splitlines(), new_content.splitlines()
+    with phase_timer('diff_compute'):
+        hunks = group_hunks(diff_opcodes(old_lines, new_lines))
+    if not hunks:
+        print(f"在 {file_path} 中未檢測到更改")
+        return
+    total_rows = removed = added = 0
+    for hunk in hunks:
+        total_rows += 1
+        for tag, i1, i2, j1, j2 in hunk:
+            total_rows += (i2 - i1) + (j2 - j1) if tag != 'equal' else i2 - i1
+            if tag != 'equal':
+                removed += i2 - i1
+                added += j2 - j1
+
+    from rich.console import Console
+    from rich.table import Table
+    console = Console()
+    rows = diff_rows(old_lines, new_lines, hunks)
+    shown = 0
+    while True:
+        table = Table(title=f"Diff for {file_path}" if not shown else None, show_header=not shown)
+        table.add_column("Status", style="bold")
+        table.add_column("Old", justify="right")
+        table.add_column("New", justify="right")
+        table.add_column("Content", no_wrap=True, overflow="ellipsis")
+        for status, old_number, new_number, text in islice(rows, DIFF_MAX_ROWS):
+            table.add_row(status, old_number, new_number, text, style=DIFF_ROW_STYLES[status])
+            shown += 1
+        console.print(table)
+        if shown >= total_rows:
+            break
+        if BATCH_MODE or AUTO_APPROVE or current_job.get() is not None:
+            print(colored(f"... 另外 {total_rows - shown} 行差異未顯示", "yellow"))
+            break
+        answer = ask(f"已顯示 {shown}/{total_rows} 行差異。按 Enter 顯示更多, 輸入 q 略過: ", style=PROMPT_STYLE)
+        if answer.strip().lower() == 'q':
+            break
+    print(colored(f"{file_path}: {len(hunks)} 個區塊, +{added} -{removed}", "cyan"))
+
+CREATION_HEADER = re.compile(r'### (FILE|FOLDER): (.+)')
+
+class CreationStreamParser:
+    """Incremental parser for the ### FILE: / ### FOLDER: blocks of /create.
+
+    Text can be fed in chunks of any size as it streams in. Only the
+    unfinished line and the lines of the file being read are kept, and every
+    character is split into lines once. feed() and close() return the blocks
+    completed so far as (item_type, path, content) tuples; content is None
+    for folders.
+    """
+
+    def __init__(self):
+        self.pending = []  # Pieces of the unfinished line
+        self.state = 'outside'  # outside -> header -> body (files) or skip (folders, unknown blocks)
+        self.item_type = None
+        self.path = None
+        self.lines = []
+        self.invalid = 0
+
+    def feed(self, text):
+        if '\n' not in text:
+            self.pending.append(text)
+            return []
+        lines = text.split('\n')
+        self.pending.append(lines[0])
+        lines[0] = "".join(self.pending)
+        self.pending = [lines.pop()]
+        completed = []
+        for line in lines:
+            block = self._feed_line(line)
+            if block:
+                completed.append(block)
+        return completed
+
+    def close(self):
+        """Finish the stream; a block without its closing fence is dropped."""
+        completed = self.feed('\n')
+        self.pending = []
+        if self.state in ('header', 'body') or (self.state == 'skip' and self.item_type):
+            print(colored(f"警告: 回應在區塊結束前中斷, 已略過 {self.path or '未命名的區塊'}", "yellow"))
+            logging.warning(f"回應在區塊結束前中斷, 已略過 {self.path}")
+        self._reset()
+        return completed
+
+    def _reset(self):
+        self.state = 'outside'
+        self.item_type = self.path = None
+        self.lines = []
+
+    def _invalid(self):
+        self.invalid += 1
+        print(colored("錯誤: 無法從程式碼區塊中確定檔案或資料夾資訊。", "red"))
+        logging.error("無法從程式碼區塊中確定檔案或資料夾資訊。")
+
+    def _finish(self):
+        if self.item_type == 'FILE':
+            block = ('FILE', self.path, "\n".join(self.lines).strip())
+        elif self.item_type == 'FOLDER':
+            block = ('FOLDER', self.path, None)
+        else:
+            block = None
+        self._reset()
+        return block
+
+    def _feed_line(self, line):
+        stripped = line.strip()
+        if self.state == 'outside':
+            if stripped.startswith('```'):
+                self.state = 'header'
+                # The header may follow the fence and language on the same line
+                rest = re.sub(r'^\w*', '', stripped[3:]).strip()
+                if rest:
+                    return self._feed_line(rest)
+            return None
+        if self.state == 'header':
+            if not stripped:
+                return None
+            if stripped.startswith('```'):
+                self._invalid()
+                self._reset()
+                return None
+            closed = stripped.endswith('```')
+            if closed:
+                stripped = stripped[:-3].rstrip()
+            match = CREATION_HEADER.match(stripped)
+            if not match:
+                self._invalid()
             else:
-                print(colored("生成計劃回應失敗。請再試一次。", "red"))
-                logging.error("AI 生成計劃回應失敗。")
+                self.item_type, self.path = match.group(1), match.group(2).strip()
+            self.state = 'body' if self.item_type == 'FILE' else 'skip'
+            return self._finish() if closed else None
+        if self.state == 'body':
+            if stripped.startswith('```'):
+                return self._finish()
+            if stripped.endswith('```'):
+                self.lines.append(line.rstrip()[:-3])
+                return self._finish()
+            self.lines.append(line)
+            return None
+        # skip: wait for the closing fence of a folder or unrecognised block
+        if stripped.startswith('```') or stripped.endswith('```'):
+            return self._finish()
+        return None
+
+def create_folder(path):
+    os.makedirs(path, exist_ok=True)
+    print(colored(f"創建資料夾: {path}", "green"))
+    logging.info(f"創建資料夾: {path}")
+
+def write_created_file(path, content=None, staged_path=None):
+    """Create path from content, or by moving a staged copy into place."""
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        create_folder(directory)
+    if staged_path is not None:
+        shutil.move(staged_path, path)
+    else:
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+    record_changed_file(path)
+    print(colored(f"創建檔案: {path}", "green"))
+    logging.info(f"創建檔案: {path}")
+
+def stage_creation_block(block, staging_dir=None):
+    """Create a parsed block right away, or write it to staging_dir to await approval.
 
+    Returns (item_type, path, staged_path) for commit_staged_creations.
+    """
+    item_type, path, content = block
+    if staging_dir is None:
+        if item_type == 'FOLDER':
+            create_folder(path)
         else:
-            ai_response = chat_with_ai(user_input, added_files=added_files)
-            if ai_response:
-                print()
-                print(colored("軟體工程師:", "blue"))
-                rprint(Markdown(ai_response))
-                logging.info("提供 AI 回應給用戶查詢。")
+            write_created_file(path, content)
+        return item_type, path, None
+    if item_type == 'FOLDER':
+        print(colored(f"待創建資料夾: {path}", "cyan"))
+        return item_type, path, None
+    fd, staged_path = tempfile.mkstemp(dir=staging_dir)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(content)
+    print(colored(f"已暫存檔案: {path}", "cyan"))
+    logging.info(f"已暫存檔案: {path} -> {staged_path}")
+    return item_type, path, staged_path
+
+def commit_staged_creations(staged):
+    for item_type, path, staged_path in staged:
+        if item_type == 'FOLDER':
+            create_folder(path)
+        else:
+            write_created_file(path, staged_path=staged_path)
+
+def apply_creation_steps(creation_response, added_files, retry_count=0):
+    max_retries = 3
+    try:
+        parser = CreationStreamParser()
+        blocks = parser.feed(creation_response) + parser.close()
+        if not blocks:
+            raise ValueError("在 AI 回應中未找到程式碼區塊。")
+
+        print("成功提取程式碼區塊:")
+        logging.info("成功從創建回應中提取程式碼區塊。")
+
+        for block in blocks:
+            stage_creation_block(block)
+
+        return True
+
+    except ValueError as e:
+        if retry_count < max_retries:
+            print(colored(f"錯誤: {str(e)} 重試... (嘗試 {retry_count + 1})", "red"))
+            logging.warning(f"創建解析失敗: {str(e)}. 重試... (嘗試 {retry_count + 1})")
+            error_message = f"{str(e)} 請再次提供使用指定格式的創建指令。"
+            new_response = chat_with_ai(error_message, is_edit_request=False, added_files=added_files, system_prompt=CREATE_SYSTEM_PROMPT, call_type='create')
+            if new_response:
+                return apply_creation_steps(new_response, added_files, retry_count + 1)
+            else:
+                return False
+        else:
+            print(colored(f"創建回應失敗: {str(e)}", "red"))
+            logging.error(f"創建回應失敗: {str(e)}")
+            print("創建回應失敗:")
+            print(creation_response)
+            return False
+    except Exception as e:
+        print(colored(f"創建回應失敗: {e}", "red"))
+        logging.error(f"創建回應失敗: {e}")
+        return False
+
+
+
+class EditInstructionStreamParser:
+    """Incremental parser for "File: path" sections of edit instruction responses.
+
+    A section is complete when the next "File:" line arrives or the stream
+    ends, so rewrites can start while the rest of the response streams in.
+    feed() and close() return completed (file_path, instructions) pairs. By
+    default blank lines are dropped and lines stripped; keep_lines keeps the
+    section verbatim for SEARCH/REPLACE blocks.
+    """
+
+    def __init__(self, keep_lines=False):
+        self.keep_lines = keep_lines
+        self.pending = []
+        self.current_file = None
+        self.current_lines = []
+
+    def feed(self, text):
+        if '\n' not in text:
+            self.pending.append(text)
+            return []
+        lines = text.split('\n')
+        self.pending.append(lines[0])
+        lines[0] = "".join(self.pending)
+        self.pending = [lines.pop()]
+        completed = []
+        for line in lines:
+            if line.startswith("File: "):
+                if self.current_file:
+                    completed.append(self._section())
+                self.current_file = line[6:].strip()
+                self.current_lines = []
+            elif self.current_file and self.keep_lines:
+                self.current_lines.append(line)
+            elif line.strip() and self.current_file:
+                self.current_lines.append(line.strip())
+        return completed
+
+    def close(self):
+        completed = self.feed('\n')
+        self.pending = []
+        if self.current_file:
+            completed.append(self._section())
+            self.current_file = None
+        return completed
+
+    def _section(self):
+        text = "\n".join(self.current_lines)
+        return self.current_file, text.strip('\n') if self.keep_lines else text
+
+def parse_edit_instructions(response):
+    parser = EditInstructionStreamParser()
+    return dict(parser.feed(response) + parser.close())
+
+def parse_search_replace_blocks(response):
+    """Extract (search, replace) pairs from a SEARCH/REPLACE formatted response."""
+    blocks = []
+    state = None
+    search_lines, replace_lines = [], []
+    for line in response.splitlines():
+        marker = line.strip()
+        if state is None:
+            if re.match(r'^<{5,} ?SEARCH$', marker):
+                state = 'search'
+                search_lines, replace_lines = [], []
+        elif state == 'search':
+            if re.match(r'^={5,}$', marker):
+                state = 'replace'
+            else:
+                search_lines.append(line)
+        elif state == 'replace':
+            if re.match(r'^>{5,} ?REPLACE$', marker):
+                blocks.append(("\n".join(search_lines), "\n".join(replace_lines)))
+                state = None
+            else:
+                replace_lines.append(line)
+    if state is not None:
+        raise ValueError("SEARCH/REPLACE 區塊不完整。")
+    return blocks
+
+def _find_lines(lines, search_lines, start, normalize):
+    """Return the index where search_lines matches lines, preferring matches after start."""
+    target = [normalize(line) for line in search_lines]
+    normalized = [normalize(line) for line in lines]
+    last = len(lines) - len(target)
+    for i in list(range(start, last + 1)) + list(range(0, min(start, last + 1))):
+        if normalized[i:i + len(target)] == target:
+            return i
+    return -1
+
+def _leading_whitespace(line):
+    return line[:len(line) - len(line.lstrip())]
+
+def apply_search_replace_blocks(content, blocks):
+    """Apply SEARCH/REPLACE blocks to content.
+
+    Each block is matched exactly first (ignoring trailing whitespace) and then
+    with all whitespace collapsed, re-indenting the replacement when the model's
+    indentation drifted. Raises ValueError when a block cannot be placed.
+    """
+    newline = "\r\n" if "\r\n" in content else "\n"
+    lines = content.splitlines()
+    trailing_newline = content.endswith(("\n", "\r"))
+    position = 0
+    for index, (search, replace) in enumerate(blocks, start=1):
+        search_lines = search.splitlines()
+        replace_lines = replace.splitlines()
+        while search_lines and not search_lines[0].strip():
+            search_lines.pop(0)
+        while search_lines and not search_lines[-1].strip():
+            search_lines.pop()
+        if not search_lines:
+            if lines:
+                raise ValueError(f"第 {index} 個區塊的 SEARCH 內容為空。")
+            lines = replace_lines
+            continue
+
+        match = _find_lines(lines, search_lines, position, str.rstrip)
+        if match < 0:
+            match = _find_lines(lines, search_lines, position, lambda line: " ".join(line.split()))
+            if match < 0:
+                raise ValueError(f"第 {index} 個區塊無法在檔案中找到對應內容。")
+            # Shift the replacement by the indentation difference of the anchor line
+            expected = _leading_whitespace(search_lines[0])
+            actual = _leading_whitespace(lines[match])
+            if expected != actual:
+                replace_lines = [
+                    actual + line[len(expected):] if line.startswith(expected) and line.strip() else line
+                    for line in replace_lines
+                ]
+
+        lines[match:match + len(search_lines)] = replace_lines
+        position = match + len(replace_lines)
+
+    new_content = newline.join(lines)
+    if trailing_newline and lines:
+        new_content += newline
+    return new_content
+
+def rewrite_file(file_path, content, instructions):
+    if EDIT_FORMAT == 'diff':
+        prompt = f"Original File: {file_path}\nContent:\n{content}\n\nEdit Instructions:\n{instructions}\n\nSEARCH/REPLACE blocks:"
+        response = chat_with_ai(prompt, is_edit_request=True, system_prompt=APPLY_DIFF_EDITS_PROMPT, call_type='rewrite')
+        if response:
+            try:
+                blocks = parse_search_replace_blocks(response)
+                if not blocks:
+                    raise ValueError("回應中沒有 SEARCH/REPLACE 區塊。")
+                return apply_search_replace_blocks(content, blocks)
+            except ValueError as e:
+                print(colored(f"無法套用 {file_path} 的差異編輯 ({e}), 改為重寫整個文件...", "yellow"))
+                logging.warning(f"無法套用 {file_path} 的差異編輯: {e}")
+
+    prompt = f"Original File: {file_path}\nContent:\n{content}\n\nEdit Instructions:\n{instructions}\n\nUpdated File Content:"
+    response = chat_with_ai(prompt, is_edit_request=True, system_prompt=APPLY_EDITS_PROMPT, call_type='rewrite')
+    if not response:
+        raise RuntimeError("AI 沒有回傳內容")
+    return response.strip()
+
+def collect_rewrites(futures):
+    """Wait for rewrite futures ({future: file_path}), reporting each file as it finishes."""
+    results = {}
+    for done, future in enumerate(as_completed(futures), start=1):
+        file_path = futures[future]
+        try:
+            results[file_path] = future.result()
+            print(colored(f"[{done}/{len(futures)}] 已完成改寫 {file_path}", "green"))
+        except Exception as e:
+            print(colored(f"[{done}/{len(futures)}] 改寫 {file_path} 時發生錯誤: {e}", "red"))
+            logging.error(f"改寫 {file_path} 時發生錯誤: {e}")
+    return results
+
+def merge_rewrites(original_files, pending, results):
+    """Order rewritten files like original_files, leaving out files whose rewrite failed."""
+    modified_files = {}
+    for file_path, content in original_files.items():
+        if file_path in pending:
+            if file_path in results:
+                modified_files[file_path] = results[file_path]
+        else:
+            modified_files[file_path] = content  # No changes for this file
+    return modified_files
+
+def apply_edit_instructions(edit_instructions, original_files, max_workers=None):
+    """Rewrite every file that has instructions concurrently.
+
+    Results keep the order of original_files. A file whose rewrite fails is
+    left out of the result so the others can still be applied.
+    """
+    pending = {file_path: content for file_path, content in original_files.items() if file_path in edit_instructions}
+    results = {}
+    if pending:
+        workers = min(max_workers or MAX_WORKERS, len(pending))
+        print(colored(f"正在並行改寫 {len(pending)} 個文件 (最多 {workers} 個同時進行)...", "magenta"))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(contextvars.copy_context().run, rewrite_file, file_path, content, edit_instructions[file_path]): file_path
+                for file_path, content in pending.items()
+            }
+            results = collect_rewrites(futures)
+    return merge_rewrites(original_files, pending, results)
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    """Return the tiktoken encoding, or None when tiktoken is not installed."""
+    try:
+        import tiktoken
+    except ImportError:  # Fall back to a byte-based estimate
+        return None
+    return tiktoken.get_encoding("cl100k_base")
+
+_token_counts = {}  # (length, digest) -> tokens, so the cache does not keep file-sized strings alive
+TOKEN_COUNT_CACHE_SIZE = 4096
+
+def estimate_tokens(text):
+    """Count tokens with tiktoken when available, otherwise estimate from the UTF-8 size."""
+    if not text:
+        return 0
+    data = text.encode('utf-8', errors='surrogatepass')
+    encoding = _get_encoding()
+    if encoding is None:
+        return len(data) // 3 + 1
+    key = (len(data), hashlib.blake2b(data, digest_size=16).digest())
+    tokens = _token_counts.get(key)
+    if tokens is not None:
+        return tokens
+    try:
+        tokens = len(encoding.encode(text, disallowed_special=()))
+    except Exception as e:
+        logging.warning(f"tiktoken 計算失敗, 改用估算: {e}")
+        return len(data) // 3 + 1
+    if len(_token_counts) >= TOKEN_COUNT_CACHE_SIZE:
+        _token_counts.pop(next(iter(_token_counts)), None)  # Oldest entry first
+    _token_counts[key] = tokens
+    return tokens
+
+def get_context_budget(model=None):
+    """Return the number of prompt tokens available for the given model."""
+    if CONTEXT_BUDGET:
+        return CONTEXT_BUDGET
+    model = (model or MODEL).lower()
+    window = DEFAULT_CONTEXT_WINDOW
+    matches = [prefix for prefix in MODEL_CONTEXT_WINDOWS if model.startswith(prefix)]
+    if matches:
+        window = MODEL_CONTEXT_WINDOWS[max(matches, key=len)]
+    return max(window - MAX_OUTPUT_TOKENS, window // 2)
+
+def route_budget(call_type):
+    """The context budget of a call type: the smallest budget among the models it may be sent to."""
+    return min(get_context_budget(model) for model in route_tier(call_type)[1])
+
+def format_file_context(files):
+    """Render files in path order so the block is byte-stable across turns."""
+    file_context = "Added files:\n"
+    for file_path in sorted(files):
+        file_context += f"File: {file_path}\nContent:\n{files[file_path]}\n\n"
+    if any(is_outline(content) for content in files.values()):
+        file_context += OUTLINE_NOTE + "\n\n"
+    return file_context
+
+def _message_content(text, cache_breakpoint=False):
+    if cache_breakpoint and PROMPT_CACHE:
+        return [{"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}]
+    return text
+
+def build_messages(user_message, system_prompt=None, files=None, history=()):
+    """Lay out messages from the most to the least stable part.
+
+    The system prompt comes first, then the file block, then earlier turns as
+    alternating user/assistant messages and finally the new request, so that
+    provider-side prompt caching can reuse the shared prefix between turns.
+    """
+    messages = []
+    if system_prompt:
+        messages.append({"role": "system", "content": _message_content(system_prompt, cache_breakpoint=True)})
+    if files:
+        messages.append({"role": "user", "content": _message_content(format_file_context(files), cache_breakpoint=True)})
+        messages.append({"role": "assistant", "content": FILE_CONTEXT_ACK})
+    for i, msg in enumerate(history):
+        messages.append({"role": "user" if i % 2 == 0 else "assistant", "content": msg})
+    messages.append({"role": "user", "content": user_message})
+    return messages
+
+def extract_usage(usage):
+    """Normalise token usage, including cached prompt tokens from OpenAI or Anthropic style fields."""
+    if usage is None:
+        return None
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached = getattr(details, 'cached_tokens', None) if details is not None else None
+    if cached is None:
+        cached = getattr(usage, 'cache_read_input_tokens', None)
+    return {
+        'prompt_tokens': getattr(usage, 'prompt_tokens', None) or 0,
+        'completion_tokens': getattr(usage, 'completion_tokens', None) or 0,
+        'cached_tokens': cached or 0,
+    }
+
+@timed_phase('context_build')
+def build_context(user_message, added_files, history, fixed_text="", budget=None):
+    """Fit added files and history into the model's token budget.
+
+    The oldest history turns are evicted first, down to the newest exchange,
+    then the files with the lowest priority. Files mentioned in the request
+    are kept longest, otherwise more recently added files win. A file that
+    still does not fit is truncated, so one large file does not push out the
+    newest exchange. Older turns that fit again once files are dropped are
+    put back. Returns the kept files, the kept history and a report of the
+    token usage.
+    """
+    budget = budget or get_context_budget()
+    fixed_tokens = estimate_tokens(fixed_text) + estimate_tokens(user_message)
+    file_tokens = {file_path: estimate_tokens(f"File: {file_path}\nContent:\n{content}\n\n") for file_path, content in added_files.items()}
+    turn_tokens = [estimate_tokens(msg) for msg in history]
+    files = dict(added_files)
+    start = 0  # Index of the oldest history entry that is kept
+    dropped_files = []
+
+    def total():
+        return fixed_tokens + sum(file_tokens[path] for path in files) + sum(turn_tokens[start:])
+
+    # Evict the oldest turns (user + AI pairs) first, keeping the newest exchange for now
+    newest = max(len(history) - 2, 0)
+    while start < newest and total() > budget:
+        start += 2
+
+    # Then evict files, lowest priority first
+    def priority(item):
+        index, file_path = item
+        mentioned = file_path in user_message or os.path.basename(file_path) in user_message
+        return (mentioned, index)
+
+    for _, file_path in sorted(enumerate(list(files)), key=priority):
+        if total() <= budget or len(files) == 1:
+            break
+        del files[file_path]
+        dropped_files.append(f"{file_path} ({file_tokens[file_path]} tokens)")
+
+    # The newest exchange only gives way when it cannot fit even without files
+    if fixed_tokens + sum(turn_tokens[start:]) > budget:
+        start = len(history)
+
+    # Truncate the last remaining file if it alone is too large
+    if files and total() > budget:
+        file_path = next(iter(files))
+        available = budget - (total() - file_tokens[file_path])
+        content = files[file_path]
+        keep = int(len(content) * available / file_tokens[file_path]) if available > 0 else 0
+        while keep > 0:
+            truncated = content[:keep] + "\n... [內容因超出上下文預算而被截斷]"
+            tokens = estimate_tokens(f"File: {file_path}\nContent:\n{truncated}\n\n")
+            if tokens <= available:
+                break
+            keep = min(keep - 1, int(keep * available / tokens))  # The estimate is not linear, shrink until it fits
+        if keep > 0:
+            files[file_path] = truncated
+            file_tokens[file_path] = tokens
+            dropped_files.append(f"{file_path} 的後半部分 ({len(content) - keep} 字元)")
+        else:
+            del files[file_path]
+            dropped_files.append(f"{file_path} ({file_tokens[file_path]} tokens)")
+
+    # Put back the newest evicted turns that fit now that files are gone
+    while start >= 2 and total() + sum(turn_tokens[start - 2:start]) <= budget:
+        start -= 2
+
+    dropped = [f"最舊的對話 ({sum(turn_tokens[index:index + 2])} tokens)" for index in range(0, start, 2)] + dropped_files
+
+    report = {
+        'budget': budget,
+        'fixed': fixed_tokens,
+        'history': sum(turn_tokens[start:]),
+        'history_turns': (len(history) - start + 1) // 2,
+        'files': {file_path: file_tokens[file_path] for file_path in files},
+        'total': total(),
+        'dropped': dropped,
+    }
+    return files, history[start:], report
+
+def display_context_breakdown(added_files):
+    """Show how the current context would use the token budget."""
+    from rich.console import Console
+    from rich.table import Table
+    _, _, report = build_context("", added_files, session_history(), budget=route_budget('chat'))
+    console = Console()
+    table = Table(title=f"Context budget for {', '.join(route_tier('chat')[1])}")
+    table.add_column("Item")
+    table.add_column("Tokens", justify="right")
+    table.add_row(f"History ({report['history_turns']} turns)", str(report['history']))
+    for file_path, tokens in report['files'].items():
+        table.add_row(file_path, str(tokens))
+    table.add_row("Total", str(report['total']), style="bold")
+    table.add_row("Budget", str(report['budget']), style="bold")
+    table.add_row("Remaining", str(report['budget'] - report['total']), style="green" if report['total'] <= report['budget'] else "red")
+    console.print(table)
+    if report['dropped']:
+        print(colored("超出預算, 下次請求時將省略: " + ", ".join(report['dropped']), "yellow"))
+    method = "tiktoken" if _get_encoding() is not None else "位元組估算"
+    print(colored(f"Token 計算方式: {method}", "dark_grey"))
+
+_cache_lock = threading.Lock()
+_cache_connection = None
+cache_hits = 0
+cache_misses = 0
+
+def get_cache_connection():
+    global _cache_connection
+    if _cache_connection is None:
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        _cache_connection = sqlite3.connect(CACHE_PATH, check_same_thread=False)
+        _cache_connection.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        _cache_connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        _cache_connection.commit()
+    return _cache_connection
+
+def cache_key(model, messages, params):
+    """Hash the model, the full message payload and the generation parameters."""
+    payload = json.dumps({'model': model, 'messages': messages, 'params': params}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def cache_get(key):
+    """Return the cached response for key, or None when missing or expired."""
+    global cache_hits, cache_misses
+    now = time.time()
+    with _cache_lock:
+        connection = get_cache_connection()
+        row = connection.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+        if row and now - row[1] <= CACHE_TTL:
+            connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            connection.commit()
+            cache_hits += 1
+            return row[0]
+        if row:
+            connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            connection.commit()
+        cache_misses += 1
+        return None
+
+def cache_put(key, model, response):
+    """Store a response and evict the least recently used entries above CACHE_MAX_BYTES."""
+    now = time.time()
+    size = len(response.encode('utf-8'))
+    with _cache_lock:
+        connection = get_cache_connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO responses (key, model, response, size, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+            (key, model, response, size, now, now)
+        )
+        connection.execute("DELETE FROM responses WHERE created_at < ?", (now - CACHE_TTL,))
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total > CACHE_MAX_BYTES:
+            rows = connection.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall()
+            evicted = []
+            for old_key, old_size in rows:
+                if total <= CACHE_MAX_BYTES:
+                    break
+                evicted.append((old_key,))
+                total -= old_size
+            connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+            logging.info(f"快取超出大小上限, 已移除 {len(evicted)} 筆最久未使用的回應。")
+        connection.commit()
+
+def cache_clear():
+    with _cache_lock:
+        connection = get_cache_connection()
+        count = connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        connection.execute("DELETE FROM responses")
+        connection.commit()
+        connection.execute("VACUUM")
+    return count
+
+def cache_stats():
+    with _cache_lock:
+        count, size = get_cache_connection().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+    return {'entries': count, 'bytes': size, 'hits': cache_hits, 'misses': cache_misses}
+
+_index_lock = threading.Lock()
+_index_connection = None
+_index_documents = {}  # Root -> {path: (mtime_ns, size, length, terms, symbols, path_terms)}
+_index_df = {}  # Root -> {term: number of documents containing it}
+
+WORD_PATTERN = re.compile(r'[A-Za-z0-9_]+')
+SUBWORD_PATTERN = re.compile(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+')
+SYMBOL_PATTERN = re.compile(r'\b(?:def|class|function|func|fn|interface|struct|enum|trait|type|module)\s+([A-Za-z_][A-Za-z0-9_]*)')
+INDEX_STOPWORDS = {
+    'the', 'and', 'for', 'with', 'this', 'that', 'from', 'into', 'are', 'was', 'not', 'but', 'you', 'all',
+    'can', 'has', 'have', 'will', 'please', 'file', 'files', 'code', 'add', 'use', 'make', 'self', 'none', 'true',
+    'false', 'return', 'import', 'def', 'class', 'if', 'else', 'in', 'is', 'of', 'to', 'it', 'on', 'or', 'an', 'be',
+}
+
+def tokenize_for_index(text):
+    """Split text into lowercase identifier tokens, including camelCase and snake_case parts."""
+    tokens = []
+    for word in WORD_PATTERN.findall(text):
+        parts = [part.lower() for part in SUBWORD_PATTERN.findall(word)]
+        lowered = word.lower().strip('_')
+        if len(parts) > 1 and lowered not in INDEX_STOPWORDS:
+            tokens.append(lowered)
+        tokens.extend(part for part in parts if len(part) > 1 and part not in INDEX_STOPWORDS)
+    return tokens
+
+def index_document(file_path, content):
+    """Return (length, term frequencies, symbol tokens, path tokens) for one file."""
+    terms = {}
+    tokens = tokenize_for_index(content)
+    for token in tokens:
+        terms[token] = terms.get(token, 0) + 1
+    symbols = set()
+    for name in SYMBOL_PATTERN.findall(content):
+        symbols.update(tokenize_for_index(name))
+    return len(tokens), terms, symbols, set(tokenize_for_index(file_path))
+
+def get_index_connection():
+    global _index_connection
+    if _index_connection is None:
+        os.makedirs(os.path.dirname(RETRIEVAL_INDEX_PATH), exist_ok=True)
+        _index_connection = sqlite3.connect(RETRIEVAL_INDEX_PATH, check_same_thread=False)
+        _index_connection.execute("""
+            CREATE TABLE IF NOT EXISTS documents (
+                root TEXT NOT NULL,
+                path TEXT NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                terms TEXT NOT NULL,
+                symbols TEXT NOT NULL,
+                PRIMARY KEY (root, path)
+            )
+        """)
+        _index_connection.commit()
+    return _index_connection
+
+def _index_file(file_path):
+    try:
+        content = read_text_file(file_path) if os.path.getsize(file_path) <= RETRIEVAL_MAX_FILE_BYTES else None
+    except OSError:
+        content = None
+    return index_document(file_path, content or "")
+
+def _count_terms(df, terms, delta):
+    for term in terms:
+        count = df.get(term, 0) + delta
+        if count > 0:
+            df[term] = count
+        else:
+            df.pop(term, None)
+
+@timed_phase('index_update')
+def update_retrieval_index(root='.'):
+    """Bring the index of root up to date, re-reading only files whose mtime or size changed.
+
+    Returns the number of files that were (re)indexed and removed.
+    """
+    key = os.path.abspath(root)
+    with _index_lock:
+        connection = get_index_connection()
+        if key not in _index_documents:
+            documents, df = {}, {}
+            for path, mtime_ns, size, length, terms, symbols in connection.execute(
+                    "SELECT path, mtime_ns, size, length, terms, symbols FROM documents WHERE root = ?", (key,)):
+                terms = json.loads(terms)
+                documents[path] = (mtime_ns, size, length, terms, set(json.loads(symbols)), set(tokenize_for_index(path)))
+                _count_terms(df, terms, 1)
+            _index_documents[key], _index_df[key] = documents, df
+        documents, df = _index_documents[key], _index_df[key]
+
+        seen, changed = set(), []
+        for file_path in walk_files(root):
+            path = os.path.normpath(os.path.relpath(file_path, root))
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            seen.add(path)
+            entry = documents.get(path)
+            if entry is None or entry[0] != stat.st_mtime_ns or entry[1] != stat.st_size:
+                changed.append((path, file_path, stat))
+        removed = [path for path in documents if path not in seen]
+
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS * 4) as executor:
+            indexed = list(executor.map(lambda item: _index_file(item[1]), changed))
+        rows = []
+        for (path, _, stat), (length, terms, symbols, path_terms) in zip(changed, indexed):
+            if path in documents:
+                _count_terms(df, documents[path][3], -1)
+            _count_terms(df, terms, 1)
+            documents[path] = (stat.st_mtime_ns, stat.st_size, length, terms, symbols, path_terms)
+            rows.append((key, path, stat.st_mtime_ns, stat.st_size, length, json.dumps(terms), json.dumps(sorted(symbols))))
+        for path in removed:
+            _count_terms(df, documents.pop(path)[3], -1)
+        if rows or removed:
+            connection.executemany("INSERT OR REPLACE INTO documents (root, path, mtime_ns, size, length, terms, symbols) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            connection.executemany("DELETE FROM documents WHERE root = ? AND path = ?", [(key, path) for path in removed])
+            connection.commit()
+            logging.info(f"索引更新: {len(rows)} 個文件重新索引, {len(removed)} 個文件移除")
+    return len(rows), len(removed)
+
+def search_index(query, k, root='.', exclude=()):
+    """Rank the indexed files of root for query with BM25 plus symbol and path matches.
+
+    Returns up to k (path, score, reasons) tuples, best first.
+    """
+    query_terms = set(tokenize_for_index(query))
+    key = os.path.abspath(root)
+    excluded = {os.path.normpath(os.path.relpath(path, root)) for path in exclude}
+    with _index_lock:
+        documents, df = _index_documents.get(key, {}), _index_df.get(key, {})
+        if not query_terms or not documents:
+            return []
+        total = len(documents)
+        average_length = sum(entry[2] for entry in documents.values()) / total or 1
+        idf = {term: math.log(1 + (total - df.get(term, 0) + 0.5) / (df.get(term, 0) + 0.5)) for term in query_terms}
+        results = []
+        for path, (_, _, length, terms, symbols, path_terms) in documents.items():
+            if path in excluded:
+                continue
+            score = 0.0
+            reasons = []
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+            for term in query_terms:
+                frequency = terms.get(term)
+                if frequency:
+                    score += idf[term] * frequency * (BM25_K1 + 1) / (frequency + norm)
+                    reasons.append(f"{term}×{frequency}")
+                if term in symbols:
+                    score += SYMBOL_BOOST * idf[term]
+                    reasons.append(f"符號 {term}")
+                if term in path_terms:
+                    score += PATH_BOOST * idf[term]
+                    reasons.append(f"路徑 {term}")
+            if score > 0:
+                results.append((path, score, reasons))
+    return heapq.nlargest(k, results, key=lambda result: result[1])
+
+@timed_phase('retrieval')
+def pick_context_files(query, added_files, k=None):
+    """Choose the k files most relevant to query that are not in added_files and report why.
+
+    Returns the picked files and their content.
+    """
+    k = k or AUTO_CONTEXT_K
+    update_retrieval_index('.')
+    picked = {}
+    results = search_index(query, k, exclude=added_files)
+    for path, score, reasons in results:
+        content = read_text_file(path)
+        if content is not None:
+            picked[path] = content
+    if picked:
+        print(colored(f"自動加入 {len(picked)} 個相關文件:", "cyan"))
+        for path, score, reasons in results:
+            if path in picked:
+                print(colored(f"  {path} (分數 {score:.2f}: {', '.join(reasons[:6])})", "dark_grey"))
+                logging.info(f"自動加入 {path}, 分數 {score:.2f}, 原因: {reasons}")
+    else:
+        logging.info("索引中沒有與請求相關的文件。")
+    return picked
+
+_session_lock = threading.Lock()
+session_turns = []  # {'user', 'assistant', 'files': {path: digest}, 'time'} for each exchange since the summary
+session_summary = None  # Summary of the turns removed by compaction
+session_files = {}  # The REPL's added files as {path: digest}, kept apart from the files each turn saw
+
+def session_path(name):
+    return os.path.join(SESSION_DIR, f"{name}.jsonl")
+
+def store_snapshot(content):
+    """Store content once under its digest and return the digest."""
+    digest = content_digest(content)
+    path = os.path.join(SNAPSHOT_DIR, digest[:2], digest)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(temporary_path, path)
+    return digest
+
+def load_snapshot(digest):
+    try:
+        with open(os.path.join(SNAPSHOT_DIR, digest[:2], digest), 'r', encoding='utf-8') as f:
+            return f.read()
+    except OSError:
+        return None
+
+def _append_session_record(record):
+    if SESSION_NAME:
+        os.makedirs(SESSION_DIR, exist_ok=True)
+        with open(session_path(SESSION_NAME), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+def _rewrite_session_file():
+    if SESSION_NAME:
+        os.makedirs(SESSION_DIR, exist_ok=True)
+        path = session_path(SESSION_NAME)
+        with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+            if session_summary:
+                f.write(json.dumps({'type': 'summary', 'summary': session_summary}, ensure_ascii=False) + "\n")
+            if session_files:
+                f.write(json.dumps({'type': 'files', 'files': session_files}, ensure_ascii=False) + "\n")
+            for turn in session_turns:
+                f.write(json.dumps(dict(turn, type='turn'), ensure_ascii=False) + "\n")
+        os.replace(f"{path}.tmp", path)
+
+def session_history():
+    """Return the conversation as alternating user/assistant texts for build_context."""
+    with _session_lock:
+        history = []
+        if session_summary:
+            history += [f"Summary of our earlier conversation:\n{session_summary}", SESSION_SUMMARY_ACK]
+        for turn in session_turns:
+            history += [turn['user'], turn['assistant']]
+    return history
+
+def record_turn(user_message, ai_response, files):
+    """Add an exchange to the session, referencing the files it saw by snapshot digest."""
+    if SESSION_NAME:
+        refs = {file_path: store_snapshot(content) for file_path, content in files.items()}
+    else:
+        refs = {file_path: content_digest(content) for file_path, content in files.items()}
+    turn = {'user': user_message, 'assistant': ai_response, 'files': refs, 'time': time.time()}
+    with _session_lock:
+        session_turns.append(turn)
+        _append_session_record(dict(turn, type='turn'))
+
+def save_session_files(added_files):
+    """Remember the REPL's added files, the set that is restored when the session is resumed."""
+    if SESSION_NAME:
+        refs = {file_path: store_snapshot(content) for file_path, content in added_files.items()}
+    else:
+        refs = {file_path: content_digest(content) for file_path, content in added_files.items()}
+    with _session_lock:
+        if refs == session_files:
+            return
+        session_files.clear()
+        session_files.update(refs)
+        _append_session_record({'type': 'files', 'files': refs})
 
+def reset_session():
+    global session_summary
+    with _session_lock:
+        session_turns.clear()
+        session_summary = None
+        session_files.clear()
+        _rewrite_session_file()
+
+def load_session(name):
+    """Load a saved session and return its added files, read from disk or from snapshots.
+
+    Sessions saved before the added files were recorded fall back to the files of the last turn.
+    """
+    global session_summary
+    turns, summary, saved_files = [], None, None
+    try:
+        with open(session_path(name), 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logging.warning(f"略過會話 {name} 中無法解析的紀錄")
+                    continue
+                if record.get('type') == 'summary':
+                    summary, turns = record['summary'], []
+                elif record.get('type') == 'files':
+                    saved_files = record['files']
+                elif record.get('type') == 'turn':
+                    record.pop('type')
+                    turns.append(record)
+    except FileNotFoundError:
+        return {}
+    if saved_files is None:
+        saved_files = turns[-1]['files'] if turns else {}
+    with _session_lock:
+        session_turns[:] = turns
+        session_summary = summary
+        session_files.clear()
+        session_files.update(saved_files)
+    files = {}
+    for file_path, digest in saved_files.items():
+        content = read_text_file(file_path) if os.path.isfile(file_path) else load_snapshot(digest)
+        if content is not None and content_digest(content) != digest and is_outline(load_snapshot(digest)):
+            content = outline_file(file_path, content)  # Files added as outlines stay outlines
+        if content is not None:
+            files[file_path] = content
+    return files
+
+def compact_session():
+    """Summarise the oldest turns once the session grows past SESSION_MAX_TURNS or SESSION_MAX_TOKENS.
+
+    The last SESSION_KEEP_TURNS turns are kept verbatim. If the summary
+    cannot be generated the old turns are dropped, as the fixed history cap did.
+    """
+    global session_summary
+    with _session_lock:
+        tokens = sum(estimate_tokens(turn['user']) + estimate_tokens(turn['assistant']) for turn in session_turns)
+        if len(session_turns) <= SESSION_MAX_TURNS and tokens <= SESSION_MAX_TOKENS:
+            return False
+        old_turns = session_turns[:-SESSION_KEEP_TURNS] if SESSION_KEEP_TURNS else list(session_turns)
+        previous_summary = session_summary
+    if not old_turns:
+        return False
+    transcript = "\n\n".join(f"User: {turn['user']}\n\nAssistant: {turn['assistant']}" for turn in old_turns)
+    if previous_summary:
+        transcript = f"Earlier summary:\n{previous_summary}\n\n{transcript}"
+    print(colored(f"壓縮對話紀錄: 摘要最早的 {len(old_turns)} 輪對話...", "magenta"))
+    summary = chat_with_ai(transcript, system_prompt=SESSION_SUMMARY_PROMPT, call_type='summary', use_history=False)
+    with _session_lock:
+        del session_turns[:len(old_turns)]
+        session_summary = summary or previous_summary
+        _rewrite_session_file()
+    logging.info(f"壓縮對話紀錄: 移除 {len(old_turns)} 輪, 摘要{'成功' if summary else '失敗, 已直接省略'}")
+    return True
+
+class TokenBucket:
+    """Client-side rate limiter shared by every concurrent API call.
+
+    A rate of None only honours pauses requested by the server (Retry-After).
+    """
+
+    def __init__(self, rate_per_minute=None):
+        self.lock = threading.Lock()
+        self.configure(rate_per_minute)
+        self.paused_until = 0.0
+
+    def configure(self, rate_per_minute):
+        with self.lock:
+            self.rate = rate_per_minute / 60.0 if rate_per_minute else None
+            self.capacity = max(1.0, self.rate * 5) if self.rate else 1.0
+            self.tokens = self.capacity
+            self.updated = time.monotonic()
+
+    def pause(self, seconds):
+        """Hold back every caller, e.g. after a 429 with a Retry-After header."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait_time = self.paused_until - now
+                if wait_time <= 0:
+                    if self.rate is None:
+                        return
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+rate_limiter = TokenBucket(RATE_LIMIT_RPM)
+_hedge_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="hedge")
+
+class AbortableNetwork:
+    """httpcore network backend whose open connections can be shut down from another thread.
+
+    Closing an httpx client does not interrupt a read that is already
+    blocked, so the sockets are kept here and abort() shuts them down; the
+    request in flight then fails at once and later connections are refused.
+    """
+
+    def __init__(self):
+        import httpcore
+        self.backend = httpcore.SyncBackend()
+        self.streams = []
+        self.children = []  # Networks aborted together with this one
+        self.aborted = False
+        self.lock = threading.Lock()
+
+    def attach(self, network):
+        """Abort network whenever this network is aborted."""
+        with self.lock:
+            aborted = self.aborted
+            if not aborted:
+                self.children.append(network)
+        if aborted:
+            network.abort()
+
+    def _track(self, stream):
+        with self.lock:
+            self.streams = [s for s in self.streams if self._socket(s) is not None]
+            self.streams.append(stream)
+            aborted = self.aborted
+        if aborted:
+            self._shutdown(stream)
+        return stream
+
+    @staticmethod
+    def _socket(stream):
+        sock = stream.get_extra_info('socket')
+        return sock if sock is not None and sock.fileno() != -1 else None
+
+    def _shutdown(self, stream):
+        import socket
+        sock = self._socket(stream)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def connect_tcp(self, *args, **kwargs):
+        return self._track(self.backend.connect_tcp(*args, **kwargs))
+
+    def connect_unix_socket(self, *args, **kwargs):
+        return self._track(self.backend.connect_unix_socket(*args, **kwargs))
+
+    def sleep(self, seconds):
+        self.backend.sleep(seconds)
+
+    def abort(self):
+        with self.lock:
+            self.aborted = True
+            streams, self.streams = self.streams, []
+            children, self.children = self.children, []
+        for stream in streams:
+            self._shutdown(stream)
+        for network in children:
+            network.abort()
+
+@contextmanager
+def _httpx_errors():
+    """Raise httpcore errors as the httpx errors of the same name, as httpx's own transport does."""
+    import httpcore
+    import httpx
+    try:
+        yield
+    except (httpcore.TimeoutException, httpcore.NetworkError, httpcore.ProtocolError, httpcore.ProxyError, httpcore.UnsupportedProtocol) as e:
+        for cls in type(e).__mro__:
+            mapped = getattr(httpx, cls.__name__, None)
+            if isinstance(mapped, type) and issubclass(mapped, httpx.TransportError):
+                raise mapped(str(e)) from e
+        raise httpx.TransportError(str(e)) from e
+
+@lru_cache(maxsize=1)
+def _abortable_stream_class():
+    import httpx
+
+    class AbortableResponseStream(httpx.SyncByteStream):
+        def __init__(self, stream):
+            self.stream = stream
+
+        def __iter__(self):
+            with _httpx_errors():
+                yield from self.stream
+
+        def close(self):
+            if hasattr(self.stream, 'close'):
+                self.stream.close()
+
+    return AbortableResponseStream
+
+class AbortableTransport:
+    """httpx transport on an httpcore connection pool that connects through an AbortableNetwork.
+
+    Only public httpx and httpcore APIs are used, so the abort on /cancel
+    keeps working across upgrades instead of depending on httpx internals.
+    """
+
+    def __init__(self, network, limits):
+        import httpcore
+        import httpx
+        self.pool = httpcore.ConnectionPool(
+            ssl_context=httpx.create_ssl_context(),
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+            network_backend=network,
+        )
+
+    def handle_request(self, request):
+        import httpcore
+        import httpx
+        core_request = httpcore.Request(
+            method=request.method,
+            url=httpcore.URL(scheme=request.url.raw_scheme, host=request.url.raw_host, port=request.url.port, target=request.url.raw_path),
+            headers=request.headers.raw,
+            content=request.stream,
+            extensions=request.extensions,
+        )
+        with _httpx_errors():
+            response = self.pool.handle_request(core_request)
+        return httpx.Response(status_code=response.status, headers=response.headers,
+                              stream=_abortable_stream_class()(response.stream), extensions=response.extensions)
+
+    def close(self):
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def create_client(api_key, base_url=None, pool_size=None, network=None):
+    """Build the OpenAI client on a pooled keep-alive HTTP connection.
+
+    Retries are handled by call_api, so the SDK's own retries are disabled.
+    network, an AbortableNetwork, opens the client's connections so its
+    requests can be aborted from another thread.
+    """
+    import httpx
+    from openai import OpenAI
+    pool_size = pool_size or max(10, MAX_WORKERS * 2)
+    limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size, keepalive_expiry=120)
+    timeout = httpx.Timeout(REQUEST_TIMEOUT, connect=10.0)
+    if network is None:
+        http_client = httpx.Client(limits=limits, timeout=timeout)
+    else:
+        http_client = httpx.Client(transport=AbortableTransport(network, limits), timeout=timeout)
+    return OpenAI(
+        base_url=base_url or API_BASE_URL,
+        api_key=api_key,
+        http_client=http_client,
+        max_retries=0
+    )
+
+client = None  # Built by get_client on the first request, or assigned directly
+hedge_attempt = contextvars.ContextVar('hedge_attempt', default=None)  # {'client', 'network'} of a hedged request
+client_settings = None  # (api_key, base_url) for get_client
+_client_lock = threading.Lock()
+
+def get_client():
+    """Return the API client, creating it from client_settings when the first request is sent.
+
+    Inside a background job the job's own client is returned, so /cancel can abort its requests.
+    """
+    global client
+    attempt = hedge_attempt.get()
+    if attempt is not None:
+        return attempt['client']
+    job = current_job.get()
+    if job is not None and job['client'] is not None:
+        return job['client']
+    if client is None:
+        with _client_lock:
+            if client is None:
+                api_key, base_url = client_settings or ("YOUR KEY", None)
+                client = create_client(api_key, base_url=base_url)
+    return client
+
+def _is_retryable(error):
+    from openai import APIConnectionError, APIStatusError, APITimeoutError
+    if isinstance(error, (APITimeoutError, APIConnectionError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code in RETRYABLE_STATUS_CODES
+
+def _retry_after(error):
+    """Read the server's Retry-After hint in seconds, if any."""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        value = headers.get('retry-after')
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            from email.utils import parsedate_to_datetime
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+def _call_with_retries(kwargs, max_retries=None):
+    max_retries = MAX_RETRIES if max_retries is None else max_retries
+    attempt = hedge_attempt.get()
+    retries = 0
+    while True:
+        check_cancelled()
+        rate_limiter.acquire()
+        try:
+            return get_client().chat.completions.create(**kwargs), retries
+        except Exception as e:
+            check_cancelled()  # A request aborted by /cancel fails with a connection error
+            lost = attempt is not None and attempt['network'].aborted  # Another hedged request won
+            if lost or not _is_retryable(e) or retries >= max_retries:
+                e.retries = retries
+                raise
+            retry_after = _retry_after(e)
+            if retry_after is not None:
+                delay = min(retry_after, RETRY_MAX_DELAY) + random.uniform(0, RETRY_BASE_DELAY)
+                if getattr(e, 'status_code', None) == 429:
+                    rate_limiter.pause(delay)
+            else:
+                # Full jitter exponential backoff
+                delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** retries))
+            retries += 1
+            print(colored(f"API 請求失敗 ({e}), {delay:.1f} 秒後重試... (第 {retries} 次)", "yellow"))
+            logging.warning(f"API 請求失敗: {e}. {delay:.1f} 秒後重試 (第 {retries} 次)")
+            time.sleep(delay)
+
+def call_api(timeout=None, hedge=True, max_retries=None, **kwargs):
+    """Create a chat completion through the shared client layer.
+
+    Applies the shared rate limiter, retries transient errors with jitter while
+    honouring Retry-After, and uses a per-call timeout. Non-streaming calls can
+    be hedged: if no answer arrives within HEDGE_AFTER seconds a second request
+    is sent and the first successful one wins.
+    Returns the response and the number of retries.
+    """
+    kwargs['timeout'] = timeout or REQUEST_TIMEOUT
+    if not hedge or not HEDGE_AFTER or kwargs.get('stream'):
+        return _call_with_retries(kwargs, max_retries)
+
+    # Each hedged request gets its own client, so the losing one can be aborted once the other answers
+    base = get_client()
+    job = current_job.get()
+    attempts = {}
+
+    def start_attempt():
+        network = AbortableNetwork()
+        if job is not None:
+            job['network'].attach(network)  # /cancel aborts the hedged requests too
+        attempt_client = create_client(base.api_key, base_url=str(base.base_url), pool_size=1, network=network)
+        context = contextvars.copy_context()
+        context.run(hedge_attempt.set, {'client': attempt_client, 'network': network})
+        future = _hedge_executor.submit(context.run, _call_with_retries, dict(kwargs), max_retries)
+        future.add_done_callback(lambda _: attempt_client.close())
+        attempts[future] = network
+
+    start_attempt()
+    done, _ = wait(attempts, timeout=HEDGE_AFTER)
+    if not done:
+        logging.info(f"請求超過 {HEDGE_AFTER} 秒未回應, 發送對沖請求。")
+        start_attempt()
+    error = None
+    try:
+        for future in as_completed(attempts):
+            try:
+                return future.result()
+            except Exception as e:
+                error = e
+        raise error
+    finally:
+        for future, network in attempts.items():
+            if not future.done():
+                future.cancel()
+                network.abort()  # The request in flight fails at once and is not retried
+
+def stream_completion(messages, on_delta=None, model=None, timeout=None, max_retries=None):
+    """Stream a completion while rendering the latest part as live Markdown.
+
+    on_delta, if given, is called with every piece of text as it arrives.
+    Returns the full response text, the time-to-first-token in seconds, the
+    token usage and the number of retries.
+    """
+    from rich.console import Console
+    from rich.live import Live
+    from rich.markdown import Markdown
+    console = Console()
+    start_time = time.perf_counter()
+    ttft = None
+    text = ""
+
+    def render_tail():
+        # Only render what fits on screen so long answers stay cheap to redraw
+        max_lines = max(console.size.height - 4, 5)
+        return Markdown("\n".join(text.rsplit("\n", max_lines)[-max_lines:]))
+
+    usage = None
+    send_to_client = client_sink.get()  # Daemon clients receive the text as it streams
+    response, retries = call_api(
+        timeout=timeout,
+        max_retries=max_retries,
+        model=model or MODEL,
+        messages=messages,
+        max_tokens=MAX_OUTPUT_TOKENS,
+        stream=True,
+        stream_options={"include_usage": True}
+    )
+    # Batch runs and captured output (daemon requests, background jobs) get the text without the live view
+    live = Live(console=console, get_renderable=render_tail, refresh_per_second=8, transient=True) if send_to_client is None and not BATCH_MODE else nullcontext()
+    with live:
+        try:
+            for chunk in response:
+                check_cancelled()
+                if getattr(chunk, 'usage', None):
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                if ttft is None:
+                    ttft = time.perf_counter() - start_time
+                text += delta
+                if on_delta:
+                    on_delta(delta)
+                if send_to_client:
+                    send_to_client('delta', delta)
+        except Exception:
+            check_cancelled()  # An aborted stream fails with a read error
+            raise
+    check_cancelled()  # or simply ends early
+    return text, ttft, extract_usage(usage), retries
+
+def route_tier(call_type):
+    """Return the tier of call_type and its models in configured order."""
+    tier = MODEL_ROUTES.get(call_type) or MODEL_ROUTES.get(ROUTE_ALIASES.get(call_type)) or 'default'
+    return tier, MODEL_TIERS.get(tier) or [MODEL]
+
+def route_models(call_type):
+    """Return the tier of call_type and its models to try: those cooling down after a failure go last."""
+    tier, models = route_tier(call_type)
+    now = time.time()
+    return tier, sorted(models, key=lambda model: _model_cooldowns.get(model, 0) > now)
+
+_model_cooldowns = {}  # Model -> time until which it is tried after the other models of its tier
+
+def cool_down(model, error):
+    _model_cooldowns[model] = time.time() + ROUTE_COOLDOWN
+    logging.warning(f"{model} 失敗或太慢, {ROUTE_COOLDOWN:.0f} 秒內將最後嘗試: {error}")
+
+def complete_with(model, messages, stream=False, on_delta=None, timeout=None, max_retries=None):
+    """Ask one model. Returns the text, the time-to-first-token (streams only), the usage and the retries."""
+    if stream:
+        return stream_completion(messages, on_delta=on_delta, model=model, timeout=timeout, max_retries=max_retries)
+    response, retries = call_api(timeout=timeout, max_retries=max_retries, model=model, messages=messages, max_tokens=MAX_OUTPUT_TOKENS)
+    return response.choices[0].message.content, None, extract_usage(getattr(response, 'usage', None)), retries
+
+def race_models(call_type, tier, messages, models):
+    """Send the request to every model at once and return the first non-empty answer.
+
+    Returns (text, usage, retries, model) or raises the last error. The
+    losing answers are still recorded when they arrive, since they are paid for.
+    """
+    def timed(model):
+        start_time = time.perf_counter()
+        text, _, usage, retries = complete_with(model, messages)
+        return text, usage, retries, time.perf_counter() - start_time
+
+    def record_loser(model, start_time):
+        def done(future):
+            try:
+                _, usage, retries, latency = future.result()
+                record_model_call(call_type, model, usage, latency, latency, retries, tier=tier, discarded=True)
+            except Exception as e:
+                record_model_call(call_type, model, None, None, time.perf_counter() - start_time, getattr(e, 'retries', 0), error=str(e), tier=tier, discarded=True)
+        return done
+
+    start_time = time.perf_counter()
+    futures = {_hedge_executor.submit(contextvars.copy_context().run, timed, model): model for model in models}
+    error = None
+    for future in as_completed(futures):
+        model = futures[future]
+        try:
+            text, usage, retries, latency = future.result()
+            if not text:
+                raise ValueError("空白回應")
+        except JobCancelled:
+            raise
+        except Exception as e:
+            error = e
+            cool_down(model, e)
+            record_model_call(call_type, model, None, None, time.perf_counter() - start_time, getattr(e, 'retries', 0), error=str(e), tier=tier)
+            continue
+        for other, other_model in futures.items():
+            if other is not future and not other.done():
+                other.add_done_callback(record_loser(other_model, start_time))
+        logging.info(f"競速: {model} 先回應 ({latency:.2f}s)")
+        return text, usage, retries, model
+    raise error
+
+def routed_completion(call_type, messages, stream=False, on_delta=None):
+    """Get a completion for call_type from the models of its tier.
+
+    The models are tried in order. One that fails, or that takes longer than
+    ROUTE_TIMEOUT while another model is left, is cooled down and the next
+    model is asked instead of retrying. A stream that already delivered text is not retried
+    elsewhere. With ROUTE_RACE, calls that are not streamed go to the first
+    two models at once. Failed attempts are recorded here, the answer by the
+    caller. Returns (text, ttft, usage, retries, model, tier, fallback).
+    """
+    tier, models = route_models(call_type)
+    position = 0
+    if ROUTE_RACE and not stream and len(models) > 1:
+        try:
+            text, usage, retries, model = race_models(call_type, tier, messages, models[:2])
+            return text, None, usage, retries, model, tier, model != models[0]
+        except JobCancelled:
+            raise
+        except Exception as e:
+            if len(models) == 2:
+                e.model = models[-1]
+                e.recorded = True
+                raise
+            position = 2
+    delivered = False
+
+    def forward(delta):
+        nonlocal delivered
+        delivered = True
+        on_delta(delta)
+
+    for position in range(position, len(models)):
+        model = models[position]
+        last = position == len(models) - 1
+        start_time = time.perf_counter()
+        try:
+            text, ttft, usage, retries = complete_with(
+                model, messages, stream=stream, on_delta=forward if on_delta else None,
+                timeout=None if last else ROUTE_TIMEOUT, max_retries=None if last else 0  # The next model is the retry
+            )
+            return text, ttft, usage, retries, model, tier, position > 0
+        except JobCancelled:
+            raise
+        except Exception as e:
+            e.model = model
+            if last or delivered:
+                raise
+            cool_down(model, e)
+            print(colored(f"{model} 請求失敗 ({e}), 改用 {models[position + 1]}...", "yellow"))
+            record_model_call(call_type, model, None, None, time.perf_counter() - start_time, getattr(e, 'retries', 0), error=str(e), tier=tier)
+
+def chat_with_ai(user_message, is_edit_request=False, retry_count=0, added_files=None, stream=False, system_prompt=None, call_type=None, on_delta=None, use_history=True, context_note=None, record_history=True):
+    global last_ai_response, last_response_timing, last_usage, MODEL
+    call_type = call_type or ('instructions' if is_edit_request else 'chat')
+    tier, models = route_tier(call_type)
+    call_start = time.perf_counter()
+    try:
+        show_edit_progress = is_edit_request and retry_count == 0 and not system_prompt
+        if is_edit_request and not system_prompt:
+            system_prompt = EDIT_INSTRUCTION_PROMPT if retry_count == 0 else APPLY_EDITS_PROMPT
+        use_history = use_history and not is_edit_request and not BATCH_MODE
+        history = session_history() if use_history else []
+        # The note (such as diffs of changed files) is sent with this request but not kept in the history
+        request = f"{context_note}\n\n{user_message}" if context_note else user_message
+        files, history, report = build_context(request, added_files or {}, history, fixed_text=system_prompt or "", budget=route_budget(call_type))
+        if report['dropped']:
+            print(colored("上下文超出預算, 已省略: " + ", ".join(report['dropped']), "yellow"))
+            logging.warning(f"上下文超出預算 ({report['budget']} tokens), 已省略: {report['dropped']}")
+
+        messages = build_messages(request, system_prompt=system_prompt, files=files, history=history)
+
+        if show_edit_progress:
+            print(colored("分析文件並生成修改...", "magenta"))
+            logging.info("分析文件並生成修改...")
+        elif not is_edit_request and use_history:  # Calls made in parallel report their own progress
+            print(colored("軟體工程師正在思考...", "magenta"))
+            logging.info("發送一般查詢到 AI.")
+
+        start_time = time.perf_counter()
+        # Keyed on the tier's first model; only that model's answers are stored
+        key = cache_key(models[0], messages, {'max_tokens': MAX_OUTPUT_TOKENS}) if CACHE_ENABLED else None
+        cached_response = None
+        if key:
+            try:
+                cached_response = cache_get(key)
+            except sqlite3.Error as e:
+                logging.warning(f"無法讀取回應快取: {e}")
+        model, fallback = models[0], False
+        if cached_response is not None:
+            ai_response = cached_response
+            ttft = 0.0
+            print(colored("(使用快取的回應)", "dark_grey"))
+            logging.info("使用快取的回應。")
+            usage = None
+            retries = 0
+        else:
+            ai_response, ttft, usage, retries, model, tier, fallback = routed_completion(call_type, messages, stream=stream, on_delta=on_delta)
+        if on_delta and ai_response and (cached_response is not None or not stream):
+            on_delta(ai_response)  # Responses that were not streamed arrive in one piece
+        total_time = time.perf_counter() - start_time
+        if key and cached_response is None and ai_response and model == models[0]:
+            # A fallback or racing model's answer is not cached as the first model's
+            try:
+                cache_put(key, model, ai_response)
+            except sqlite3.Error as e:
+                logging.warning(f"無法寫入回應快取: {e}")
+        # Use locals until here so concurrent calls never return each other's answers
+        last_ai_response, last_usage = ai_response, usage
+        last_response_timing = {'ttft': ttft, 'total': total_time, 'stream': stream, 'cached': cached_response is not None, 'retries': retries, 'model': model}
+        logging.info("Received response from AI.")
+        if ttft is not None:
+            logging.info(f"首個 token 延遲: {ttft:.2f}s, 總耗時: {total_time:.2f}s")
+        else:
+            logging.info(f"總耗時: {total_time:.2f}s")
+        record_task_usage(usage, retries)
+        record_model_call(call_type, model, usage, ttft if stream or cached_response is not None else total_time, total_time, retries, cached=cached_response is not None, tier=tier, fallback=fallback)
+        if usage:
+            logging.info(f"Token 使用量: 輸入 {usage['prompt_tokens']} (快取 {usage['cached_tokens']}), 輸出 {usage['completion_tokens']}")
+
+        if use_history and record_history:
+            # Update conversation history
+            record_turn(user_message, ai_response, added_files or {})  # Only the request itself, files by reference
+
+        return ai_response
+    except JobCancelled as e:
+        record_model_call(call_type, models[0], None, None, time.perf_counter() - call_start, getattr(e, 'retries', 0), error=str(e), tier=tier)
+        raise
+    except Exception as e:
+        print(colored(f"與 Stima API 通訊時發生錯誤: {e}", "red"))
+        logging.error(f"與 Stima API 通訊時發生錯誤: {e}")
+        if not getattr(e, 'recorded', False):  # Raced attempts are recorded as they fail
+            record_model_call(call_type, getattr(e, 'model', models[0]), None, None, time.perf_counter() - call_start, getattr(e, 'retries', 0), error=str(e), tier=tier)
+        return None
+    
+
+
+def resolve_edit_mode(added_files):
+    """Turn EDIT_MODE into the mode used for this request; auto picks single-pass for small change sets."""
+    if EDIT_MODE != 'auto':
+        return EDIT_MODE
+    tokens = sum(estimate_tokens(content) for content in added_files.values())
+    return 'single' if tokens <= SINGLE_PASS_MAX_TOKENS else 'pipelined'
+
+def apply_single_pass_edits(ai_response, added_files):
+    """Apply the per-file SEARCH/REPLACE sections of a single-pass response.
+
+    A file whose blocks cannot be placed is rewritten, with its blocks as the instructions.
+    """
+    parser = EditInstructionStreamParser(keep_lines=True)
+    sections = dict(parser.feed(ai_response) + parser.close())
+    results, fallbacks = {}, {}
+    for file_path, section in sections.items():
+        if file_path not in added_files:
+            print(colored(f"略過不在上下文中的文件: {file_path}", "yellow"))
+            continue
+        try:
+            blocks = parse_search_replace_blocks(section)
+            if not blocks:
+                raise ValueError("沒有 SEARCH/REPLACE 區塊。")
+            results[file_path] = apply_search_replace_blocks(added_files[file_path], blocks)
+        except ValueError as e:
+            print(colored(f"無法套用 {file_path} 的差異編輯 ({e}), 改為重寫整個文件...", "yellow"))
+            logging.warning(f"無法套用 {file_path} 的單次編輯: {e}")
+            fallbacks[file_path] = section
+    if fallbacks:
+        results.update(apply_edit_instructions(fallbacks, {file_path: added_files[file_path] for file_path in fallbacks}))
+    return merge_rewrites(added_files, sections, results)
+
+def run_edit(edit_instruction, added_files):
+    """Handle /edit: ask for edit instructions, rewrite the files and apply the changes.
+
+    two-pass asks for instructions and then rewrites every file. pipelined
+    starts each rewrite as soon as its section of the streamed instructions
+    is complete. single asks for the final SEARCH/REPLACE edits in one call.
+    The time until the instructions arrive and until the last rewrite returns
+    is reported per mode. Pipelined rewrites that run while the confirmation
+    is open count towards it, and the rest of the confirmation does not.
+    """
+    context_files = added_files
+    sync_context_files(context_files, rebase=True)  # Edits start from the files as they are on disk
+    # Outlined files are context only; /edit with their paths adds them in full
+    added_files = {file_path: content for file_path, content in context_files.items() if not is_outline(content)}
+    if not added_files:
+        print(colored("沒有可編輯的完整文件, 以大綱添加的文件只作為參考。", "red"))
+        return None
+    mode = resolve_edit_mode(added_files)
+    edit_request = f"""User request: {edit_instruction}
+
+Files to modify (their content is in the added files above):
+"""
+    for file_path in added_files:
+        edit_request += f"- {file_path}\n"
+
+    start_time = time.perf_counter()
+    instructions_done = rewrites_done = None
+    modified_files = None
+    executor = None
+    refused = threading.Event()
+    try:
+        if mode == 'single':
+            ai_response = chat_with_ai(edit_request, is_edit_request=True, added_files=context_files, system_prompt=SINGLE_PASS_EDIT_PROMPT, call_type='single_pass')
+        elif mode == 'pipelined':
+            executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+            parser = EditInstructionStreamParser()
+            futures = {}
+            instructions = {}
+            finished = {}  # Future -> time it returned
+
+            def rewrite_unless_refused(file_path, content, file_instructions):
+                if refused.is_set():
+                    raise RuntimeError("用戶拒絕了編輯指令")
+                return rewrite_file(file_path, content, file_instructions)
+
+            def start_rewrites(sections):
+                for file_path, file_instructions in sections:
+                    if file_path not in added_files or instructions.get(file_path) == file_instructions:
+                        continue
+                    if file_path in instructions:
+                        # A later section for the same file wins, as in parse_edit_instructions
+                        stale = next(future for future, path in futures.items() if path == file_path)
+                        del futures[stale]
+                        stale.cancel()
+                        print(colored(f"{file_path} 有新的指令, 重新改寫...", "yellow"))
+                    instructions[file_path] = file_instructions
+                    future = executor.submit(contextvars.copy_context().run, rewrite_unless_refused, file_path, added_files[file_path], file_instructions)
+                    future.add_done_callback(lambda done: finished.setdefault(done, time.perf_counter()))
+                    futures[future] = file_path
+                    print(colored(f"開始改寫 {file_path}...", "magenta"))
+
+            ai_response = chat_with_ai(edit_request, is_edit_request=True, added_files=context_files, stream=STREAM, on_delta=lambda delta: start_rewrites(parser.feed(delta)))
+            if ai_response:
+                start_rewrites(parser.close())
+        else:
+            ai_response = chat_with_ai(edit_request, is_edit_request=True, added_files=context_files)
+        instructions_done = time.perf_counter()
+
+        if ai_response:
+            print("軟體工程師: 以下是建議的編輯指令:" if mode != 'single' else "軟體工程師: 以下是建議的編輯:")
+            show_markdown(ai_response)
+
+            if confirm("你想要應用這些編輯指令嗎? (yes/no): ", style=PROMPT_STYLE):
+                if mode == 'single':
+                    modified_files = apply_single_pass_edits(ai_response, added_files)
+                    rewrites_done = instructions_done
+                elif mode == 'pipelined':
+                    modified_files = merge_rewrites(added_files, instructions, collect_rewrites(futures))
+                    # The rewrites may have returned while the confirmation was open
+                    now = time.perf_counter()
+                    rewrites_done = max((finished.get(future, now) for future in futures), default=instructions_done)
+                else:
+                    rewrites_start = time.perf_counter()
+                    modified_files = apply_edit_instructions(parse_edit_instructions(ai_response), added_files)
+                    rewrites_done = instructions_done + time.perf_counter() - rewrites_start
+            else:
+                refused.set()
+                print(colored("編輯指令未應用。", "red"))
+                logging.info("用戶選擇不應用編輯指令。")
+    finally:
+        if executor:
+            # Queued rewrites never start after a refusal; those already running finish their request and are ignored
+            refused.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    if instructions_done is not None:
+        instructions_time = instructions_done - start_time
+        record_telemetry({'type': 'phase', 'phase': f'edit_{mode}_instructions', 'duration': instructions_time})
+        if rewrites_done is None:
+            print(colored(f"/edit 模式 {mode}: 取得指令 {instructions_time:.1f}s", "cyan"))
+        else:
+            total = rewrites_done - start_time
+            record_telemetry({'type': 'phase', 'phase': f'edit_{mode}', 'duration': total})
+            print(colored(f"/edit 模式 {mode}: 取得指令 {instructions_time:.1f}s, 其後改寫 {total - instructions_time:.1f}s, "
+                          f"共等待模型 {total:.1f}s (不含確認時間)", "cyan"))
+    for file_path, new_content in (modified_files or {}).items():
+        apply_modifications(new_content, file_path)
+    return ai_response
+
+def run_create(creation_instruction, added_files):
+    """Handle /create: generate files and folders and create them after confirmation."""
+    create_request = f"User request: {creation_instruction}"
+    # Files are parsed while the response streams in. With --auto-approve they
+    # are created right away, otherwise they wait in a staging directory.
+    staging_dir = None if AUTO_APPROVE else tempfile.mkdtemp(prefix='stima-create-')
+    parser = CreationStreamParser()
+    staged = []
+
+    def on_delta(delta):
+        for block in parser.feed(delta):
+            staged.append(stage_creation_block(block, staging_dir))
+
+    try:
+        ai_response = chat_with_ai(create_request, is_edit_request=False, added_files=added_files, stream=STREAM, system_prompt=CREATE_SYSTEM_PROMPT, call_type='create', on_delta=on_delta, context_note=sync_context_files(added_files))
+        if ai_response:
+            staged.extend(stage_creation_block(block, staging_dir) for block in parser.close())
+        if ai_response and staged:
+            print("軟體工程師: 以下是建議的創建結構:")
+            show_markdown(ai_response)
+            if staging_dir is None:
+                print(colored(f"已創建 {len(staged)} 個檔案和資料夾。", "green"))
+            elif confirm("你想要執行這些創建步驟嗎? (yes/no): ", style=PROMPT_STYLE):
+                commit_staged_creations(staged)
+            else:
+                print(colored("創建步驟未執行。", "red"))
+                logging.info("用戶選擇不執行創建步驟。")
+            return ai_response
+    finally:
+        if staging_dir:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    # Nothing could be parsed: fall back to asking again
+    if ai_response:
+        while True:
+            print("軟體工程師: 以下是建議的創建結構:")
+            show_markdown(ai_response)
+
+            if confirm("你想要執行這些創建步驟嗎? (yes/no): ", style=PROMPT_STYLE):
+                success = apply_creation_steps(ai_response, added_files)
+                if success:
+                    break
+                else:
+                    if BATCH_MODE or not confirm("創建失敗。你想要 AI 再次嘗試嗎? (yes/no): ", style=PROMPT_STYLE):
+                        break
+                    ai_response = chat_with_ai("The previous creation attempt failed. Please try again with a different approach.", is_edit_request=False, added_files=added_files, system_prompt=CREATE_SYSTEM_PROMPT, call_type='create')
+                    if not ai_response:
+                        break
+            else:
+                print(colored("創建步驟未執行。", "red"))
+                logging.info("用戶選擇不執行創建步驟。")
+                break
+    return ai_response
+
+def pack_by_tokens(items, max_tokens, min_size=1):
+    """Greedily group (key, tokens) items into lists whose tokens stay under max_tokens.
+
+    An item larger than max_tokens gets a group of its own. Groups hold at
+    least min_size items when enough items are left.
+    """
+    groups, group, group_tokens = [], [], 0
+    for key, tokens in items:
+        if group and len(group) >= min_size and group_tokens + tokens > max_tokens:
+            groups.append(group)
+            group, group_tokens = [], 0
+        group.append(key)
+        group_tokens += tokens
+    if group:
+        if len(group) < min_size and groups:
+            groups[-1].extend(group)
+        else:
+            groups.append(group)
+    return groups
+
+def get_review_batch_tokens():
+    """Tokens of file content per review batch, kept inside the context budget."""
+    return max(1000, min(REVIEW_BATCH_TOKENS, route_budget('review') - estimate_tokens(CODE_REVIEW_PROMPT) - 2000))
+
+def _review_parallel(jobs, label):
+    """Run (title, request, files, system_prompt, call_type) jobs concurrently, reporting each as it finishes."""
+    results = [None] * len(jobs)
+    workers = min(MAX_WORKERS, len(jobs))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(contextvars.copy_context().run, chat_with_ai, request, added_files=files, system_prompt=system_prompt, call_type=call_type, use_history=False): index
+            for index, (title, request, files, system_prompt, call_type) in enumerate(jobs)
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            index = futures[future]
+            results[index] = future.result()
+            if results[index]:
+                print(colored(f"[{done}/{len(jobs)}] 已完成{label} {jobs[index][0]}", "green"))
+            else:
+                print(colored(f"[{done}/{len(jobs)}] {label}失敗: {jobs[index][0]}", "red"))
+    return results
+
+def merge_reviews(reviews, max_tokens):
+    """Reduce batch reviews into one review, merging in parallel rounds until they fit one request."""
+    round_number = 1
+    while True:
+        groups = pack_by_tokens([(index, estimate_tokens(review)) for index, review in enumerate(reviews)], max_tokens, min_size=2)
+        if len(groups) == 1:
+            print(colored(f"合併 {len(reviews)} 份批次審查...", "magenta"))
+            request = "Merge these batch reviews into one review:\n\n" + "\n\n".join(
+                f"## Batch review {number}\n\n{review}" for number, review in enumerate(reviews, start=1))
+            return chat_with_ai(request, is_edit_request=False, stream=STREAM, system_prompt=REVIEW_MERGE_PROMPT, call_type='review_merge', use_history=False)
+        print(colored(f"第 {round_number} 輪合併: {len(reviews)} 份審查分成 {len(groups)} 組...", "magenta"))
+        jobs = []
+        for number, group in enumerate(groups, start=1):
+            request = "Merge these batch reviews into one review:\n\n" + "\n\n".join(
+                f"## Batch review {index + 1}\n\n{reviews[index]}" for index in group)
+            jobs.append((f"合併組 {number}/{len(groups)}", request, None, REVIEW_MERGE_PROMPT, 'review_merge'))
+        merged = _review_parallel(jobs, "合併")
+        reviews = [review for review in merged if review]
+        if not reviews:
+            return None
+        round_number += 1
+
+REVIEW_SECTION = re.compile(r'^#{1,4}[ \t]*File:[ \t]*(.+?)[ \t]*$', re.MULTILINE)
+_review_store_lock = threading.Lock()
+_review_store_connection = None
+
+def get_review_store_connection():
+    global _review_store_connection
+    if _review_store_connection is None:
+        os.makedirs(os.path.dirname(REVIEW_STORE_PATH), exist_ok=True)
+        _review_store_connection = sqlite3.connect(REVIEW_STORE_PATH, check_same_thread=False)
+        _review_store_connection.execute("""
+            CREATE TABLE IF NOT EXISTS reviews (
+                path TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                model TEXT NOT NULL,
+                prompt_version TEXT NOT NULL,
+                review TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (path, digest, model, prompt_version)
+            )
+        """)
+        _review_store_connection.commit()
+    return _review_store_connection
+
+def review_prompt_version():
+    """Stored reviews are only reused while the per-file review prompt stays the same."""
+    return content_digest(FILE_REVIEW_PROMPT)[:12]
+
+def review_store_get(digests):
+    """Return {path: (review, created_at)} for the files of {path: digest} already reviewed with this content, model and prompt."""
+    version = review_prompt_version()
+    found = {}
+    with _review_store_lock:
+        connection = get_review_store_connection()
+        for file_path, digest in digests.items():
+            row = connection.execute(
+                "SELECT review, created_at FROM reviews WHERE path = ? AND digest = ? AND model = ? AND prompt_version = ?",
+                (os.path.abspath(file_path), digest, route_tier('review')[1][0], version)
+            ).fetchone()
+            if row:
+                found[file_path] = row
+    return found
+
+def review_store_put(reviews):
+    """Store {path: (digest, review)}, replacing the reviews of earlier versions of those files."""
+    version = review_prompt_version()
+    model = route_tier('review')[1][0]
+    now = time.time()
+    rows = [(os.path.abspath(file_path), digest, model, version, review, now) for file_path, (digest, review) in reviews.items()]
+    with _review_store_lock:
+        connection = get_review_store_connection()
+        connection.executemany("DELETE FROM reviews WHERE path = ? AND model = ? AND prompt_version = ?", [(row[0], model, version) for row in rows])
+        connection.executemany("INSERT INTO reviews (path, digest, model, prompt_version, review, created_at) VALUES (?, ?, ?, ?, ?, ?)", rows)
+        connection.commit()
+
+def split_file_reviews(ai_response, file_paths):
+    """Split a response to FILE_REVIEW_PROMPT into {path: review} for the given paths.
+
+    Headers naming a path that is not in file_paths are matched by their
+    trailing path components when that is unambiguous, and skipped otherwise.
+    """
+    by_name = {os.path.normpath(file_path): file_path for file_path in file_paths}
+    headers = list(REVIEW_SECTION.finditer(ai_response or ""))
+    reviews = {}
+    for header, following in zip(headers, headers[1:] + [None]):
+        name = os.path.normpath(header.group(1).strip('`*"\' '))
+        file_path = by_name.get(name)
+        if file_path is None:
+            matches = [path for normalized, path in by_name.items() if normalized.endswith(os.sep + name) or name.endswith(os.sep + normalized)]
+            file_path = matches[0] if len(matches) == 1 else None
+        body = ai_response[header.end():following.start() if following else len(ai_response)].strip()
+        if file_path is not None and body:
+            reviews[file_path] = f"{reviews[file_path]}\n\n{body}" if file_path in reviews else body
+    return reviews
+
+def run_incremental_review(file_contents):
+    """Review only the files without a stored review and reuse the stored findings for the rest.
+
+    Reviews are stored per file, keyed by path, content digest, model and
+    prompt version, so repeating a review costs about as much as the change.
+    The report puts the per-file reviews together locally, in path order.
+    """
+    digests = {file_path: content_digest(content) for file_path, content in file_contents.items()}
+    stored = review_store_get(digests)
+    changed = sorted(file_path for file_path in file_contents if file_path not in stored)
+    print(colored(f"{len(stored)} 個文件未變更, 沿用已儲存的審查; {len(changed)} 個文件需要審查。", "cyan"))
+
+    new_reviews = {}
+    if changed:
+        batches = review_batches(file_contents, changed)
+        print(colored(f"將 {len(changed)} 個文件分成 {len(batches)} 批審查...", "magenta"))
+        jobs = []
+        for number, batch in enumerate(batches, start=1):
+            request = "Review each of the files provided above:\n" + "\n".join(f"- {file_path}" for file_path in batch)
+            files = {file_path: file_contents[file_path] for file_path in batch}
+            jobs.append((f"批次 {number}/{len(batches)} ({len(batch)} 個文件)", request, files, FILE_REVIEW_PROMPT, 'review'))
+        for job, response in zip(jobs, _review_parallel(jobs, "審查")):
+            new_reviews.update(split_file_reviews(response, list(job[2])))
+        missing = [file_path for file_path in changed if file_path not in new_reviews]
+        if missing:
+            print(colored("警告: 沒有取得這些文件的審查, 下次將再次審查: " + ", ".join(missing), "yellow"))
+            logging.warning(f"/review --changed 缺少文件的審查: {missing}")
+        review_store_put({file_path: (digests[file_path], review) for file_path, review in new_reviews.items()})
+
+    if not new_reviews and not stored:
+        return None
+    sections = [f"# 程式碼審查: {len(new_reviews) + len(stored)} 個文件 (本次審查 {len(new_reviews)}, 沿用 {len(stored)})"]
+    for file_path in sorted(file_contents):
+        if file_path in new_reviews:
+            sections.append(f"## {file_path}\n\n{new_reviews[file_path]}")
+        elif file_path in stored:
+            review, created_at = stored[file_path]
+            reviewed_at = time.strftime('%Y-%m-%d %H:%M', time.localtime(created_at))
+            sections.append(f"## {file_path}\n\n_未變更, 沿用 {reviewed_at} 的審查_\n\n{review}")
+    return "\n\n".join(sections)
+
+def review_batches(file_contents, file_paths):
+    """Pack the files into batches of about get_review_batch_tokens() tokens."""
+    sized = [(file_path, estimate_tokens(f"File: {file_path}\nContent:\n{file_contents[file_path]}\n\n")) for file_path in file_paths]
+    return pack_by_tokens(sized, get_review_batch_tokens())
+
+def review_files(file_contents):
+    """Review all files: one batch directly, more in parallel with their findings merged into one review."""
+    batch_tokens = get_review_batch_tokens()
+    batches = review_batches(file_contents, sorted(file_contents))
+    if len(batches) == 1:
+        print(colored("分析程式碼並生成審查...", "magenta"))
+        review_request = "Review the files provided above:\n" + "\n".join(f"- {file_path}" for file_path in batches[0])
+        ai_response = chat_with_ai(review_request, is_edit_request=False, added_files=file_contents, stream=STREAM, system_prompt=CODE_REVIEW_PROMPT, call_type='review')
+    else:
+        print(colored(f"將 {len(file_contents)} 個文件分成 {len(batches)} 批審查 (每批最多約 {batch_tokens} tokens, 最多 {MAX_WORKERS} 批同時進行)...", "magenta"))
+        jobs = []
+        for number, batch in enumerate(batches, start=1):
+            request = (f"Review the files provided above. This is batch {number} of {len(batches)} from a larger review; "
+                       "the batch reviews are merged afterwards, so focus on the findings for each file:\n"
+                       + "\n".join(f"- {file_path}" for file_path in batch))
+            files = {file_path: file_contents[file_path] for file_path in batch}
+            jobs.append((f"批次 {number}/{len(batches)} ({len(batch)} 個文件)", request, files, CODE_REVIEW_PROMPT, 'review'))
+        reviews = [review for review in _review_parallel(jobs, "審查") if review]
+        if len(reviews) < len(batches):
+            print(colored(f"警告: {len(batches) - len(reviews)} 批審查失敗, 合併時將省略", "yellow"))
+        ai_response = merge_reviews(reviews, batch_tokens) if reviews else None
+        if ai_response and not BATCH_MODE:
+            # Keep the merged review in the conversation, not the batch reviews it was merged from
+            record_turn("Review these files:\n" + "\n".join(f"- {file_path}" for file_path in sorted(file_contents)), ai_response, {})
+    return ai_response
+
+def run_review(paths, changed_only=False):
+    """Handle /review: review the given files and folders.
+
+    The files are sent once, as the file context, in token-bounded batches.
+    A single batch is reviewed directly. Otherwise the batches are reviewed
+    in parallel and their findings are merged, in rounds if needed, into one
+    review. changed_only (/review --changed) reviews only new and modified
+    files and reuses the stored reviews of the others.
+    """
+    file_contents = {}
+    add_paths_to_context(paths, file_contents, action='to review')
+
+    if not file_contents:
+        print(colored("沒有有效的文件可以審查。", "red"))
+        return None
+
+    ai_response = run_incremental_review(file_contents) if changed_only else review_files(file_contents)
+    if ai_response:
+        print()
+        print(colored("程式碼審查:", "blue"))
+        show_markdown(ai_response)
+        logging.info("提供程式碼審查給請求的文件。")
+    return ai_response
+
+def run_planning(planning_instruction, added_files):
+    """Handle /planning: produce a detailed plan for the request."""
+    planning_request = f"User request: {planning_instruction}"
+    changes = sync_context_files(added_files)
+    ai_response = chat_with_ai(planning_request, is_edit_request=False, added_files=added_files, stream=STREAM, system_prompt=PLANNING_PROMPT, call_type='plan', context_note=changes)
+    if ai_response:
+        print()
+        print(colored("軟體工程師: 以下是你的詳細計劃:", "blue"))
+        show_markdown(ai_response)
+        logging.info("提供計劃回應給用戶。")
+    else:
+        print(colored("生成計劃回應失敗。請再試一次。", "red"))
+        logging.error("AI 生成計劃回應失敗。")
+    return ai_response
+
+def run_chat(user_input, added_files):
+    changes = sync_context_files(added_files)
+    if AUTO_CONTEXT_K:
+        # Picked files are only sent with this request; files added by hand keep priority
+        added_files = {**pick_context_files(user_input, added_files), **added_files}
+    # The expanded sources are sent once and kept out of the history, which only records the question and the final answer
+    ai_response = chat_with_ai(user_input, added_files=added_files, stream=STREAM, context_note=changes, record_history=False)
+    for _ in range(OUTLINE_EXPAND_ROUNDS):
+        # The model may ask for the full source of symbols in outlined files
+        expanded = expand_outline_requests(ai_response, added_files)
+        if not expanded:
+            break
+        ai_response = chat_with_ai(f"{expanded}\n\nNow answer the original request: {user_input}", added_files=added_files, stream=STREAM, context_note=changes, use_history=False)
+    if ai_response and not BATCH_MODE:
+        record_turn(user_input, ai_response, added_files)
+    if ai_response:
+        print()
+        print(colored("軟體工程師:", "blue"))
+        show_markdown(ai_response)
+        logging.info("提供 AI 回應給用戶查詢。")
+    return ai_response
+
+def load_batch_tasks(tasks_path):
+    """Read batch tasks from a JSONL file.
+
+    Each line is either a JSON string with the command, or an object with a
+    "command" key and optional "id", "instruction" (for /edit), "files"
+    (paths added to the context first) and "outline" (paths added as outlines).
+    A line that cannot be used becomes a task with an "error", reported as a
+    failed result so the other tasks still run.
+    """
+    tasks = []
+    with open(tasks_path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                task = json.loads(line)
+            except json.JSONDecodeError as e:
+                task = {'command': line, 'error': f"第 {line_number} 行不是有效的 JSON: {e}"}
+            else:
+                if isinstance(task, str):
+                    task = {'command': task}
+                if not isinstance(task, dict) or not isinstance(task.get('command'), str) or not task['command'].strip():
+                    task = {'command': line, 'error': f"第 {line_number} 行缺少 command。"}
+            if 'error' in task:
+                logging.warning(f"批次任務檔案 {tasks_path}: {task['error']}")
+            task.setdefault('id', str(line_number))
+            tasks.append(task)
+    return tasks
+
+def run_batch_task(task):
+    """Run one batch task and return its result record."""
+    command = task['command'].strip()
+    added_files = {}
+    record = {
+        'id': task['id'],
+        'command': command,
+        'status': 'ok',
+        'output': None,
+        'files_changed': [],
+        'usage': {'calls': 0, 'retries': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'cached_tokens': 0},
+        'error': None,
+    }
+    token = current_task.set(record)
+    start_time = time.perf_counter()
+    record['started_at'] = time.time()
+    try:
+        if task.get('error'):
+            raise ValueError(task['error'])
+        if task.get('files'):
+            add_paths_to_context(task['files'], added_files)
+        if task.get('outline'):
+            add_outlines_to_context(task['outline'], added_files)
+        name, _, argument = command.partition(' ')
+        argument = argument.strip()
+        if name == '/review' and not argument or name == '/edit' and not argument and not AUTO_CONTEXT_K:
+            raise ValueError(f"{name} 需要至少一個文件或文件夾路徑。")
+        if name in ('/create', '/planning') and not argument:
+            raise ValueError(f"{name} 需要指令。")
+        if name == '/edit':
+            if not task.get('instruction'):
+                raise ValueError("/edit 任務需要 instruction 欄位。")
+            if argument:
+                add_paths_to_context(argument.split(), added_files)
+            else:
+                added_files.update(pick_context_files(task['instruction'], added_files))
+            if not added_files:
+                raise ValueError("沒有有效的文件可以編輯。")
+            record['output'] = run_edit(task['instruction'], added_files)
+        elif name == '/create':
+            record['output'] = run_create(argument, added_files)
+        elif name == '/review':
+            paths = argument.split()
+            record['output'] = run_review([path for path in paths if path != '--changed'], changed_only='--changed' in paths)
+        elif name == '/planning':
+            record['output'] = run_planning(argument, added_files)
+        elif name.startswith('/'):
+            raise ValueError(f"批次模式不支援的指令: {name}")
+        else:
+            record['output'] = run_chat(command, added_files)
+        if record['output'] is None:
+            record['status'] = 'error'
+            record['error'] = "AI 沒有回傳內容"
+    except Exception as e:
+        record['status'] = 'error'
+        record['error'] = str(e)
+        logging.error(f"批次任務 {task['id']} 失敗: {e}")
+    finally:
+        record['duration'] = time.perf_counter() - start_time
+        current_task.reset(token)
+        flush_prometheus_textfile()
+    return record
+
+def run_batch(tasks_path, output_path):
+    """Run the tasks of a JSONL file concurrently and write one JSONL result per task."""
+    tasks = load_batch_tasks(tasks_path)
+    print(colored(f"批次模式: {len(tasks)} 個任務, 最多 {MAX_WORKERS} 個同時進行, 結果寫入 {output_path}", "cyan"))
+    start_time = time.perf_counter()
+    failures = 0
+    with open(output_path, 'w', encoding='utf-8') as output, ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {executor.submit(contextvars.copy_context().run, run_batch_task, task): task for task in tasks}
+        for done, future in enumerate(as_completed(futures), start=1):
+            record = future.result()
+            output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            output.flush()
+            if record['status'] != 'ok':
+                failures += 1
+            color = "green" if record['status'] == 'ok' else "red"
+            print(colored(f"[{done}/{len(tasks)}] {record['id']} {record['command'][:60]} ({record['status']}, {record['duration']:.1f}s)", color))
+    elapsed = time.perf_counter() - start_time
+    print(colored(f"批次完成: {len(tasks) - failures} 個成功, {failures} 個失敗, 總耗時 {elapsed:.1f}s", "cyan"))
+    return failures == 0
+
+# Set while a daemon request or background job runs: a callable(kind, text) that receives its output
+client_sink = contextvars.ContextVar('client_sink', default=None)
+_daemon_lock = threading.Lock()  # Requests change the working directory, so they run one at a time
+
+class OutputRouter:
+    """sys.stdout replacement that forwards the output of a daemon request or background job to its sink."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        send = client_sink.get()
+        if send is None:
+            return self.stream.write(text)
+        send('output', text)
+        return len(text)
+
+    def flush(self):
+        if client_sink.get() is None:
+            self.stream.flush()
+
+    def isatty(self):
+        return client_sink.get() is None and self.stream.isatty()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+def handle_daemon_connection(connection, request_id):
+    """Serve one client request: a JSON task line in, JSON event lines out."""
+    send_lock = threading.Lock()
+    closed = False
+
+    def send(kind, payload):
+        nonlocal closed
+        if closed:
+            return
+        event = json.dumps({'type': kind, 'data': payload}, ensure_ascii=False) + "\n"
+        try:
+            with send_lock:
+                connection.sendall(event.encode('utf-8'))
+        except OSError:
+            closed = True  # The client went away, finish the request quietly
+
+    global AUTO_APPROVE
+    try:
+        with connection, connection.makefile('r', encoding='utf-8') as reader:
+            try:
+                task = json.loads(reader.readline())
+            except json.JSONDecodeError as e:
+                send('result', {'status': 'error', 'error': f"無效的請求: {e}"})
+                return
+            command = (task.get('command') or '').strip()
+            if command == '/ping':
+                send('result', {'status': 'ok', 'output': 'pong', 'pid': os.getpid()})
+                return
+            if command == '/shutdown':
+                send('result', {'status': 'ok', 'output': '守護程序已停止'})
+                threading.Thread(target=daemon_server.shutdown, daemon=True).start()
+                return
+            task['id'] = task.get('id') or f"daemon-{request_id}"
+            with _daemon_lock:
+                cwd = os.getcwd()
+                auto_approve = AUTO_APPROVE
+                token = client_sink.set(send)
+                try:
+                    os.chdir(task.get('cwd') or cwd)
+                    AUTO_APPROVE = bool(task.get('auto_approve', auto_approve))
+                    record = run_batch_task(task)
+                except Exception as e:
+                    record = {'id': task['id'], 'status': 'error', 'error': str(e)}
+                finally:
+                    client_sink.reset(token)
+                    AUTO_APPROVE = auto_approve
+                    os.chdir(cwd)
+            send('result', record)
+    except OSError as e:
+        logging.warning(f"守護程序連線錯誤: {e}")
+
+daemon_server = None
+
+def serve_daemon(socket_path):
+    """Keep the client, caches and index warm and serve requests on a Unix socket."""
+    global daemon_server
+    import socketserver
+    if not hasattr(socketserver, 'UnixStreamServer'):
+        print(colored("錯誤: 此平台不支援 Unix socket, 無法啟動守護程序。", "red"))
+        return False
+    os.makedirs(os.path.dirname(os.path.abspath(socket_path)), exist_ok=True)
+    if os.path.exists(socket_path):
+        import socket
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+            print(colored(f"錯誤: 守護程序已在 {socket_path} 執行中。", "red"))
+            return False
+        except OSError:
+            os.remove(socket_path)  # Left behind by a daemon that did not exit cleanly
+        finally:
+            probe.close()
+
+    counter = iter(range(1, sys.maxsize))
+
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            handle_daemon_connection(self.request, next(counter))
+
+    old_umask = os.umask(0o077)  # Only the current user may connect
+    try:
+        daemon_server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+    finally:
+        os.umask(old_umask)
+    daemon_server.daemon_threads = True
+    get_client()  # Import the SDK and open the connection pool once, before the first request
+    sys.stdout = OutputRouter(sys.stdout)
+    print(colored(f"守護程序已啟動: {socket_path} (pid {os.getpid()}, 模型 {MODEL})", "cyan"))
+    logging.info(f"守護程序已啟動: {socket_path}")
+    try:
+        daemon_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon_server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        sys.stdout = sys.stdout.stream
+        print(colored("守護程序已停止。", "cyan"))
+    return True
+
+# Background jobs of the interactive session: a command ending in & runs on a job thread
+MAX_JOBS = 4  # Jobs that run at the same time; later ones wait in the queue
+BACKGROUND_COMMANDS = ('/edit', '/create', '/review', '/planning')  # Besides plain chat messages
+JOB_STATUS = {'queued': '排隊中', 'running': '執行中', 'done': '完成', 'failed': '失敗', 'cancelled': '已取消'}
+JOB_STATUS_COLORS = {'done': 'green', 'failed': 'red', 'cancelled': 'yellow'}
+background_jobs = {}  # Job id -> {'id', 'command', 'status', 'output', 'cancel', 'done', 'network', 'client', ...}
+job_listener = None  # Called on the job's thread when a job finishes
+_job_executor = None
+_job_ids = iter(range(1, sys.maxsize))
+
+def start_job(command, func, *args):
+    """Run func(*args) as a background job and return its record.
+
+    The job sends its requests through its own client, so cancel_job can
+    abort them, and everything it prints is kept in the record's output.
+    """
+    global _job_executor
+    if _job_executor is None:
+        _job_executor = ThreadPoolExecutor(max_workers=MAX_JOBS, thread_name_prefix="job")
+    base = get_client()
+    network = AbortableNetwork()
+    job = {
+        'id': next(_job_ids), 'command': command, 'status': 'queued', 'output': [],
+        'cancel': threading.Event(), 'done': threading.Event(), 'network': network,
+        'client': create_client(base.api_key, base_url=str(base.base_url), network=network),
+        'started': None, 'finished': None, 'shown': False,
+    }
+    background_jobs[job['id']] = job
+    job['future'] = _job_executor.submit(run_job, job, func, *args)
+    logging.info(f"背景工作 {job['id']} 已排入: {command}")
+    return job
+
+def run_job(job, func, *args):
+    def capture(kind, text):
+        if kind == 'output':  # Streamed deltas are left out, the final answer is printed in full
+            job['output'].append(text)
+
+    job['status'] = 'running'
+    job['started'] = time.time()
+    job_token = current_job.set(job)
+    sink_token = client_sink.set(capture)
+    status = 'done'
+    try:
+        func(*args)
+    except JobCancelled:
+        status = 'cancelled'
+    except Exception as e:
+        print(colored(f"背景工作發生錯誤: {e}", "red"))
+        logging.error(f"背景工作 {job['id']} 發生錯誤: {e}")
+        status = 'failed'
+    finally:
+        client_sink.reset(sink_token)
+        current_job.reset(job_token)
+    finish_job(job, 'cancelled' if job['cancel'].is_set() else status)
+
+def finish_job(job, status):
+    job['client'].close()
+    job['status'] = status
+    job['finished'] = time.time()
+    job['done'].set()
+    flush_prometheus_textfile()
+    logging.info(f"背景工作 {job['id']} {JOB_STATUS[status]}: {job['command']}")
+    if job_listener:
+        job_listener()
+
+def cancel_job(job):
+    """Stop a job: a queued job never starts and a running one has its requests aborted."""
+    job['cancel'].set()
+    if job['future'].cancel():
+        finish_job(job, 'cancelled')
+    elif not job['done'].is_set():
+        job['network'].abort()
+
+def job_elapsed(job):
+    if job['started'] is None:
+        return 0.0
+    return (job['finished'] or time.time()) - job['started']
+
+def show_job(job):
+    """Print a finished job's output under a header line."""
+    print(colored(f"[{job['id']}] {JOB_STATUS[job['status']]} ({job_elapsed(job):.1f}s): {job['command']}", JOB_STATUS_COLORS.get(job['status'], 'cyan')))
+    output = "".join(job['output'])
+    if output:
+        print(output.rstrip("\n"))
+    job['shown'] = True
+
+def show_finished_jobs():
+    for job in list(background_jobs.values()):
+        if job['done'].is_set() and not job['shown']:
+            show_job(job)
+
+def display_jobs():
+    if not background_jobs:
+        print(colored("沒有背景工作。在命令結尾加上 & 即可在背景執行。", "cyan"))
+        return
+    from rich.console import Console
+    from rich.table import Table
+    table = Table(title="背景工作")
+    table.add_column("ID", justify="right")
+    table.add_column("狀態")
+    table.add_column("耗時", justify="right")
+    table.add_column("輸出", justify="right")
+    table.add_column("命令", overflow="ellipsis")
+    for job in background_jobs.values():
+        lines = "".join(job['output']).count("\n")
+        table.add_row(str(job['id']), JOB_STATUS[job['status']], f"{job_elapsed(job):.1f}s", f"{lines} 行", job['command'])
+    Console().print(table)
+
+def select_jobs(argument, default_unfinished=False):
+    """Return the jobs named by the ids in argument, or None after reporting an unknown id."""
+    ids = argument.split()
+    if not ids and default_unfinished:
+        return [job for job in background_jobs.values() if not job['done'].is_set()]
+    selected = []
+    for job_id in ids:
+        job = background_jobs.get(int(job_id)) if job_id.isdigit() else None
+        if job is None:
+            print(colored(f"找不到背景工作: {job_id}", "red"))
+            return None
+        selected.append(job)
+    return selected
+
+async def run_in_thread(func, *args):
+    """Await func(*args) on a daemon thread in a copy of the current context.
+
+    The thread can read from the terminal with ask(), and unlike the default
+    executor it does not keep the program alive after Ctrl+C.
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    context = contextvars.copy_context()
+
+    def settle(method, value):
+        if not future.done():
+            method(value)
+
+    def target():
+        try:
+            result = context.run(func, *args)
+        except BaseException as e:
+            loop.call_soon_threadsafe(settle, future.set_exception, e)
+        else:
+            loop.call_soon_threadsafe(settle, future.set_result, result)
+
+    threading.Thread(target=target, daemon=True).start()
+    return await future
+
+async def run_repl(added_files, completer):
+    """The interactive loop on prompt_toolkit's asyncio support.
+
+    Commands run on a thread while the loop waits for them, or, with a
+    trailing &, as background jobs. A job's output is shown when it finishes:
+    above the prompt while the user is typing, otherwise before the next one.
+    """
+    import asyncio
+    from prompt_toolkit import PromptSession
+    from prompt_toolkit.application import run_in_terminal
+    from prompt_toolkit.styles import Style
+    global job_listener
+    session = PromptSession(style=Style.from_dict(PROMPT_STYLE), completer=completer)
+    loop = asyncio.get_running_loop()
+    finished = asyncio.Event()
+    job_listener = lambda: loop.call_soon_threadsafe(finished.set)
+
+    async def announce_finished_jobs():
+        while True:
+            await finished.wait()
+            finished.clear()
+            if session.app.is_running:
+                await run_in_terminal(show_finished_jobs)
+
+    announcer = asyncio.create_task(announce_finished_jobs())
+    try:
+        while True:
+            compact_session()  # Between commands, so the summary never delays an answer
+            show_finished_jobs()
+            print()  # Add a newline before the prompt
+            user_input = (await session.prompt_async("You: ")).strip()
+            background = user_input.endswith('&')
+            if background:
+                user_input = user_input[:-1].strip()
+            command = user_input.lower()
+
+            if command == '/quit':
+                unfinished = select_jobs("", default_unfinished=True)
+                if unfinished:
+                    print(colored(f"取消 {len(unfinished)} 個未完成的背景工作...", "yellow"))
+                    for job in unfinished:
+                        cancel_job(job)
+                print("Goodbye!")
+                logging.info("User exited the program.")
+                break
+
+            elif command == '/jobs':
+                display_jobs()
+
+            elif command.startswith('/wait'):
+                selected = select_jobs(user_input[5:], default_unfinished=True)
+                if selected:
+                    print(colored(f"等待 {len(selected)} 個背景工作...", "magenta"))
+                    await run_in_thread(lambda: [job['done'].wait() for job in selected])
+                    for job in selected:
+                        show_job(job)
+                elif selected is not None:
+                    print(colored("沒有執行中的背景工作。", "cyan"))
+
+            elif command.startswith('/cancel'):
+                selected = select_jobs(user_input[7:])
+                if selected == []:
+                    print(colored("請提供要取消的背景工作編號, 使用 /jobs 查看。", "red"))
+                for job in selected or []:
+                    if job['done'].is_set():
+                        print(colored(f"[{job['id']}] 已經{JOB_STATUS[job['status']]}。", "yellow"))
+                        continue
+                    cancel_job(job)
+                    print(colored(f"[{job['id']}] 已要求取消, 進行中的請求已中止。", "yellow"))
+
+            elif background and (command.startswith(BACKGROUND_COMMANDS) or not command.startswith('/')):
+                edit_instruction = None
+                if command.startswith('/edit'):
+                    # Asked now, since the job cannot read from the terminal
+                    edit_instruction = (await session.prompt_async("Edit Instruction: ")).strip()
+                # The job works on a copy of the added files, brought up to date with the disk first
+                sync_context_files(added_files, rebase=True)
+                job = start_job(user_input, execute_command, user_input, dict(added_files), edit_instruction)
+                print(colored(f"[{job['id']}] 已在背景執行: {user_input} (使用 /jobs 查看, /wait {job['id']} 等待, /cancel {job['id']} 取消)", "cyan"))
+
+            else:
+                if background:
+                    print(colored(f"{user_input.split()[0]} 無法在背景執行, 改為直接執行。", "yellow"))
+                await run_in_thread(execute_command, user_input, added_files)
+                save_session_files(added_files)
+                flush_prometheus_textfile()
+    finally:
+        job_listener = None
+        announcer.cancel()
+
+def execute_command(user_input, added_files, edit_instruction=None):
+    """Run one REPL command. /quit and the job commands are handled by run_repl."""
+    global last_ai_response
+    style = PROMPT_STYLE
+    if user_input.lower() == '/debug':
+        if last_ai_response:
+            print(colored("Last AI Response:", "blue"))
+            print(last_ai_response)
+            if last_response_timing:
+                ttft = last_response_timing['ttft']
+                ttft_text = f"{ttft:.2f}s" if ttft is not None else "n/a"
+                print(colored(f"模型: {last_response_timing['model']}, 首個 token 延遲: {ttft_text}, 總耗時: {last_response_timing['total']:.2f}s", "dark_grey"))
+            if last_usage:
+                print(colored(f"Token 使用量: 輸入 {last_usage['prompt_tokens']} (快取命中 {last_usage['cached_tokens']}), 輸出 {last_usage['completion_tokens']}", "dark_grey"))
+        else:
+            print(colored("No AI response available yet.", "red"))
+
+    elif user_input.lower() == '/reset':
+        reset_session()
+        added_files.clear()
+        reset_context_sync()
+        last_ai_response = None
+        print(colored("聊天上下文和添加的文件已重置。", "green"))
+        logging.info("聊天上下文和添加的文件已重置。")
+
+    elif user_input.startswith('/cache'):
+        action = user_input[6:].strip().lower()
+        if action == 'clear':
+            print(colored(f"已清除 {cache_clear()} 筆快取的回應。", "green"))
+            logging.info("已清除回應快取。")
+        elif action in ('', 'stats'):
+            stats = cache_stats()
+            state = "啟用" if CACHE_ENABLED else "停用"
+            print(colored(f"回應快取 ({state}): {stats['entries']} 筆, {stats['bytes'] / 1024:.1f} KB, 本次命中 {stats['hits']} 次, 未命中 {stats['misses']} 次", "cyan"))
+            print(colored(f"位置: {CACHE_PATH}", "dark_grey"))
+        else:
+            print(colored("用法: /cache clear|stats", "red"))
+
+    elif user_input.lower() == '/stats':
+        display_stats()
+
+    elif user_input.lower() == '/context':
+        display_context_breakdown(added_files)
+
+    elif user_input.startswith('/add'):
+        paths = user_input.split()[1:]
+        outline = '--outline' in paths
+        paths = [path for path in paths if path != '--outline']
+        if not paths:
+            print(colored("請提供至少一個文件或文件夾路徑。", "red"))
+            logging.warning("用戶發送 /add 而沒有文件或文件夾路徑。")
+            return
+
+        if outline:
+            add_outlines_to_context(paths, added_files)
+        else:
+            add_paths_to_context(paths, added_files)
+        total_tokens = sum(estimate_tokens(content) for content in added_files.values())
+        if total_tokens > route_budget('chat'):
+            print(colored(f"警告: 添加的文件約 {total_tokens} tokens, 超出模型的上下文預算 {route_budget('chat')} tokens, 部分文件將被省略。使用 /context 查看詳情。", "red"))
+            logging.warning(f"添加的文件約 {total_tokens} tokens, 超出上下文預算。")
+
+    elif user_input.startswith('/edit'):
+        paths = user_input.split()[1:]
+        if not paths and AUTO_CONTEXT_K:
+            # Without paths the files to edit are picked from the index
+            edit_instruction = edit_instruction or ask(f"Edit Instruction: ", style=style).strip()
+            edit_files = pick_context_files(edit_instruction, {})
+            if not edit_files:
+                print(colored("索引中沒有與指令相關的文件, 請提供文件或文件夾路徑。", "red"))
+                return
+            run_edit(edit_instruction, edit_files)
+            return
+        if not paths:
+            print(colored("請提供至少一個文件或文件夾路徑。", "red"))
+            logging.warning("用戶發送 /edit 而沒有文件或文件夾路徑。")
+            return
+        add_paths_to_context(paths, added_files)
+        if not added_files:
+            print(colored("沒有有效的文件可以編輯。", "red"))
+            return
+        edit_instruction = edit_instruction or ask(f"Edit Instruction for all files: ", style=style).strip()
+        run_edit(edit_instruction, added_files)
+
+    elif user_input.startswith('/create'):
+        creation_instruction = user_input[7:].strip()  # Remove '/create' and leading/trailing whitespace
+        if not creation_instruction:
+            print(colored("請在 /create 後提供創建指令。", "red"))
+            logging.warning("用戶發送 /create 而沒有指令。")
+            return
+        run_create(creation_instruction, added_files)
+
+    elif user_input.startswith('/review'):
+        paths = user_input.split()[1:]
+        changed_only = '--changed' in paths
+        paths = [path for path in paths if path != '--changed']
+        if not paths:
+            print(colored("請提供至少一個文件或文件夾路徑。", "red"))
+            logging.warning("用戶發送 /review 而沒有文件或文件夾路徑。")
+            return
+        run_review(paths, changed_only=changed_only)
+
+    elif user_input.startswith('/planning'):
+        planning_instruction = user_input[9:].strip()  # Remove '/planning' and leading/trailing whitespace
+        if not planning_instruction:
+            print(colored("請在 /planning 後提供計劃請求。", "red"))
+            logging.warning("用戶發送 /planning 而沒有指令。")
+            return
+        run_planning(planning_instruction, added_files)
+
+    else:
+        run_chat(user_input, added_files)
+
+def main():
+    global last_ai_response, client_settings, MODEL, STREAM, MAX_WORKERS, EDIT_FORMAT, EDIT_MODE, CONTEXT_BUDGET
+    global CACHE_ENABLED, CACHE_TTL, CACHE_MAX_BYTES, PROMPT_CACHE
+    global REQUEST_TIMEOUT, MAX_RETRIES, RATE_LIMIT_RPM, HEDGE_AFTER, AUTO_APPROVE, BATCH_MODE, REVIEW_BATCH_TOKENS, AUTO_CONTEXT_K, SESSION_NAME
+    global file_watcher, DELTA_MAX_RATIO, ROUTE_TIMEOUT, ROUTE_COOLDOWN, ROUTE_RACE
+
+    parser = argparse.ArgumentParser(description="Stima 助理工程師 CLI")
+    parser.add_argument("--api-key", help="請輸入您的 Stima API Key")
+    parser.add_argument("--model", help="請輸入模型名稱, 預設使用 Anthropic Claude 3.5 Sonnet", default="claude-3-5-sonnet-20240620")
+    parser.add_argument("--tier", action="append", default=[], metavar="NAME=MODEL[,MODEL...]", help="定義模型層級: 依序嘗試的模型, 後面的模型作為備援 (可重複)")
+    parser.add_argument("--route", action="append", default=[], metavar="TYPE=TIER", help=f"將呼叫類型 ({', '.join(ROUTE_TYPES)}) 指派給模型層級 (可重複), 未指派的使用 --model")
+    parser.add_argument("--route-timeout", type=float, help="層級中還有備援模型時, 超過此秒數未回應即改用下一個模型")
+    parser.add_argument("--route-cooldown", type=float, default=ROUTE_COOLDOWN, help="失敗或太慢的模型在此秒數內改為最後嘗試")
+    parser.add_argument("--race", action="store_true", help="非串流呼叫同時送給層級中的前兩個模型, 採用先到的有效回應")
+    parser.add_argument("--price", action="append", default=[], metavar="MODEL=INPUT,OUTPUT", help="模型每百萬 token 的輸入與輸出價格 (美元), 用於 /stats 的成本估算 (可重複)")
+    parser.add_argument("--no-stream", action="store_true", help="關閉串流輸出, 等待完整回應後再顯示")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="並行請求 AI 的最大數量")
+    parser.add_argument("--edit-format", choices=['diff', 'whole'], default=EDIT_FORMAT, help="編輯格式: diff 只回傳 SEARCH/REPLACE 區塊, whole 重寫整個文件")
+    parser.add_argument("--edit-mode", choices=['two-pass', 'pipelined', 'single', 'auto'], default=EDIT_MODE, help="/edit 流程: two-pass 先取得指令再改寫, pipelined 在指令串流時即開始改寫, single 一次呼叫直接回傳編輯, auto 依文件大小選擇")
+    parser.add_argument("--context-budget", type=int, help="每次請求的輸入 token 上限, 預設依模型的上下文長度決定")
+    parser.add_argument("--auto-context", type=int, default=AUTO_CONTEXT_K, metavar="K", help="每次對話與 /edit 自動從本地索引加入 K 個最相關的文件, 0 為停用")
+    parser.add_argument("--review-batch-tokens", type=int, default=REVIEW_BATCH_TOKENS, help="/review 每批文件的 token 上限, 超過時分批並行審查再合併")
+    parser.add_argument("--cache", action="store_true", help="啟用本地回應快取: 相同的請求直接重用先前的回應")
+    parser.add_argument("--no-cache", action="store_true", help="不使用本地回應快取 (預設)")
+    parser.add_argument("--no-watch", action="store_true", help="不監看已添加的文件; 預設會把磁碟上的變更以差異傳送給模型")
+    parser.add_argument("--delta-max-ratio", type=float, default=DELTA_MAX_RATIO, help="差異超過文件 token 的此比例時改為重新傳送完整文件")
+    parser.add_argument("--cache-ttl", type=float, default=CACHE_TTL / 3600, help="快取回應的有效時間 (小時)")
+    parser.add_argument("--cache-max-mb", type=float, default=CACHE_MAX_BYTES / (1024 * 1024), help="回應快取的大小上限 (MB)")
+    parser.add_argument("--prompt-cache", action="store_true", help="在穩定的前綴訊息上加入 cache_control 標記, 啟用供應商端的提示快取")
+    parser.add_argument("--base-url", default=API_BASE_URL, help="OpenAI 相容 API 的位址")
+    parser.add_argument("--timeout", type=float, default=REQUEST_TIMEOUT, help="每次 API 請求的逾時秒數")
+    parser.add_argument("--max-retries", type=int, default=MAX_RETRIES, help="暫時性錯誤 (429/5xx/連線錯誤) 的最大重試次數")
+    parser.add_argument("--rpm", type=float, help="所有並行請求共用的每分鐘請求上限")
+    parser.add_argument("--hedge-after", type=float, help="非串流請求超過此秒數未回應時, 再發送一個對沖請求")
+    parser.add_argument("--session", metavar="NAME", help="將對話保存在此名稱下, 再次使用相同名稱即可恢復")
+    parser.add_argument("--daemon", action="store_true", help="以守護程序執行, 透過 Unix socket 接收 engc.py 的指令")
+    parser.add_argument("--socket", default=DAEMON_SOCKET, help="守護程序的 Unix socket 路徑")
+    parser.add_argument("--batch", metavar="TASKS_JSONL", help="以非互動模式執行 JSONL 檔案中的任務")
+    parser.add_argument("--output", help="批次結果的 JSONL 檔案, 預設為 TASKS_JSONL 加上 .results.jsonl")
+    parser.add_argument("--auto-approve", action="store_true", help="自動同意所有確認 (套用編輯與創建步驟)")
+    parser.add_argument("--telemetry-file", default=TELEMETRY_PATH, help="每次呼叫的遙測紀錄 (JSONL, 自動輪替)")
+    parser.add_argument("--no-telemetry", action="store_true", help="不寫入遙測紀錄檔案 (/stats 仍可使用)")
+    parser.add_argument("--prometheus-textfile", help="將統計指標寫入 Prometheus textfile collector 檔案")
+    args = parser.parse_args()
+    
+    # 定義全局 MODEL 變量
+    MODEL = args.model
+    for spec in args.tier:
+        name, _, models = spec.partition('=')
+        models = [model.strip() for model in models.split(',') if model.strip()]
+        if not name or not models:
+            parser.error(f"--tier 格式應為 NAME=MODEL[,MODEL...]: {spec}")
+        MODEL_TIERS[name] = models
+    for spec in args.route:
+        call_type, _, tier = spec.partition('=')
+        if call_type not in ROUTE_TYPES and call_type not in ROUTE_ALIASES:
+            parser.error(f"--route 的呼叫類型必須是 {', '.join(ROUTE_TYPES + tuple(ROUTE_ALIASES))} 之一: {spec}")
+        if tier not in MODEL_TIERS:
+            parser.error(f"--route 指向未定義的層級 {tier!r}, 請先以 --tier 定義")
+        MODEL_ROUTES[call_type] = tier
+    for spec in args.price:
+        model, _, prices = spec.partition('=')
+        try:
+            input_price, output_price = (float(price) for price in prices.split(','))
+        except ValueError:
+            parser.error(f"--price 格式應為 MODEL=INPUT,OUTPUT: {spec}")
+        MODEL_PRICES[model.lower()] = (input_price, output_price)
+    ROUTE_TIMEOUT = args.route_timeout
+    ROUTE_COOLDOWN = args.route_cooldown
+    ROUTE_RACE = args.race
+    STREAM = not args.no_stream
+    MAX_WORKERS = max(1, args.workers)
+    EDIT_FORMAT = args.edit_format
+    EDIT_MODE = args.edit_mode
+    CONTEXT_BUDGET = args.context_budget
+    REVIEW_BATCH_TOKENS = max(1000, args.review_batch_tokens)
+    AUTO_CONTEXT_K = max(0, args.auto_context)
+    DELTA_MAX_RATIO = args.delta_max_ratio
+    CACHE_ENABLED = args.cache and not args.no_cache
+    PROMPT_CACHE = args.prompt_cache
+    REQUEST_TIMEOUT = args.timeout
+    MAX_RETRIES = max(0, args.max_retries)
+    RATE_LIMIT_RPM = args.rpm
+    HEDGE_AFTER = args.hedge_after
+    CACHE_TTL = args.cache_ttl * 3600
+    CACHE_MAX_BYTES = int(args.cache_max_mb * 1024 * 1024)
+
+    # OpenAI 客戶端在第一次請求時才建立
+    rate_limiter.configure(RATE_LIMIT_RPM)
+    client_settings = (args.api_key if args.api_key else "YOUR KEY", args.base_url)
+
+    configure_telemetry(None if args.no_telemetry else args.telemetry_file, args.prometheus_textfile)
+    AUTO_APPROVE = args.auto_approve
+    if args.batch:
+        BATCH_MODE = True
+        STREAM = False
+        output_path = args.output or f"{os.path.splitext(args.batch)[0]}.results.jsonl"
+        sys.exit(0 if run_batch(args.batch, output_path) else 1)
+    if args.daemon:
+        BATCH_MODE = True  # No prompts and no history; clients send self-contained tasks
+        sys.exit(0 if serve_daemon(args.socket) else 1)
+
+    print(colored(f"Stima engineer is ready to help you. Using model: {MODEL}", "cyan"))
+    for call_type in ROUTE_TYPES:
+        tier, models = route_tier(call_type)
+        if tier != 'default':
+            print(colored(f"  {call_type} → {tier}: {' → '.join(models)}", "dark_grey"))
+    print("\nAvailable commands:")
+    print(f"{colored('/edit', 'magenta'):<10} {colored('編輯文件或目錄 (跟隨路徑)', 'dark_grey')}")
+    print(f"{colored('/create', 'magenta'):<10} {colored('創建文件或文件夾 (跟隨指令)', 'dark_grey')}")
+    print(f"{colored('/add', 'magenta'):<10} {colored('添加文件或文件夾到上下文 (--outline 只添加簽名與文件字串)', 'dark_grey')}")
+    print(f"{colored('/debug', 'magenta'):<10} {colored('印出最後的 AI 回應', 'dark_grey')}")
+    print(f"{colored('/reset', 'magenta'):<10} {colored('重置聊天上下文並清除添加的文件', 'dark_grey')}")
+    print(f"{colored('/context', 'magenta'):<10} {colored('顯示上下文的 token 預算使用情況', 'dark_grey')}")
+    print(f"{colored('/cache', 'magenta'):<10} {colored('查看 (stats) 或清除 (clear) 回應快取', 'dark_grey')}")
+    print(f"{colored('/stats', 'magenta'):<10} {colored('顯示本次會話的延遲與 token 統計', 'dark_grey')}")
+    print(f"{colored('/review', 'magenta'):<10} {colored('審查代碼文件 (跟隨文件路徑, --changed 只審查有變更的文件)', 'dark_grey')}")
+    print(f"{colored('/planning', 'magenta'):<10} {colored('生成基於您請求的詳細計劃', 'dark_grey')}")
+    print(f"{colored('/jobs', 'magenta'):<10} {colored('列出背景工作 (在命令結尾加上 & 即可在背景執行)', 'dark_grey')}")
+    print(f"{colored('/wait', 'magenta'):<10} {colored('等待背景工作並顯示輸出 (跟隨工作編號, 預設全部)', 'dark_grey')}")
+    print(f"{colored('/cancel', 'magenta'):<10} {colored('取消背景工作並中止進行中的請求 (跟隨工作編號)', 'dark_grey')}")
+    print(f"{colored('/quit', 'magenta'):<10} {colored('退出腳本', 'dark_grey')}")
+
+    if WATCH_FILES and not args.no_watch:
+        file_watcher = FileWatcher()
+        logging.info(f"以 {file_watcher.method} 監看已添加的文件")
+
+    # Paths are completed from an index of the tree that is built and refreshed in the background
+    refresh_path_index()
+    completer = make_path_completer(
+        ['/edit', '/create', '/add', '/quit', '/debug', '/reset', '/context', '/cache', '/stats', '/review', '/planning', '/jobs', '/wait', '/cancel']
+    )
+
+    added_files = {}
+    file_contents = {}
+    if args.session:
+        SESSION_NAME = args.session
+        added_files.update(load_session(SESSION_NAME))
+        if session_turns or session_summary:
+            print(colored(f"已恢復會話 {SESSION_NAME}: {len(session_turns)} 輪對話{' 與較早對話的摘要' if session_summary else ''}, {len(added_files)} 個文件", "cyan"))
+        else:
+            print(colored(f"新會話: {SESSION_NAME}", "cyan"))
+
+    import asyncio
+    sys.stdout = OutputRouter(sys.stdout)  # Keeps the output of background jobs apart
+    try:
+        asyncio.run(run_repl(added_files, completer))
+    finally:
+        sys.stdout = sys.stdout.stream
 
 
 
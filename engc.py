@@ -0,0 +1,133 @@
+"""Thin client for the eng.py daemon.
+
+Sends one command to the daemon over its Unix socket and streams the reply
+back. The model's answer goes to stdout and progress messages go to stderr,
+so the output can be piped from editor hooks and scripts. Only the standard
+library is imported to keep each call fast. The daemon is started in the
+background on first use.
+
+Usage:
+    python engc.py "How is the retry layer configured?"
+    python engc.py /review src/
+    python engc.py /review src/ --changed
+    python engc.py /edit eng.py --instruction "Add type hints" --auto-approve
+    python engc.py --ping
+    python engc.py --stop
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+STATE_DIR = os.path.join(os.path.expanduser('~'), '.stima_engineer')
+DAEMON_SOCKET = os.path.join(STATE_DIR, 'daemon.sock')
+ENG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'eng.py')
+
+
+def connect(socket_path):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except OSError:
+        client.close()
+        raise
+    return client
+
+
+def start_daemon(socket_path, daemon_args, wait=30.0):
+    """Start eng.py --daemon in the background and wait until it accepts connections."""
+    os.makedirs(STATE_DIR, exist_ok=True)
+    with open(os.path.join(STATE_DIR, 'daemon.log'), 'a', encoding='utf-8') as log:
+        subprocess.Popen(
+            [sys.executable, ENG_PATH, '--daemon', '--socket', socket_path] + daemon_args,
+            stdin=subprocess.DEVNULL, stdout=log, stderr=log, start_new_session=True,
+        )
+    deadline = time.monotonic() + wait
+    while time.monotonic() < deadline:
+        try:
+            return connect(socket_path)
+        except OSError:
+            time.sleep(0.05)
+    raise SystemExit(f"守護程序未能在 {wait:.0f} 秒內啟動, 請查看 {os.path.join(STATE_DIR, 'daemon.log')}")
+
+
+def send_task(task, socket_path, daemon_args, autostart=True):
+    """Send task and stream the events back; return the final result record."""
+    try:
+        client = connect(socket_path)
+    except OSError:
+        if not autostart:
+            raise SystemExit(f"守護程序未在 {socket_path} 執行")
+        print("啟動守護程序...", file=sys.stderr)
+        client = start_daemon(socket_path, daemon_args)
+
+    streamed = False
+    with client, client.makefile('r', encoding='utf-8') as reader:
+        client.sendall((json.dumps(task, ensure_ascii=False) + "\n").encode('utf-8'))
+        for line in reader:
+            event = json.loads(line)
+            if event['type'] == 'delta':
+                sys.stdout.write(event['data'])
+                sys.stdout.flush()
+                streamed = True
+            elif event['type'] == 'output':
+                sys.stderr.write(event['data'])
+                sys.stderr.flush()
+            elif event['type'] == 'result':
+                record = event['data']
+                if record.get('output') and not streamed:
+                    sys.stdout.write(record['output'])
+                if record.get('output') or streamed:
+                    sys.stdout.write("\n")
+                return record
+    raise SystemExit("守護程序在回傳結果前中斷了連線")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send a command to the eng.py daemon")
+    parser.add_argument("command", nargs='*', help="chat message or /edit, /create, /review, /planning command")
+    parser.add_argument("--files", nargs='*', default=[], help="files or folders to add to the context first")
+    parser.add_argument("--outline", nargs='*', default=[], help="files or folders to add as outlines (signatures and docstrings only)")
+    parser.add_argument("--instruction", help="edit instruction for /edit")
+    parser.add_argument("--changed", action="store_true", help="with /review, only review files changed since their stored review")
+    parser.add_argument("--auto-approve", action="store_true", help="apply edits and created files")
+    parser.add_argument("--socket", default=DAEMON_SOCKET)
+    parser.add_argument("--no-start", action="store_true", help="fail instead of starting the daemon")
+    parser.add_argument("--daemon-args", default="", help="extra eng.py options when the daemon is started, e.g. \"--model gpt-4o\"")
+    parser.add_argument("--ping", action="store_true", help="check that the daemon is running and report the round trip")
+    parser.add_argument("--stop", action="store_true", help="stop the daemon")
+    args = parser.parse_args()
+
+    daemon_args = args.daemon_args.split()
+    if args.ping or args.stop:
+        start = time.perf_counter()
+        record = send_task({'command': '/ping' if args.ping else '/shutdown'}, args.socket, daemon_args, autostart=args.ping and not args.no_start)
+        if args.ping:
+            print(f"守護程序 pid {record.get('pid')} 回應時間 {(time.perf_counter() - start) * 1000:.1f}ms", file=sys.stderr)
+        return 0
+
+    if not args.command:
+        parser.error("請提供指令或訊息")
+    task = {
+        'command': " ".join(args.command + (['--changed'] if args.changed else [])),
+        'files': args.files,
+        'outline': args.outline,
+        'cwd': os.getcwd(),
+        'auto_approve': args.auto_approve,
+    }
+    if args.instruction:
+        task['instruction'] = args.instruction
+    record = send_task(task, args.socket, daemon_args, autostart=not args.no_start)
+    if record.get('status') != 'ok':
+        print(f"錯誤: {record.get('error')}", file=sys.stderr)
+        return 1
+    if record.get('files_changed'):
+        print("已變更: " + ", ".join(record['files_changed']), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())